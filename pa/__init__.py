@@ -1,3 +1 @@
-from . import db
 from . import utils
-from . import modules
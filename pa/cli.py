@@ -13,9 +13,10 @@
  '-^--^---'--^---^-^--^--^---'--^---^-^-^-==-^--^---^-'
 
 Usage:
+  pa init
+  pa daemon [stop | status]
   pa <command> [<args>...]
   pa [options]
-  pa init
 
 Options:
   -s, --sync        Run the sync scripts for all sub-commands
@@ -24,24 +25,77 @@ Options:
 
 Commands:
 {}
+'pa daemon' keeps a resident pa process running in order to make subsequent
+commands near instant. Commands fall back to running normally when there is no
+daemon running.
+
 Use 'pa <command> --help' for specific information regarding a sub command
 '''
-import os
+import sys
 from traceback import print_exc
-from importlib import import_module
-from importlib.util import spec_from_file_location, module_from_spec
 
-from docopt import docopt, DocoptExit
+from docopt import docopt, DocoptExit, DocoptLanguageError
 
-from .db import db_init
-from .utils import get_config, init_config_dir, print_red, MOD_DIR
+from . import daemon
+from .manifest import get_manifest, load_module
+from .sync import run_syncs, print_summary
+from .utils import get_config, init_config_dir, print_red, print_green, \
+    print_yellow, MOD_DIR
 
 
 __version__ = '0.3.5'
 
 
 def main(argv=None):
-    sub_commands, cmd_map = get_sub_commands()
+    '''
+    Entry point for the pa command: hand the command off to the daemon if
+    there is one running, otherwise run it ourselves.
+    '''
+    if argv is None:
+        argv = sys.argv[1:]
+
+    if not _run_in_process(argv):
+        status = daemon.forward(argv)
+        if status is not None:
+            exit(status)
+
+    run(argv)
+
+
+def _run_in_process(argv):
+    '''
+    Check if a command must not be handed to the daemon: `pa daemon` itself,
+    long running commands and the top level options. `pa --sync` leaves any
+    module sync that times out running on its thread, which must die with
+    the process rather than keep writing to the next client's terminal.
+    '''
+    if not argv or argv[0] == 'daemon' or argv[0].startswith('-'):
+        return True
+
+    return _long_running(argv)
+
+
+def _long_running(argv):
+    '''
+    Check if a command runs until it is interrupted (`pa mail watch`). The
+    daemon runs one command at a time so these would block every other
+    client and are always run in-process instead. Any of the words that the
+    module lists in LONG_RUNNING appearing in its arguments is enough: the
+    worst that a false positive can do is skip the daemon.
+    '''
+    entry = get_manifest(MOD_DIR).get(argv[0]) if argv else None
+    if entry is None:
+        return False
+
+    words = set(entry.get('long_running', []))
+    return any(arg in words for arg in argv[1:])
+
+
+def run(argv):
+    '''
+    Parse and run a pa command in this process.
+    '''
+    sub_commands, manifest = get_sub_commands()
     cmd_str = format_sub_command_section(sub_commands)
 
     args = docopt(
@@ -52,21 +106,33 @@ def main(argv=None):
     )
 
     if args['init']:
+        # peewee is only needed here so don't pay for importing it on
+        # every other run.
+        from .db import db_init
         init_config_dir()
         db_init(MOD_DIR)
         exit()
+    elif args['daemon']:
+        _daemon_command(args)
+        exit()
     elif args['--sync']:
         # Sync everything
         # NOTE: sync must take only the config as an argument
         config = get_config()
-        for mod in cmd_map.values():
-            if 'sync' in dir(mod):
-                mod.sync(config)
-        exit()
+        modules = {}
+        for name, entry in manifest.items():
+            if entry['sync']:
+                mod = _load_or_report(entry)
+                if mod is not None:
+                    modules[name] = mod
+
+        results = run_syncs(modules, config)
+        print_summary(results)
+        exit(0 if all(r.status == 'ok' for r in results) else 1)
     elif args['<command>'] is not None:
         if args['<command>'].startswith('_comp'):
             # private helper functions for zsh completions
-            _completion_helper(args['<command>'], args['<args>'])
+            _completion_helper(args['<command>'], args['<args>'], sub_commands)
             exit()
     else:
         # <command> is None and no flags set
@@ -77,59 +143,100 @@ def main(argv=None):
     command = args['<command>']
     argv = [command] + args['<args>']
 
-    try:
-        module = cmd_map[command]
+    entry = manifest.get(command)
+    if entry is None:
+        exit("{} is not a pa command. See 'pa --help'".format(command))
+
+    if entry['doc']:
+        # docopt prints the help and exits if -h/--help was passed as an
+        # option (rather than as the value of one). The cached docstring is
+        # enough for that so help doesn't import the module. Anything else is
+        # parsed again below against the module's own docstring.
         try:
-            args = docopt(module.__doc__, argv=argv)
-        except DocoptExit:
-            print(module.__doc__)
-        module.run(args)
-    except ImportError:
-        print_red("Module '{}' failed to load".format(command))
-        print_red("Error was:")
-        print_exc()
+            docopt(entry['doc'], argv=argv)
+        except (DocoptExit, DocoptLanguageError):
+            pass
+
+    module = _load_or_report(entry)
+    if module is None:
+        exit()
+
+    try:
+        args = docopt(module.__doc__, argv=argv)
+    except DocoptExit:
+        print(module.__doc__)
         exit()
-    except KeyError:
-        exit("{} is not a pa command. See 'pa --help'".format(command))
+
+    module.run(args)
 
 
 def get_sub_commands():
     '''
-    Walk both the modules directory and the user module directory to find
-    commands that we can run.
-
-    pa makes no distinction between built-in and user defined modules.
-    '''
-    def valid_module(fname):
-        '''_ marks a file as not being a pa module'''
-        return fname.endswith('.py') and not fname.startswith('_')
-
-    sub_commands = []
-    cmd_map = {}
-
-    # Built-in
-    built_in_modules = import_module('.modules', package='pa')
-    for entry in dir(built_in_modules):
-        if not entry.startswith('_'):
-            module = getattr(built_in_modules, entry)
-            sub_commands.append((entry, module.SUMMARY))
-            cmd_map[entry] = module
-
-    # User-defined
-    for entry in os.listdir(MOD_DIR):
-        path = os.path.join(MOD_DIR, entry)
-        if os.path.isfile(path) and valid_module(entry):
-            spec = spec_from_file_location("module", path)
-            module = module_from_spec(spec)
-            spec.loader.exec_module(module)
-            cmd = entry[:-3]
-            sub_commands.append((cmd, module.SUMMARY))
-            cmd_map[cmd] = module
+    Find all of the commands that we can run from the cached manifest of the
+    modules directory and the user module directory.
+
+    Returns a sorted list of (name, summary) pairs along with the manifest
+    itself so that the module for a command can be loaded on demand.
+    '''
+    manifest = get_manifest(MOD_DIR)
 
     # Sort by sub-command name
-    sub_commands = sorted(sub_commands, key=lambda t: t[0])
+    sub_commands = sorted(
+        (name, entry['summary']) for name, entry in manifest.items()
+    )
 
-    return sub_commands, cmd_map
+    return sub_commands, manifest
+
+
+def _daemon_command(args):
+    '''
+    Start, stop or check on the resident pa daemon.
+    '''
+    if args['stop'] or args['status']:
+        reply = daemon.control('stop' if args['stop'] else 'status')
+        if reply is None:
+            print_yellow('pa daemon is not running')
+        elif args['stop']:
+            print_green('Stopped pa daemon (pid {})'.format(reply['pid']))
+        else:
+            print_green('pa daemon is running (pid {})'.format(reply['pid']))
+    else:
+        daemon.serve(run, warm_up=_warm_up)
+
+
+def _warm_up():
+    '''
+    Load everything that the daemon should keep hold of between commands.
+    '''
+    get_config()
+    _, manifest = get_sub_commands()
+
+    for entry in manifest.values():
+        try:
+            load_module(entry)
+        except Exception:
+            # Missing optional dependencies will be reported if the
+            # command is actually run.
+            pass
+
+    try:
+        from .db import DB
+        DB.connect(reuse_if_open=True)
+    except Exception:
+        pass
+
+
+def _load_or_report(entry):
+    '''
+    Import a module from its manifest entry, reporting (rather than raising)
+    any errors so that one broken module can't take down the others.
+    '''
+    try:
+        return load_module(entry)
+    except Exception:
+        print_red("Module '{}' failed to load".format(entry['name']))
+        print_red("Error was:")
+        print_exc()
 
 
 def format_sub_command_section(sub_commands):
@@ -153,12 +260,10 @@ def format_sub_command_section(sub_commands):
     return cmd_str
 
 
-def _completion_helper(cmd, args):
+def _completion_helper(cmd, args, sub_commands):
     '''
     Output helper text for the _pa zsh completion file to use.
     '''
-    sub_commands, cmd_map = get_sub_commands()
-
     if cmd == '_comp_sub_commands':
         # output zsh format completion descriptions
         comps = []
@@ -169,4 +274,4 @@ def _completion_helper(cmd, args):
     elif cmd == '_comp_note_root':
         # Display the user's note root directory
         config = get_config()
-        print(config['note']['note_root'])
+        print(config.note.path('note_root'))
@@ -0,0 +1,312 @@
+'''
+An optional resident pa process to avoid paying start up costs on every run.
+
+`pa daemon` listens on a Unix socket in the config directory and keeps the
+parsed config, imported modules, the database connection and any network
+sessions warm between commands. A normal `pa` invocation first tries to hand
+its argv, working directory and stdin/stdout/stderr file descriptors over to
+the daemon, which runs the command directly against the caller's terminal and
+replies with the exit status. The caller's environment is sent along with the
+command and swapped in for the daemon's while it runs. If no daemon is running
+then the command is run in-process as normal.
+
+Commands are run one at a time in the daemon process so any further clients
+simply queue until the current command finishes. If the client goes away
+(ctrl-c) then the command is interrupted as if it had been run directly.
+Restart the daemon after upgrading pa or editing a built-in module.
+'''
+import os
+import sys
+import json
+import time
+import socket
+import signal
+import select
+import threading
+from traceback import print_exc
+
+from .utils import CONFIG_ROOT, print_green, print_yellow
+
+
+SOCKET_PATH = os.path.join(CONFIG_ROOT, 'pa.sock')
+CONNECT_TIMEOUT = 0.5
+MAX_MSG_LEN = 64 * 1024
+
+
+def forward(argv, path=SOCKET_PATH):
+    '''
+    Try to run a command in the daemon, returning its exit status or None if
+    there is no daemon available to run it.
+    '''
+    if not hasattr(socket, 'send_fds') or not os.path.exists(path):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(CONNECT_TIMEOUT)
+
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+
+    sock.settimeout(None)
+    request = {'argv': argv, 'cwd': os.getcwd(), 'env': dict(os.environ)}
+
+    with sock:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        try:
+            socket.send_fds(sock, [_encode(request)], [0, 1, 2])
+        except OSError:
+            return None
+
+        try:
+            reply = _read_message(sock)
+        except KeyboardInterrupt:
+            # Closing the socket lets the daemon know to stop the command
+            return 130
+
+    if reply is None:
+        # The daemon went away part way through the command
+        return 1
+
+    return reply.get('status', 1)
+
+
+def control(action, path=SOCKET_PATH):
+    '''
+    Send a control message ('stop' or 'status') to a running daemon, returning
+    its reply or None if no daemon is running.
+    '''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(CONNECT_TIMEOUT)
+
+    with sock:
+        try:
+            sock.connect(path)
+            sock.settimeout(None)
+            sock.sendall(_encode({'control': action}))
+        except OSError:
+            return None
+
+        return _read_message(sock)
+
+
+def serve(run_command, warm_up=None, path=SOCKET_PATH):
+    '''
+    Run the daemon in the foreground until it is sent a stop message.
+
+    `run_command` is called with each forwarded argv and should behave like
+    the pa entry point (including raising SystemExit). `warm_up` is called
+    once before we start accepting connections.
+    '''
+    if control('status', path) is not None:
+        print_yellow('pa daemon is already running')
+        return
+
+    if os.path.exists(path):
+        # Stale socket left behind by a daemon that didn't shut down cleanly
+        os.unlink(path)
+
+    if warm_up is not None:
+        warm_up()
+
+    # Shells start background jobs with SIGINT ignored but we rely on it to
+    # interrupt commands when the client goes away.
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o077)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(old_umask)
+
+    server.listen(16)
+    print_green('pa daemon listening on {} (pid {})'.format(path, os.getpid()))
+    sys.stdout.flush()
+
+    try:
+        while True:
+            conn, _ = server.accept()
+            with conn:
+                if not _handle(conn, run_command):
+                    break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def _handle(conn, run_command):
+    '''
+    Process a single client connection, returning False if the daemon should
+    shut down.
+    '''
+    try:
+        data, fds, _, _ = socket.recv_fds(conn, MAX_MSG_LEN, 3)
+    except OSError:
+        return True
+
+    try:
+        request = _read_message(conn, data)
+        if request is None:
+            return True
+
+        action = request.get('control')
+        if action == 'stop':
+            conn.sendall(_encode({'status': 0, 'pid': os.getpid()}))
+            return False
+        elif action == 'status':
+            conn.sendall(_encode({'status': 0, 'pid': os.getpid()}))
+            return True
+
+        if len(fds) != 3:
+            conn.sendall(_encode({'status': 1}))
+            return True
+
+        status = _run_with_fds(run_command, request, fds, conn)
+        try:
+            conn.sendall(_encode({'status': status}))
+        except OSError:
+            # The client has gone away (most likely ctrl-c)
+            pass
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+    return True
+
+
+def _run_with_fds(run_command, request, fds, conn=None):
+    '''
+    Run a command with the client's stdin/stdout/stderr, working directory
+    and environment swapped in for our own, restoring ours afterwards. The
+    command is interrupted if the client hangs up on `conn` before it
+    finishes.
+    '''
+    saved_fds = [os.dup(n) for n in range(3)]
+    saved_cwd = os.getcwd()
+    saved_env = dict(os.environ)
+    saved_stdin = sys.stdin
+    status = 0
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    for n, fd in enumerate(fds):
+        os.dup2(fd, n)
+
+    # The builtin exit() closes sys.stdin and reads may leave data buffered
+    # so each command gets its own wrapper around fd 0.
+    sys.stdin = open(0, 'r', closefd=False)
+
+    done = threading.Event()
+    watcher = threading.Thread(
+        target=_interrupt_on_hangup, args=(conn, done), daemon=True)
+
+    try:
+        try:
+            if conn is not None:
+                watcher.start()
+            os.chdir(request.get('cwd', saved_cwd))
+            if 'env' in request:
+                _set_environ(request['env'])
+            run_command(request['argv'])
+        finally:
+            # Once the watcher has stopped there can be no further interrupts
+            done.set()
+            if watcher.is_alive():
+                watcher.join()
+    except SystemExit as e:
+        status = _exit_status(e.code)
+    except KeyboardInterrupt:
+        status = 130
+    except BaseException:
+        print_exc()
+        status = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        sys.stdin.close()
+        sys.stdin = saved_stdin
+        for n, fd in enumerate(saved_fds):
+            os.dup2(fd, n)
+            os.close(fd)
+        os.chdir(saved_cwd)
+        _set_environ(saved_env)
+
+    return status
+
+
+def _interrupt_on_hangup(conn, done):
+    '''
+    Raise KeyboardInterrupt in the main thread if the client closes its end
+    of the connection while a command is running.
+    '''
+    while not done.is_set():
+        if not select.select([conn], [], [], 0.2)[0]:
+            continue
+
+        try:
+            data = conn.recv(1, socket.MSG_PEEK)
+        except OSError:
+            data = b''
+
+        if not data and not done.is_set():
+            # A real signal (rather than _thread.interrupt_main) so that any
+            # blocking call in the main thread is woken up.
+            signal.pthread_kill(threading.main_thread().ident, signal.SIGINT)
+
+        # Clients don't send anything else so either way we are done
+        return
+
+
+def _set_environ(env):
+    '''
+    Replace the whole of os.environ, picking up any change to TZ.
+    '''
+    os.environ.clear()
+    os.environ.update(env)
+    time.tzset()
+
+
+def _exit_status(code):
+    '''
+    Mirror the interpreter's handling of the argument to sys.exit.
+    '''
+    if code is None:
+        return 0
+    elif isinstance(code, int):
+        return code
+
+    print(code, file=sys.stderr)
+    sys.stderr.flush()
+    return 1
+
+
+def _encode(msg):
+    return (json.dumps(msg) + '\n').encode()
+
+
+def _read_message(sock, data=b''):
+    '''
+    Read a single newline terminated JSON message from the socket.
+    '''
+    while not data.endswith(b'\n'):
+        try:
+            chunk = sock.recv(MAX_MSG_LEN)
+        except OSError:
+            return None
+
+        if not chunk:
+            return None
+
+        data += chunk
+
+    try:
+        return json.loads(data.decode())
+    except ValueError:
+        return None
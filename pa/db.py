@@ -2,12 +2,12 @@
 Database functionality for pa via peewee.
 '''
 import os
-from importlib import import_module
-from importlib.util import spec_from_file_location, module_from_spec
+import json
 
 import peewee
 
-from .utils import print_yellow, print_green, MOD_DIR
+from .manifest import get_manifest, load_module
+from .utils import print_red, print_yellow, print_green, MOD_DIR
 
 
 # Location of the pa sqlite database
@@ -25,26 +25,48 @@ class PaModel(peewee.Model):
         database = DB
 
 
+class State(PaModel):
+    '''
+    Key/value storage for small pieces of JSON serialisable state that
+    modules need to keep between runs (sync tokens and the like).
+    '''
+    key = peewee.CharField(unique=True)
+    value = peewee.TextField()
+
+
+def get_state(key, default=None):
+    '''
+    Look up a value stored with set_state.
+    '''
+    State.create_table(safe=True)
+    row = State.get_or_none(State.key == key)
+    return default if row is None else json.loads(row.value)
+
+
+def set_state(key, value):
+    '''
+    Store a value under the given key, replacing any existing value.
+    '''
+    State.create_table(safe=True)
+    State.insert(
+        key=key, value=json.dumps(value)
+    ).on_conflict_replace().execute()
+
+
 def db_init(mod_dir=MOD_DIR):
     '''
     Initialise the local SQLite database by walking each of the built-in and
     user modules, looking for PaModel classes and creating a table for each
     one that we find.
     '''
-    # Built-in
-    built_in_modules = import_module('.modules', package='pa')
-    for entry in dir(built_in_modules):
-        module = getattr(built_in_modules, entry)
-        init_tables(module)
+    for name, entry in sorted(get_manifest(mod_dir).items()):
+        try:
+            module = load_module(entry)
+        except ImportError as e:
+            print_red('Unable to load {}: {}'.format(name, e))
+            continue
 
-    # User-defined
-    for entry in os.listdir(mod_dir):
-        path = os.path.join(mod_dir, entry)
-        if os.path.isfile(path) and path.endswith('.py'):
-            spec = spec_from_file_location("module", path)
-            module = module_from_spec(spec)
-            spec.loader.exec_module(module)
-            init_tables(module)
+        init_tables(module)
 
 
 def init_tables(module):
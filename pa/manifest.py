@@ -0,0 +1,210 @@
+'''
+A cached manifest of the sub-commands available to pa.
+
+Building the top level help and the zsh completions only needs the name,
+SUMMARY and docstring of each module, and deciding whether to hand a command
+to the daemon only needs LONG_RUNNING (the sub-command words that run until
+interrupted). These are read from the module source with `ast` (without
+executing it) and cached in `~/.config/pa/manifest.json` along with the path
+and mtime of the file so that only modules that have changed since the last
+run need to be re-read. The only module that ever gets imported is the one
+that is actually being run.
+'''
+import os
+import ast
+import json
+from importlib import import_module
+from importlib.util import spec_from_file_location, module_from_spec
+
+from .utils import atomic_write, CONFIG_ROOT, MOD_DIR
+
+
+MANIFEST_PATH = os.path.join(CONFIG_ROOT, 'manifest.json')
+MANIFEST_VERSION = 2
+BUILT_IN_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'modules')
+
+# Loaded user modules as {path: (mtime, module)} so that a long running pa
+# process only re-executes a user module when it has been edited.
+_USER_MODULES = {}
+
+
+def valid_module(fname):
+    '''_ marks a file as not being a pa module'''
+    return fname.endswith('.py') and not fname.startswith('_')
+
+
+def module_files(mod_dir=MOD_DIR):
+    '''
+    Find the source file for each sub-command as {name: (path, built_in)}.
+
+    pa makes no distinction between built-in and user defined modules other
+    than user modules taking precedence if the names clash.
+    '''
+    files = {}
+
+    for built_in, directory in [(True, BUILT_IN_DIR), (False, mod_dir)]:
+        if not os.path.isdir(directory):
+            continue
+
+        for entry in os.listdir(directory):
+            path = os.path.join(directory, entry)
+            if os.path.isfile(path) and valid_module(entry):
+                files[entry[:-3]] = (path, built_in)
+
+    return files
+
+
+def get_manifest(mod_dir=MOD_DIR, path=MANIFEST_PATH):
+    '''
+    Return {name: entry} for every available sub-command, re-reading only
+    those module files whose mtime or size differs from the cached manifest.
+    '''
+    cached = _read_manifest(path)
+    manifest = {}
+    dirty = False
+
+    for name, (src, built_in) in module_files(mod_dir).items():
+        stat = os.stat(src)
+        entry = cached.get(name)
+
+        if (entry is None or entry['path'] != src
+                or entry['mtime'] != stat.st_mtime_ns
+                or entry['size'] != stat.st_size):
+            entry = _manifest_entry(name, src, built_in, stat)
+            dirty = True
+
+        manifest[name] = entry
+
+    if dirty or manifest.keys() != cached.keys():
+        _write_manifest(manifest, path)
+
+    return manifest
+
+
+def load_module(entry):
+    '''
+    Import the module for a manifest entry.
+    '''
+    if entry['built_in']:
+        return import_module('.modules.{}'.format(entry['name']), package='pa')
+
+    cached = _USER_MODULES.get(entry['path'])
+    if cached is not None and cached[0] == entry['mtime']:
+        return cached[1]
+
+    spec = spec_from_file_location(
+        'pa_user_{}'.format(entry['name']), entry['path'])
+    module = module_from_spec(spec)
+    spec.loader.exec_module(module)
+    _USER_MODULES[entry['path']] = (entry['mtime'], module)
+    return module
+
+
+def read_module_header(path):
+    '''
+    Parse a module file and pull out its docstring, SUMMARY, LONG_RUNNING and
+    whether or not it defines a top level `sync` function.
+
+    SUMMARY is None if it is not a plain string literal and LONG_RUNNING must
+    be a literal list of strings.
+    '''
+    with open(path, 'rb') as f:
+        tree = ast.parse(f.read(), filename=path)
+
+    doc = ast.get_docstring(tree, clean=False)
+    summary = None
+    long_running = []
+    has_sync = False
+
+    for node in tree.body:
+        if isinstance(node, ast.Assign):
+            names = [t.id for t in node.targets if isinstance(t, ast.Name)]
+            if 'SUMMARY' in names:
+                try:
+                    summary = ast.literal_eval(node.value)
+                except ValueError:
+                    summary = None
+            if 'LONG_RUNNING' in names:
+                try:
+                    long_running = [
+                        str(w) for w in ast.literal_eval(node.value)]
+                except (ValueError, TypeError):
+                    long_running = []
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            if node.name == 'sync':
+                has_sync = True
+
+    return doc, summary, long_running, has_sync
+
+
+def _manifest_entry(name, path, built_in, stat):
+    '''
+    Build the manifest entry for a single module file.
+    '''
+    entry = {
+        'name': name,
+        'path': path,
+        'built_in': built_in,
+        'mtime': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'doc': None,
+        'summary': '<unable to read module>',
+        'sync': False,
+        'long_running': [],
+    }
+
+    try:
+        doc, summary, long_running, has_sync = read_module_header(path)
+    except (SyntaxError, ValueError):
+        # Leave the placeholder summary in place: actually running the
+        # command will show the real error.
+        return entry
+
+    if not isinstance(summary, str):
+        # SUMMARY is computed at import time so we have no choice but to
+        # import the module to find it.
+        try:
+            summary = str(load_module(entry).SUMMARY)
+        except Exception:
+            summary = '<unable to read module>'
+
+    entry.update({
+        'doc': doc,
+        'summary': summary,
+        'sync': has_sync,
+        'long_running': long_running,
+    })
+    return entry
+
+
+def _read_manifest(path):
+    '''
+    Load the cached manifest, returning an empty one if it is missing,
+    corrupt or was written by a different version of pa.
+    '''
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    if not isinstance(data, dict) or data.get('version') != MANIFEST_VERSION:
+        return {}
+
+    return data.get('modules', {})
+
+
+def _write_manifest(manifest, path):
+    '''
+    Write out the manifest. Failing to do so is not an error: we just have to
+    rebuild it on the next run.
+    '''
+    if not os.path.isdir(os.path.dirname(path)):
+        return
+
+    try:
+        with atomic_write(path) as f:
+            json.dump({'version': MANIFEST_VERSION, 'modules': manifest}, f)
+    except OSError:
+        pass
@@ -1,8 +1,5 @@
 # Modules
-from . import cal
-from . import howto
-from . import mail
-from . import note
-from . import todo
-from . import toggl
-from . import spotify
+#
+# Each file in this directory (other than those starting with an underscore)
+# is a pa sub-command. They are discovered and imported on demand by
+# pa.manifest so nothing is imported here.
@@ -3,27 +3,103 @@ pa cal - Check upcoming events in your calendars
 
 The default query (no arguments) is to look at all calendars for
 the next 7 days.
-Dates should be provided in 'yyy-mm-dd' format.
+Dates should be provided in 'yyyy-mm-dd' format.
+
+The events from each calendar are cached locally and feeds are only parsed
+again when the server tells us that they have changed. Cached events are kept
+in an interval index so that looking up a time range doesn't depend on how
+much history the calendars have. Recurring events are expanded (honouring
+RRULE, RDATE, EXDATE and any modified instances) only within the requested
+time range.
 
 Usage:
   pa cal list
   pa cal show [--from=<date>] [--to=<date>] [--cal=<name>]
   pa cal (-h | --help)
 '''
-from datetime import datetime, date, timedelta
+import json
+import hashlib
+from collections import defaultdict
+from datetime import datetime, date, time, timedelta
 
-import requests
+import peewee
 from pytz import utc
-from icalendar import Calendar
+from dateutil import tz
+from dateutil.rrule import rruleset, rrulestr
+from icalendar import Calendar, vRecur
 
-from ..utils import get_config, run_many_tagged, print_red, print_yellow, \
-    print_green
+from ..db import DB, PaModel, get_state, set_state
+from ..utils import get_config, iter_many_tagged, http_request, print_red, \
+    print_yellow, print_green
 
 
 SUMMARY = 'View upcoming events in your calendars'
 
 DEFAULT_QUERY_LENGTH = timedelta(days=7)
 DEFAULT_ENCODING = 'utf-8'
+# Rows per INSERT when caching the events from a feed
+INSERT_BATCH_SIZE = 100
+# An R*Tree over the (start, end) of every cached event, keyed on CalEvent.id.
+# R*Tree coordinates are 32 bit floats so matches are re-checked against the
+# exact times in the CalEvent table.
+SPAN_SCHEMA = '''\
+CREATE VIRTUAL TABLE IF NOT EXISTS cal_event_span USING rtree(
+    id,
+    start_ts,
+    end_ts
+)'''
+# The end of a recurring event that repeats forever (exactly representable as
+# an R*Tree coordinate).
+FOREVER = 2 ** 53
+# Bump this when the layout of the cached events changes: the cache is simply
+# rebuilt from the feeds.
+CACHE_VERSION = 2
+CACHE_VERSION_KEY = 'cal.cache_version'
+
+# Expanded recurring events as {(calendar, event id): (feed digest, rules)} so
+# that a long running pa process only expands each series once per version
+# of its feed.
+_RULESETS = {}
+
+
+class CalFeed(PaModel):
+    '''
+    A calendar feed that we have downloaded, along with the validators needed
+    to ask the server whether it has changed since.
+    '''
+    calendar = peewee.CharField(unique=True)
+    url = peewee.CharField()
+    etag = peewee.CharField(null=True)
+    last_modified = peewee.CharField(null=True)
+    digest = peewee.CharField()
+
+
+class CalEvent(PaModel):
+    '''
+    A single event parsed from a calendar feed. Times are stored as UTC
+    timestamps.
+    '''
+    calendar = peewee.CharField(index=True)
+    uid = peewee.CharField(null=True)
+    start_ts = peewee.IntegerField(index=True)
+    end_ts = peewee.IntegerField()
+    duration = peewee.IntegerField()
+    all_day = peewee.BooleanField(default=False)
+    summary = peewee.TextField()
+    description = peewee.TextField(null=True)
+    # For recurring events end_ts is the end of the last occurrence (or
+    # FOREVER) and the occurrences are expanded from the fields below in the
+    # timezone of the event so that they don't drift across DST changes.
+    freq = peewee.CharField(null=True)
+    rrule = peewee.TextField(null=True)
+    rdates = peewee.TextField(null=True)
+    exdates = peewee.TextField(null=True)
+    tzid = peewee.CharField(null=True)
+    utc_offset = peewee.IntegerField(default=0)
+
+    @property
+    def recurring(self):
+        return self.rrule is not None or self.rdates is not None
 
 
 def run(args):
@@ -37,6 +113,7 @@ def run(args):
             raise ValueError('Invalid date given: {}\n{}'.format(s, e))
 
     config = get_config()
+    init_cache()
 
     if args['list']:
         show_calendars(config)
@@ -51,28 +128,25 @@ def run(args):
         end = str_to_date(end)
 
     cal = args['--cal']
+    calendars = config.cal.calendars
 
     if cal:
         # Only run for this calendar
-        url = config['cal']['calendars'].get(cal)['url']
-        if url is None:
+        details = calendars.get(cal)
+        if details is None:
             print_red('{} is not a configured calendar'.format(cal))
             show_calendars(config)
             exit()
 
-        show_events(cal, url, start, end)
-    else:
-        # Run for all calendars
-        args = []
-        for cal, data in config['cal']['calendars'].items():
-            url = data['url']
-            args.append((cal, (url, start, end)))
+        calendars = {cal: details}
 
-        evts = run_many_tagged(events, args)
+    refresh_feeds(calendars)
+    found = cached_events(list(calendars), start=start, end=end)
 
-        for cal, es in evts.items():
-            print_yellow('[{}]'.format(cal))
-            for e in es:
+    for name in calendars:
+        if name in found or cal:
+            print_yellow('[{}]'.format(name))
+            for e in found.get(name, []):
                 print(e)
             print()
 
@@ -82,46 +156,142 @@ def show_calendars(config):
     Show each of the currently configured calendars
     '''
     print_green('Configured calendars are:')
-    for c in config['cal']['calendars']:
+    for c in config.cal.calendars:
         print('  {}'.format(c))
 
 
-def show_events(cal, url, start=None, end=None):
+def refresh_feeds(calendars):
+    '''
+    Bring our cached copies of the given calendars up to date, fetching the
+    feeds concurrently. If a feed can't be fetched then we fall back to the
+    cached events.
+    '''
+    tag_args = [
+        (cal, (cal, details.url)) for cal, details in calendars.items()
+    ]
+
+    for cal, _, error in iter_many_tagged(refresh_feed, tag_args):
+        if error is None:
+            continue
+
+        if CalFeed.get_or_none(CalFeed.calendar == cal) is None:
+            print_red('Unable to fetch {}: {}'.format(cal, error))
+        else:
+            print_yellow('Unable to refresh {}, using cached events: {}'
+                         .format(cal, error))
+
+
+def init_cache():
+    '''
+    Create the tables for the event cache, throwing away any cache written by
+    an older version of pa.
+    '''
+    if get_state(CACHE_VERSION_KEY) != CACHE_VERSION:
+        DB.execute_sql('DROP TABLE IF EXISTS cal_event_span')
+        DB.drop_tables([CalEvent, CalFeed], safe=True)
+        set_state(CACHE_VERSION_KEY, CACHE_VERSION)
+
+    CalFeed.create_table(safe=True)
+    CalEvent.create_table(safe=True)
+    init_span_index()
+
+
+def init_span_index():
     '''
-    Show all of the events in the given time range
+    Create the interval index if we don't have it yet, indexing any events
+    that were cached before it existed. Returns False if this build of SQLite
+    doesn't have the R*Tree module.
     '''
-    print_yellow('[{}]'.format(cal))
-    for e in events(url, start=start, end=end):
-        print(e)
-    print()
+    exists = DB.execute_sql(
+        "SELECT 1 FROM sqlite_master WHERE name = 'cal_event_span'"
+    ).fetchone()
+    if exists:
+        return True
+
+    try:
+        with DB.atomic():
+            DB.execute_sql(SPAN_SCHEMA)
+            DB.execute_sql(
+                'INSERT INTO cal_event_span SELECT id, start_ts, end_ts '
+                'FROM {}'.format(CalEvent._meta.table_name))
+    except peewee.OperationalError:
+        return False
 
+    return True
 
-def events(url=None, start=None, end=None, encoding=DEFAULT_ENCODING):
+
+def refresh_feed(cal, url, encoding=DEFAULT_ENCODING):
     '''
-    Get all events form the given iCal URL occurring in the given time range.
+    Make a conditional request for an iCal feed and, if it has changed since
+    we last fetched it, replace the cached events for the calendar.
     '''
     if url.startswith('webcal://'):
         url = url.replace('webcal://', 'http://', 1)
 
-    resp = requests.get(url)
+    feed = CalFeed.get_or_none(CalFeed.calendar == cal)
+    headers = {}
+    if feed is not None and feed.url == url:
+        if feed.etag:
+            headers['If-None-Match'] = feed.etag
+        if feed.last_modified:
+            headers['If-Modified-Since'] = feed.last_modified
+
+    resp = http_request('GET', url, headers=headers)
+
+    if resp.status_code == 304:
+        return
 
     if not resp.ok:
         raise ConnectionError(
             'Unable to fetch data from {}'.format(url)
         )
 
-    content = resp.content.decode(encoding)
-    content = content.replace('\r', '')
-
-    # Fix Apple tzdata bug.
-    content = content.replace('TZOFFSETFROM:+5328', 'TZOFFSETFROM:+0053')
-
-    return parse_events(content, start=start, end=end)
-
-
-def parse_events(content, start=None, end=None):
+    # Not every server supports conditional requests so we also skip parsing
+    # if the content is unchanged.
+    digest = hashlib.sha1(resp.content).hexdigest()
+    unchanged = feed is not None and feed.digest == digest
+
+    has_index = init_span_index()
+    table = CalEvent._meta.table_name
+
+    with DB.atomic():
+        if not unchanged:
+            content = resp.content.decode(encoding)
+            content = content.replace('\r', '')
+
+            # Fix Apple tzdata bug.
+            content = content.replace(
+                'TZOFFSETFROM:+5328', 'TZOFFSETFROM:+0053')
+
+            rows = [dict(row, calendar=cal) for row in parse_events(content)]
+            if has_index:
+                DB.execute_sql(
+                    'DELETE FROM cal_event_span WHERE id IN '
+                    '(SELECT id FROM {} WHERE calendar = ?)'.format(table),
+                    (cal,))
+
+            CalEvent.delete().where(CalEvent.calendar == cal).execute()
+            for i in range(0, len(rows), INSERT_BATCH_SIZE):
+                CalEvent.insert_many(rows[i:i + INSERT_BATCH_SIZE]).execute()
+
+            if has_index:
+                DB.execute_sql(
+                    'INSERT INTO cal_event_span SELECT id, start_ts, end_ts '
+                    'FROM {} WHERE calendar = ?'.format(table), (cal,))
+
+        CalFeed.insert(
+            calendar=cal,
+            url=url,
+            etag=resp.headers.get('ETag'),
+            last_modified=resp.headers.get('Last-Modified'),
+            digest=digest
+        ).on_conflict_replace().execute()
+
+
+def cached_events(calendars, start=None, end=None):
     '''
-    Fetch all events in the given time range.
+    Fetch all cached events for the given calendars in the given time range
+    as {calendar: [events]}, using the interval index if we have one.
     '''
     if start is None:
         start = utc.localize(datetime.utcnow())
@@ -129,26 +299,268 @@ def parse_events(content, start=None, end=None):
     if end is None:
         end = start + DEFAULT_QUERY_LENGTH
 
-    start, end = map(normalize, [start, end])
+    start, end = (int(normalize(d).timestamp()) for d in [start, end])
+
+    if init_span_index():
+        # CROSS JOIN makes SQLite drive the query from the R*Tree rather
+        # than scanning every event in the calendars.
+        query = CalEvent.raw(
+            'SELECT e.* FROM cal_event_span AS s CROSS JOIN {} AS e '
+            'ON e.id = s.id '
+            'WHERE s.start_ts <= ? AND s.end_ts >= ? '
+            'AND e.start_ts <= ? AND e.end_ts >= ? '
+            'AND e.calendar IN ({}) '
+            'ORDER BY e.start_ts'.format(
+                CalEvent._meta.table_name, ', '.join('?' * len(calendars))),
+            end, start, end, start, *calendars
+        )
+    else:
+        query = CalEvent.select().where(
+            CalEvent.calendar.in_(calendars) &
+            (CalEvent.start_ts <= end) &
+            (CalEvent.end_ts >= start)
+        ).order_by(CalEvent.start_ts)
+
+    digests = {f.calendar: f.digest for f in CalFeed.select()}
+    window = [datetime.fromtimestamp(ts, utc) for ts in (start, end)]
+    found = defaultdict(list)
+
+    for row in query:
+        if not row.recurring:
+            found[row.calendar].append(Event.from_row(row))
+            continue
+
+        digest = digests.get(row.calendar)
+        for occ_start, occ_end in occurrences(row, digest, *window):
+            found[row.calendar].append(Event(
+                start=occ_start,
+                end=occ_end,
+                summary=row.summary,
+                description=row.description,
+                all_day=row.all_day,
+                freq=row.freq or 'RDATE'
+            ))
+
+    return {cal: sorted(events) for cal, events in found.items()}
+
+
+def occurrences(row, digest, start, end):
+    '''
+    Lazily yield the (start, end) of each occurrence of a recurring event
+    that overlaps the given time range. The series is only expanded as far
+    as the end of the range.
+    '''
+    key = (row.calendar, row.id)
+    cached = _RULESETS.get(key)
+    if cached is None or cached[0] != digest:
+        cached = _RULESETS[key] = (digest, _ruleset(row))
+
+    duration = timedelta(seconds=row.duration)
+    for occ in cached[1].xafter(start - duration, inc=True):
+        if occ > end:
+            break
+        yield occ, occ + duration
+
+
+def _ruleset(row):
+    '''
+    Build the (caching) dateutil rruleset for a cached recurring event.
+    '''
+    zone = tz.gettz(row.tzid) if row.tzid else None
+    if zone is None:
+        zone = tz.tzoffset(None, row.utc_offset)
+
+    def local(ts):
+        return datetime.fromtimestamp(ts, zone)
+
+    dtstart = local(row.start_ts)
+    rules = rruleset(cache=True)
+
+    if row.rrule is not None:
+        rules.rrule(rrulestr(row.rrule, dtstart=dtstart))
+
+    # DTSTART is always the first occurrence, even if it doesn't match RRULE
+    rules.rdate(dtstart)
+    for ts in json.loads(row.rdates or '[]'):
+        rules.rdate(local(ts))
+    for ts in json.loads(row.exdates or '[]'):
+        rules.exdate(local(ts))
+
+    return rules
+
+
+def parse_events(content):
+    '''
+    Parse each event in an iCal feed into the fields that we cache.
+
+    Modified or cancelled instances of a recurring event (those with a
+    RECURRENCE-ID) are excluded from the expansion of the series and the
+    modified ones are cached as events in their own right.
+    '''
     calendar = Calendar.from_ical(content)
     found = []
+    overridden = defaultdict(list)
 
     for component in calendar.walk():
-        if component.name == "VEVENT":
-            e_start = normalize(component.get('dtstart').dt)
-            e_end = component.get('dtend')
-            if e_end is not None:
-                e_end = normalize(e_end.dt)
-            else:
-                e_end = e_start+timedelta(days=1)
+        if component.name != 'VEVENT' or component.get('dtstart') is None:
+            continue
+
+        row = _event_row(component)
+        recurrence_id = component.get('recurrence-id')
+
+        if recurrence_id is not None:
+            overridden[row['uid']].append(_timestamp(recurrence_id.dt))
+            if str(component.get('status', '')).upper() == 'CANCELLED':
+                continue
+
+        found.append(row)
+
+    for row in found:
+        if row['rrule'] is None and row['rdates'] is None:
+            continue
+
+        exdates = row.pop('_exdates') + overridden.get(row['uid'], [])
+        if exdates:
+            row['exdates'] = json.dumps(sorted(set(exdates)))
+
+        row['end_ts'] = _series_end(row, row.pop('_bounded'))
+
+    for row in found:
+        row.pop('_exdates', None)
+        row.pop('_bounded', None)
+
+    return found
+
+
+def _event_row(component):
+    '''
+    The CalEvent fields for a single VEVENT.
+    '''
+    raw_start = component.get('dtstart').dt
+    all_day = type(raw_start) is date
+    event_start = normalize(raw_start)
+
+    event_end = component.get('dtend')
+    duration = component.get('duration')
+    if event_end is not None:
+        event_end = normalize(event_end.dt)
+    elif duration is not None:
+        event_end = event_start + duration.dt
+    else:
+        # This is a single day all day event
+        event_end = event_start + timedelta(days=1)
+        all_day = True
+
+    description = component.get('description')
+    row = {
+        'uid': None if component.get('uid') is None
+        else str(component.get('uid')),
+        'start_ts': _timestamp(event_start),
+        'end_ts': _timestamp(event_end),
+        'duration': int((event_end - event_start).total_seconds()),
+        'all_day': all_day,
+        'summary': str(component.get('summary')),
+        'description': None if description is None else str(description),
+        'freq': None,
+        'rrule': None,
+        'rdates': None,
+        'exdates': None,
+        'tzid': _tz_name(event_start.tzinfo),
+        'utc_offset': int(event_start.utcoffset().total_seconds()),
+        '_exdates': [],
+        '_bounded': True,
+    }
+
+    rule = component.get('rrule')
+    if isinstance(rule, list):
+        # Multiple RRULEs are deprecated by rfc5545: we only use the first
+        rule = rule[0]
+
+    if rule:
+        row['freq'] = str(rule.get('FREQ')[0])
+        row['rrule'] = _rrule_text(rule, event_start.tzinfo)
+        row['_bounded'] = 'UNTIL' in rule or 'COUNT' in rule
+
+    rdates = _date_list(component.get('rdate'))
+    if rdates:
+        row['rdates'] = json.dumps(rdates)
+
+    row['_exdates'] = _date_list(component.get('exdate'))
+
+    return row
+
+
+def _rrule_text(rule, tzinfo):
+    '''
+    Serialise an RRULE for rrulestr. dateutil needs UNTIL in UTC when the
+    series has a timezone, whereas rfc5545 also allows a local time or a date
+    (meaning the end of that day).
+    '''
+    rule = vRecur(rule)
+    until = rule.get('UNTIL')
+
+    if until:
+        until = until[0]
+        if not isinstance(until, datetime):
+            until = datetime.combine(until, time.max)
+        if until.tzinfo is None:
+            until = until.replace(tzinfo=tzinfo)
+        rule['UNTIL'] = [until.astimezone(utc).replace(microsecond=0)]
+
+    return rule.to_ical().decode()
+
+
+def _date_list(prop):
+    '''
+    The UTC timestamps from an RDATE or EXDATE property, which may be given
+    multiple times, each with a list of dates.
+    '''
+    if prop is None:
+        return []
+
+    if not isinstance(prop, list):
+        prop = [prop]
 
-            if e_start <= end and e_end >= start:
-                # Event is in range so keep it
-                evt = Event(component)
-                found.append(evt)
+    timestamps = []
+    for dates in prop:
+        for value in dates.dts:
+            dt = value.dt
+            if isinstance(dt, tuple):
+                # RDATE;VALUE=PERIOD gives (start, end or duration)
+                dt = dt[0]
+            timestamps.append(_timestamp(normalize(dt)))
 
-    # Sort into ascending order
-    return sorted(found)
+    return timestamps
+
+
+def _series_end(row, bounded):
+    '''
+    The end of the last occurrence of a recurring event, if it has one.
+    '''
+    if not bounded:
+        return FOREVER
+
+    occurrences = list(_ruleset(CalEvent(**row)))
+    last = max(occurrences) if occurrences else datetime.fromtimestamp(
+        row['start_ts'], utc)
+
+    return _timestamp(last) + row['duration']
+
+
+def _tz_name(tzinfo):
+    '''
+    The IANA name of a timezone (None if we can't tell what it is).
+    '''
+    for attr in ('key', 'zone'):
+        name = getattr(tzinfo, attr, None)
+        if isinstance(name, str) and tz.gettz(name) is not None:
+            return name
+
+    return None
+
+
+def _timestamp(dt):
+    return int(normalize(dt).timestamp())
 
 
 def normalize(dt):
@@ -168,44 +580,33 @@ def normalize(dt):
 class Event:
     '''A single calendar event'''
 
-    def __init__(self, component):
+    def __init__(self, start, end, summary, description=None, all_day=False,
+                 freq=None):
         '''
-        Create a new event occurrence from an iCal component.
+        Create a new event occurrence.
         '''
-        self.all_day = False
-
-        event_start = component.get('dtstart')
-        if event_start is None:
-            raise ValueError('Event must have a start date')
-
-        if type(event_start.dt) is date:
-            self.all_day = True
-
-        event_start = normalize(event_start.dt)
-
-        event_end = component.get('dtend')
-        if event_end is not None:
-            event_end = normalize(event_end.dt)
-        else:
-            # This is a single day all day event
-            event_end = event_start + timedelta(days=1)
-            self.all_day = True
-
-        if component.get('rrule'):
-            rule = component.get('rrule')
-            freq = str(rule.get('FREQ')[0])
-            recurring = True
-        else:
-            recurring = False
-            freq = None
-
-        self.start = event_start
-        self.end = event_end
-        self.summary = str(component.get('summary'))
-        self.description = str(component.get('description'))
-        self.recurring = recurring
+        self.start = start
+        self.end = end
+        self.summary = summary
+        self.description = description
+        self.all_day = all_day
+        self.recurring = freq is not None
         self.freq = freq
 
+    @classmethod
+    def from_row(cls, row):
+        '''
+        Create an event from a cached CalEvent.
+        '''
+        return cls(
+            start=datetime.fromtimestamp(row.start_ts, utc),
+            end=datetime.fromtimestamp(row.end_ts, utc),
+            summary=row.summary,
+            description=row.description,
+            all_day=row.all_day,
+            freq=row.freq
+        )
+
     def __lt__(self, other):
         '''
         Sort by start time
@@ -240,6 +641,8 @@ class Event:
         if self.recurring:
             recur = ': recurring [{}]'.format(self.freq)
 
-        start = self.start.strftime('%Y-%m-%d (%H:%M)')
+        # Times are shown in local time, dates as they are
+        start = self.start if self.all_day else self.start.astimezone()
+        start = start.strftime('%Y-%m-%d (%H:%M)')
 
         return '{}: {} ({}{})'.format(start, self.summary, msg, recur)
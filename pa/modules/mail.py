@@ -9,33 +9,156 @@ queries may optionally use boolean AND/OR clauses if needed.
 
 pa mail uses the 'keyring' module for storing your passwords in an OS keychain.
 
+Queries are answered from a local cache of the headers and the start of the
+body of the newest messages in each inbox. The cache is brought up to date
+(fetching only messages that have arrived since the last run) when it is more
+than `cache_ttl` seconds old and cached results are still shown if the server
+can't be reached. Use `--remote` to search the full text of every message on
+the server instead.
+
+`pa mail watch` keeps a connection open to each account and prints a summary
+of each new message as it arrives (using IMAP IDLE rather than polling).
+
 Usage:
   pa mail list
   pa mail setpass <account>
-  pa mail <query> [--full] [--max=<n>] [--account=<name>]
-  pa mail [options] [--full] [--max=<n>] [--account=<name>]
+  pa mail watch [--account=<name>]
+  pa mail <query> [--full] [--max=<n>] [--account=<name>] [--remote]
+  pa mail [options] [--full] [--max=<n>] [--account=<name>] [--remote]
   pa mail (-h | --help)
 
 Options:
   -f, --from <query>    Query the 'from' field (does not need to be a
                         full email address)
-  -b, --before <date>   Messages before a given date in yyy-mm-dd format.
-  -a, --after <date>    Messages after a given date in yyy-mm-dd format.
-  -o, --on <date>       Messages on a given date in yyy-mm-dd format.
+  -b, --before <date>   Messages before a given date in yyyy-mm-dd format.
+  -a, --after <date>    Messages after a given date in yyyy-mm-dd format.
+  -o, --on <date>       Messages on a given date in yyyy-mm-dd format.
   -n, --new             All recent messages that have not been seen yet.
+  -r, --remote          Run the query on the server rather than against the
+                        local cache.
 '''
+import re
+import sys
+import time
+import atexit
+import select
+import ssl
+import threading
 import email
+import email.utils
+from email import policy
+from email.parser import BytesHeaderParser
+import quopri
+import base64
+import binascii
 import getpass
 import imaplib
+from collections import defaultdict, namedtuple
+from contextlib import contextmanager
+from datetime import datetime
+from html.parser import HTMLParser
 
 import keyring
+import peewee
 
-from ..utils import get_config, print_red, print_yellow, print_green
+from ..db import DB, PaModel
+from ..utils import get_config, iter_many_tagged, print_red, print_yellow, \
+    print_green
 
 
 SUMMARY = 'Quick querying of your email via IMAP'
+# `pa mail watch` runs until interrupted so must not be run by `pa daemon`
+LONG_RUNNING = ['watch']
 MSG_SUMMARY_LEN = 400
 KEYRING_NAMESPACE = 'pa-mail'
+# Messages are fetched in batches of this many UIDs per FETCH command
+FETCH_BATCH_SIZE = 50
+# Bytes of the (possibly base64 or quoted-printable encoded) text part to
+# fetch for a summary: enough for MSG_SUMMARY_LEN characters once decoded.
+PARTIAL_FETCH_LEN = MSG_SUMMARY_LEN * 3
+HEADER_FIELDS = 'MESSAGE-ID TO CC BCC FROM DATE SUBJECT'
+# The folder that we cache and query
+DEFAULT_FOLDER = 'INBOX'
+# Pooled connections that have been idle for longer than this many seconds
+# are sent a NOOP to keep them alive and to check that they are still usable.
+KEEPALIVE_INTERVAL = 60
+# rfc2177 asks clients to re-issue IDLE at least every 29 minutes
+IDLE_TIMEOUT = 29 * 60
+# Seconds to wait before reconnecting a dropped `pa mail watch` connection
+RECONNECT_DELAY = 30
+# Search keys that take a date and the month names IMAP expects for them
+DATE_KEYS = ('BEFORE', 'SINCE', 'ON')
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+          'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+# The part of a message (from its BODYSTRUCTURE) that we use as its body
+TextPart = namedtuple(
+    'TextPart', ['section', 'subtype', 'encoding', 'charset'])
+# A search from the command line: an IMAP search key and its argument
+Search = namedtuple('Search', ['key', 'query', 'full', 'count'])
+
+# Idle, logged in MailBox clients by username. Connections are returned here
+# after each query so that `pa daemon` can re-use them between commands.
+_POOL = defaultdict(list)
+_POOL_LOCK = threading.Lock()
+_KEEPALIVE = None
+# Output from concurrent `pa mail watch` threads
+_PRINT_LOCK = threading.Lock()
+
+
+class MailFolder(PaModel):
+    '''
+    The sync state of a cached IMAP folder. UIDs are only meaningful for a
+    given UIDVALIDITY so if that changes then the cache for the folder is
+    thrown away and rebuilt.
+    '''
+    account = peewee.CharField()
+    folder = peewee.CharField()
+    uidvalidity = peewee.IntegerField()
+    last_uid = peewee.IntegerField(default=0)
+    highest_modseq = peewee.IntegerField(null=True)
+    synced = peewee.FloatField(default=0)
+
+    class Meta:
+        indexes = ((('account', 'folder'), True),)
+
+
+class MailMessage(PaModel):
+    '''
+    The headers and the start of the body of a cached message.
+    '''
+    account = peewee.CharField()
+    folder = peewee.CharField()
+    uid = peewee.IntegerField()
+    message_id = peewee.CharField(null=True)
+    sender = peewee.CharField(null=True)
+    to = peewee.TextField(null=True)
+    cc = peewee.TextField(null=True)
+    bcc = peewee.TextField(null=True)
+    date = peewee.CharField(null=True)
+    day = peewee.DateField(null=True, index=True)
+    subject = peewee.TextField(null=True)
+    snippet = peewee.TextField(default='')
+    seen = peewee.BooleanField(default=False)
+
+    class Meta:
+        indexes = ((('account', 'folder', 'uid'), True),)
+
+    def to_json(self):
+        '''
+        The same payload that json_message builds for a fetched message.
+        '''
+        headers = {
+            'Message-ID': self.message_id,
+            'To': self.to,
+            'Cc': self.cc,
+            'Bcc': self.bcc,
+            'From': self.sender,
+            'Date': self.date,
+            'Subject': self.subject,
+        }
+
+        return json_message(headers, self.snippet)
 
 
 def run(args):
@@ -43,7 +166,7 @@ def run(args):
     Entry point for the cli application.
     '''
     config = get_config()
-    accounts = config['mail']['accounts']
+    accounts = config.mail.accounts
     full = args['--full']
     count = args['--max']
     count = int(count) if count else count
@@ -61,8 +184,17 @@ def run(args):
     try:
         method, query = get_imap_key(args)
     except ValueError:
-        print(__doc__)
-        exit()
+        if not args['watch']:
+            print(__doc__)
+            exit()
+        method, query = None, None
+
+    if method in DATE_KEYS:
+        try:
+            query = parse_date(query)
+        except ValueError:
+            print_red('Dates should be given in yyyy-mm-dd format')
+            exit()
 
     account = args['--account']
 
@@ -74,53 +206,386 @@ def run(args):
             show_accounts(accounts)
             exit()
 
-        process_account(account, details, method, query, full, count)
-    else:
-        # Otherwise run for all configured accounts
-        for account, details in accounts.items():
-            process_account(account, details, method, query, full, count)
+        accounts = {account: details}
+
+    if args['watch']:
+        watch(accounts, config.mail)
+        exit()
+
+    search = Search(method, query, full, count)
+    remote = args['--remote']
+    MailFolder.create_table(safe=True)
+    MailMessage.create_table(safe=True)
+
+    # Any password prompts need to happen before we start querying
+    tag_args = [
+        (account, (details, get_password(account), search, remote,
+                   config.mail))
+        for account, details in accounts.items()
+    ]
+
+    # Accounts are queried concurrently and shown as soon as they finish
+    for account, results, error in iter_many_tagged(query_account, tag_args):
+        print_green('[{}]'.format(account))
+
+        if error is not None:
+            print_red('Error querying mailbox:')
+            print(error)
+            print()
+            continue
+
+        messages, warning = results
+        if warning is not None:
+            print_yellow(warning)
 
+        print_messages(messages)
 
-def process_account(account, details, method, query, full, count):
+
+def print_messages(messages):
+    '''
+    Print out a list of JSON messages.
+    '''
+    for json_msg in messages:
+        for section, content in json_msg.items():
+            end = ':\n' if section == 'body' else ': '
+            print_yellow(section, end=end)
+            print(content)
+
+        # Separator
+        print('\n', '-' * 80, '\n')
+
+
+def watch(accounts, settings):
     '''
-    Run the selected query for a given account
+    Print summaries of new messages as they arrive in each account until we
+    are interrupted.
+    '''
+    if not accounts:
+        print_yellow('No mail accounts are configured')
+        exit()
+
+    MailFolder.create_table(safe=True)
+    MailMessage.create_table(safe=True)
+
+    threads = [
+        threading.Thread(
+            target=watch_account,
+            args=(account, details, get_password(account), settings),
+            daemon=True
+        )
+        for account, details in accounts.items()
+    ]
+
+    for thread in threads:
+        thread.start()
+
+    print_green('Watching {} for new mail (ctrl-c to stop)'.format(
+        ', '.join(accounts)))
+
+    try:
+        while any(thread.is_alive() for thread in threads):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+
+
+def watch_account(account, details, password, settings):
+    '''
+    Hold a dedicated connection to an account in IDLE, syncing the local
+    cache and printing any new messages whenever the server tells us that the
+    inbox has changed. Dropped connections are re-opened.
+    '''
+    m = None
+    announce = False
+
+    while True:
+        try:
+            if m is None:
+                m = MailBox(
+                    username=details['username'],
+                    password=password,
+                    server=details['server']
+                )
+                if 'IDLE' not in m.client.capabilities:
+                    with _PRINT_LOCK:
+                        print_red('[{}] server does not support IDLE'.format(
+                            account))
+                    return
+
+            new = m.sync_folder(DEFAULT_FOLDER, settings.initial_sync)
+            if announce and new:
+                show_new_messages(account, details['username'], new)
+
+            # Only messages arriving after we start watching are shown
+            announce = True
+            while not m.idle(IDLE_TIMEOUT):
+                pass
+
+        except imaplib.IMAP4.abort as e:
+            reason = _error_text(e)
+        except OSError as e:
+            reason = str(e)
+        except imaplib.IMAP4.error as e:
+            with _PRINT_LOCK:
+                print_red('[{}] {}'.format(account, _error_text(e)))
+            return
+        else:
+            continue
+
+        with _PRINT_LOCK:
+            print_yellow('[{}] connection lost ({}), reconnecting in {}s'
+                         .format(account, reason, RECONNECT_DELAY))
+
+        if m is not None:
+            m.logout()
+            m = None
+        time.sleep(RECONNECT_DELAY)
+
+
+def show_new_messages(account, username, uids):
+    '''
+    Print the cached summaries of newly arrived messages.
+    '''
+    messages = MailMessage.select().where(
+        (MailMessage.account == username) &
+        (MailMessage.folder == DEFAULT_FOLDER) &
+        (MailMessage.uid.in_(uids))
+    ).order_by(MailMessage.uid)
+
+    with _PRINT_LOCK:
+        print_green('[{}]'.format(account))
+        print_messages([msg.to_json() for msg in messages])
+        sys.stdout.flush()
+
+
+def get_password(account):
+    '''
+    Look up the password for an account in the keyring, prompting for it if
+    it has not been stored.
     '''
-    print_green('[{}]'.format(account))
     password = keyring.get_password(KEYRING_NAMESPACE, account)
+
     if password is None:
         print_yellow(
             '>>> Run "pa setpass {}" to store in the keychain'.format(account)
         )
-        print_yellow('\nPlease enter your password:')
-        password = getpass.getpass(),
+        print_yellow('\nPlease enter your password for {}:'.format(account))
+        password = getpass.getpass()
+
+    return password
+
+
+def query_account(details, password, search, remote, settings):
+    '''
+    Run the selected query for a given account, returning the list of
+    matching messages and a warning to show if the local cache could not be
+    brought up to date.
+    '''
+    if remote:
+        query = search.query
+        if search.key in DATE_KEYS:
+            query = imap_date(query)
+
+        def remote_query(m):
+            messages = m._query(
+                search.key, (query,), full=search.full, count=search.count)
+            return list(messages)
+
+        return with_mailbox(details, password, remote_query), None
+
+    account = details['username']
+    state = MailFolder.get_or_none(
+        (MailFolder.account == account) &
+        (MailFolder.folder == DEFAULT_FOLDER)
+    )
+    warning = None
+
+    if state is None or time.time() - state.synced > settings.cache_ttl:
+        try:
+            with_mailbox(
+                details, password,
+                lambda m: m.sync_folder(DEFAULT_FOLDER, settings.initial_sync)
+            )
+        except (imaplib.IMAP4.error, OSError) as e:
+            if state is None:
+                raise
+            warning = 'Unable to refresh, showing cached messages: {}'.format(
+                _error_text(e))
+
+    cached = search_cache(account, search, DEFAULT_FOLDER)
+
+    if not search.full:
+        return [msg.to_json() for msg in cached], warning
+
+    # Only the start of each body is cached
+    def fetch_full(m):
+        m.client.select(DEFAULT_FOLDER)
+        return list(m._fetch_full([msg.uid for msg in cached]))
+
+    return with_mailbox(details, password, fetch_full), warning
+
+
+def with_mailbox(details, password, func):
+    '''
+    Call `func` with a logged in MailBox for an account. If a pooled
+    connection turns out to have been dropped by the server then we retry
+    once with a fresh connection.
+    '''
+    while True:
+        reused = False
+        try:
+            with mailbox(details, password) as (m, reused):
+                return func(m)
+        except (imaplib.IMAP4.abort, OSError):
+            if not reused:
+                raise
+
+
+@contextmanager
+def mailbox(details, password):
+    '''
+    Check out a logged in MailBox for an account from the pool (opening a new
+    connection if there isn't a usable one) along with whether or not it was
+    re-used. The connection is returned to the pool afterwards unless it
+    failed, in which case it is closed.
+    '''
+    username = details['username']
+    m = _checkout(username)
+    reused = m is not None
+
+    if m is None:
+        try:
+            m = MailBox(
+                username=username,
+                password=password,
+                server=details['server']
+            )
+        except imaplib.IMAP4.abort:
+            raise
+        except imaplib.IMAP4.error as e:
+            raise imaplib.IMAP4.error('Unable to log in: {}'.format(
+                _error_text(e)))
 
     try:
-        m = MailBox(
-            username=details['username'],
-            password=password,
-            server=details['server']
+        yield m, reused
+    except BaseException:
+        # We don't know what state the connection was left in
+        m.logout()
+        raise
+
+    _checkin(m)
+
+
+def _checkout(username):
+    '''
+    Take a usable connection for a user out of the pool, if there is one.
+    '''
+    while True:
+        with _POOL_LOCK:
+            if not _POOL[username]:
+                return None
+            m = _POOL[username].pop()
+
+        if time.time() - m.last_used < KEEPALIVE_INTERVAL or m.is_alive():
+            return m
+
+        m.logout()
+
+
+def _checkin(m):
+    '''
+    Return a connection to the pool and make sure that the keepalive thread
+    is running.
+    '''
+    global _KEEPALIVE
+
+    m.last_used = time.time()
+    with _POOL_LOCK:
+        _POOL[m.username].append(m)
+
+        if _KEEPALIVE is None:
+            _KEEPALIVE = threading.Thread(target=_keepalive, daemon=True)
+            _KEEPALIVE.start()
+            atexit.register(_close_pool)
+
+
+def _keepalive():
+    '''
+    Periodically NOOP idle pooled connections so that the server doesn't
+    drop them, discarding any that have stopped responding.
+    '''
+    while True:
+        time.sleep(KEEPALIVE_INTERVAL)
+        cutoff = time.time() - KEEPALIVE_INTERVAL
+
+        with _POOL_LOCK:
+            stale = [m for conns in _POOL.values() for m in conns
+                     if m.last_used < cutoff]
+            for m in stale:
+                _POOL[m.username].remove(m)
+
+        for m in stale:
+            if m.is_alive():
+                _checkin(m)
+            else:
+                m.logout()
+
+
+def _close_pool():
+    '''
+    LOGOUT of every pooled connection.
+    '''
+    with _POOL_LOCK:
+        conns = [m for conns in _POOL.values() for m in conns]
+        _POOL.clear()
+
+    for m in conns:
+        m.logout()
+
+
+def search_cache(account, search, folder=DEFAULT_FOLDER):
+    '''
+    Run a search against the cached messages for an account, newest first.
+    TEXT searches only look at the headers and the start of the body that
+    we have cached.
+    '''
+    query = MailMessage.select().where(
+        (MailMessage.account == account) &
+        (MailMessage.folder == folder)
+    )
+    key, text = search.key, search.query
+
+    if key == 'FROM':
+        query = query.where(MailMessage.sender.contains(text))
+    elif key == 'BEFORE':
+        query = query.where(MailMessage.day < text)
+    elif key == 'SINCE':
+        query = query.where(MailMessage.day >= text)
+    elif key == 'ON':
+        query = query.where(MailMessage.day == text)
+    elif key == 'NEW':
+        query = query.where(MailMessage.seen == False)  # noqa: E712
+    else:
+        query = query.where(
+            MailMessage.subject.contains(text) |
+            MailMessage.sender.contains(text) |
+            MailMessage.to.contains(text) |
+            MailMessage.cc.contains(text) |
+            MailMessage.snippet.contains(text)
         )
-    except Exception as e:
-        print_red('ERROR: {}'.format(e.args[0].decode()))
-        exit()
 
-    try:
-        results = m._query(method, (query,), full=full)
-        for i, json_msg in enumerate(results):
-            if i == count:
-                break
+    query = query.order_by(MailMessage.uid.desc())
+    if search.count is not None:
+        query = query.limit(search.count)
 
-            for section, content in json_msg.items():
-                end = ':\n' if section == 'body' else ': '
-                print_yellow(section, end=end)
-                print(content)
+    return list(query)
 
-            # Separator
-            print('\n', '-' * 80, '\n')
 
-    except Exception as e:
-        print_red('Error querying mailbox:')
-        print(e)
+def _error_text(e):
+    '''imaplib errors carry the server response as bytes'''
+    if e.args and isinstance(e.args[0], bytes):
+        return e.args[0].decode(errors='replace')
+    return str(e)
 
 
 class MailBox:
@@ -135,12 +600,214 @@ class MailBox:
         self.username = username
         self.client = imaplib.IMAP4_SSL(server)
         self.client.login(username, password)
+        self._enable_condstore()
         # Select the default folder
         self.client.select()
+        self.last_used = time.time()
+
+    def _enable_condstore(self):
+        '''
+        Ask the server to report HIGHESTMODSEQ when we SELECT a folder so that
+        flag refreshes can use CHANGEDSINCE (rfc7162). Servers often only
+        advertise CONDSTORE once we have logged in so we ask again.
+        '''
+        try:
+            typ, data = self.client.capability()
+            if typ == 'OK' and data and data[-1]:
+                self.client.capabilities = tuple(
+                    data[-1].decode().upper().split())
+
+            caps = self.client.capabilities
+            if 'CONDSTORE' in caps and 'ENABLE' in caps:
+                self.client.enable('CONDSTORE')
+        except imaplib.IMAP4.error:
+            # We just won't be able to use CHANGEDSINCE
+            pass
+
+    def logout(self):
+        '''
+        Log out and close the connection, ignoring any errors as we are done
+        with it either way.
+        '''
+        try:
+            self.client.logout()
+        except (imaplib.IMAP4.error, OSError):
+            pass
+
+    def idle(self, timeout=IDLE_TIMEOUT):
+        '''
+        Wait in IDLE (rfc2177) for the server to tell us about a change to the
+        selected folder, returning the untagged responses that we got. This
+        will be empty if `timeout` seconds passed without any changes.
+
+        imaplib has no support for IDLE so we drive the protocol ourselves.
+        '''
+        client = self.client
+        tag = client._new_tag()
+        client.send(tag + b' IDLE\r\n')
+
+        line = client.readline()
+        while line.startswith(b'* '):
+            # Responses to earlier commands can arrive before the go ahead
+            line = client.readline()
+
+        if not line.startswith(b'+'):
+            raise imaplib.IMAP4.error(line.decode(errors='replace').strip())
+
+        responses = []
+        sock = client.sock
+        if _readable(client) or select.select([sock], [], [], timeout)[0]:
+            responses.append(client.readline())
+
+        client.send(b'DONE\r\n')
+        while True:
+            line = client.readline()
+            if not line:
+                raise imaplib.IMAP4.abort('socket error: EOF')
+            if line.startswith(tag):
+                break
+            responses.append(line)
+
+        client.tagged_commands.pop(tag, None)
+        if line.split()[1:2] != [b'OK']:
+            raise imaplib.IMAP4.error(line.decode(errors='replace').strip())
+
+        self.last_used = time.time()
+        return [r for r in responses if r.startswith(b'* ')]
+
+    def is_alive(self):
+        '''
+        Check that the connection to the server is still usable.
+        '''
+        try:
+            typ, _ = self.client.noop()
+            return typ == 'OK'
+        except (imaplib.IMAP4.error, OSError):
+            return False
+
+    def select(self, folder=DEFAULT_FOLDER):
+        '''
+        Select a folder, returning its UIDVALIDITY and HIGHESTMODSEQ (None if
+        the server doesn't support CONDSTORE).
+        '''
+        typ, data = self.client.select(folder)
+        if typ != 'OK':
+            raise imaplib.IMAP4.error(data[0] if data else folder)
+
+        return (_response_code(self.client, 'UIDVALIDITY'),
+                _response_code(self.client, 'HIGHESTMODSEQ'))
+
+    def sync_folder(self, folder=DEFAULT_FOLDER, depth=500):
+        '''
+        Bring the local cache of a folder up to date, returning the UIDs of any
+        new messages. Only messages with a UID above the last one that we have
+        seen are fetched (at most `depth` of them the first time a folder is
+        synced) and the flags of cached messages are refreshed, using
+        CHANGEDSINCE if the server supports CONDSTORE.
+        '''
+        uidvalidity, modseq = self.select(folder)
+        state = MailFolder.get_or_none(
+            (MailFolder.account == self.username) &
+            (MailFolder.folder == folder)
+        )
+
+        if state is None or state.uidvalidity != uidvalidity:
+            # Any cached UIDs may now refer to different messages
+            MailMessage.delete().where(
+                (MailMessage.account == self.username) &
+                (MailMessage.folder == folder)
+            ).execute()
+            last_uid, cached_modseq = 0, None
+        else:
+            last_uid, cached_modseq = state.last_uid, state.highest_modseq
+            self._refresh_flags(folder, cached_modseq, modseq)
+
+        # "n:*" always matches the highest UID in the folder, even if it is
+        # below n, so we need to filter the results ourselves.
+        _, data = self.client.uid('SEARCH', 'UID', '{}:*'.format(last_uid + 1))
+        uids = sorted(u for u in (int(u) for u in data[0].split())
+                      if u > last_uid)
+
+        if last_uid == 0:
+            uids = uids[-depth:] if depth else []
+
+        for i in range(0, len(uids), FETCH_BATCH_SIZE):
+            batch = uids[i:i + FETCH_BATCH_SIZE]
+            rows = [
+                _cache_row(self.username, folder, uid, headers, body, flags)
+                for uid, headers, body, flags in self._summaries(batch)
+            ]
+            if rows:
+                with DB.atomic():
+                    MailMessage.insert_many(rows).on_conflict_replace() \
+                        .execute()
+
+        MailFolder.insert(
+            account=self.username,
+            folder=folder,
+            uidvalidity=uidvalidity,
+            last_uid=max(uids, default=last_uid),
+            highest_modseq=modseq,
+            synced=time.time()
+        ).on_conflict_replace().execute()
+
+        return uids
+
+    def _refresh_flags(self, folder, cached_modseq, modseq):
+        '''
+        Update the seen flag of cached messages and drop any that have been
+        expunged from the server.
+        '''
+        where = ((MailMessage.account == self.username) &
+                 (MailMessage.folder == folder))
+        cached = {m.uid for m in MailMessage.select(MailMessage.uid)
+                  .where(where)}
+        if not cached:
+            return
+
+        # Only the messages that we have cached: not the whole folder
+        message_set = _message_set(cached)
+
+        if modseq is not None and cached_modseq is not None:
+            if modseq == cached_modseq:
+                # Nothing in the folder has changed
+                return
+
+            changed = self._fetch(
+                message_set, '(UID FLAGS)',
+                '(CHANGEDSINCE {})'.format(cached_modseq))
+            _, data = self.client.uid('SEARCH', 'UID', message_set)
+            on_server = {int(u) for u in data[0].split()}
+        else:
+            changed = self._fetch(message_set, '(UID FLAGS)')
+            on_server = set(changed)
+
+        expunged = list(cached - on_server)
+        seen = [uid for uid, msg in changed.items()
+                if uid in cached and '\\Seen' in (msg.get('FLAGS') or [])]
+        unseen = [uid for uid in changed if uid in cached
+                  and uid not in seen]
 
-    def _query(self, key, args=(), folder=None, full=False):
+        with DB.atomic():
+            for uids, query in [
+                    (expunged, MailMessage.delete()),
+                    (seen, MailMessage.update(seen=True)),
+                    (unseen, MailMessage.update(seen=False))]:
+                # Keep below SQLite's limit on the number of host parameters
+                for i in range(0, len(uids), 500):
+                    query.where(
+                        where & MailMessage.uid.in_(uids[i:i + 500])
+                    ).execute()
+
+    def _query(self, key, args=(), folder=None, full=False, count=None):
         '''
-        Run an rfc3501 SEARCH query and iterate over the messages returned
+        Run an rfc3501 SEARCH query and iterate over the messages returned,
+        newest first. If `count` is given then only the newest `count`
+        messages are fetched.
+
+        Messages are fetched FETCH_BATCH_SIZE at a time and, unless `full` is
+        set, only the headers we display and the start of the text part of
+        each message are downloaded.
 
         See section 6.4.4 of the rfc for details on query syntax:
             http://www.faqs.org/rfcs/rfc3501.html
@@ -155,12 +822,92 @@ class MailBox:
         if folder is not None:
             self.client.select(folder)
 
-        _, data = self.client.search(None, key, *args)
+        _, data = self.client.uid('SEARCH', key, *args)
+        uids = sorted((int(u) for u in data[0].split()), reverse=True)
+
+        if count is not None:
+            uids = uids[:count]
+
+        for i in range(0, len(uids), FETCH_BATCH_SIZE):
+            batch = uids[i:i + FETCH_BATCH_SIZE]
+            if full:
+                yield from self._fetch_full(batch)
+            else:
+                yield from self._fetch_summaries(batch)
+
+    def _fetch(self, uids, items, *modifiers):
+        '''
+        UID FETCH the given items for a list of UIDs (or a message set string),
+        returning {uid: items}.
+        '''
+        if not isinstance(uids, str):
+            uids = _message_set(uids)
+
+        _, data = self.client.uid('FETCH', uids, items, *modifiers)
+        return {
+            int(msg['UID']): msg for msg in _parse_fetch(data)
+            if 'UID' in msg
+        }
+
+    def _fetch_full(self, uids):
+        '''
+        Fetch and yield complete messages.
+        '''
+        fetched = self._fetch(uids, '(UID BODY.PEEK[])')
+
+        for uid in uids:
+            raw = _fetched_item(fetched.get(uid, {}), 'BODY[]')
+            if raw is not None:
+                yield json_message(parse_headers(raw), get_body(raw, True))
+
+    def _fetch_summaries(self, uids):
+        '''
+        Fetch and yield message summaries.
+        '''
+        for _, headers, body, _ in self._summaries(uids):
+            yield json_message(headers, body)
+
+    def _summaries(self, uids):
+        '''
+        Fetch and yield (uid, headers, body, flags) for each message. The
+        headers, flags and BODYSTRUCTURE of every message come back in one
+        round trip and then the start of the text part of each message is
+        fetched in one round trip per distinct part (body section) that is
+        needed.
+        '''
+        fetched = self._fetch(
+            uids,
+            '(UID FLAGS BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS ({})])'.format(
+                HEADER_FIELDS)
+        )
+
+        parts = {}
+        by_section = defaultdict(list)
+        for uid, msg in fetched.items():
+            part = _find_text_part(msg.get('BODYSTRUCTURE'))
+            if part is not None:
+                parts[uid] = part
+                by_section[part.section].append(uid)
 
-        for num in data[0].split():
-            typ, data = self.client.fetch(num, '(RFC822)')
-            msg = email.message_from_string(data[0][1].decode('utf-8'))
-            yield json_message(msg, full)
+        bodies = {}
+        for section, section_uids in by_section.items():
+            items = '(UID BODY.PEEK[{}]<0.{}>)'.format(
+                section, PARTIAL_FETCH_LEN)
+            partial = self._fetch(section_uids, items)
+            for uid, msg in partial.items():
+                bodies[uid] = _fetched_item(msg, 'BODY[{}]'.format(section))
+
+        for uid in uids:
+            msg = fetched.get(uid)
+            if msg is None:
+                continue
+
+            headers = parse_headers(_fetched_item(msg, 'BODY[HEADER') or b'')
+            body = ''
+            if bodies.get(uid) is not None:
+                body = _decode_part(bodies[uid], parts[uid])
+
+            yield uid, headers, body[:MSG_SUMMARY_LEN], msg.get('FLAGS') or []
 
 
 def get_imap_key(args):
@@ -185,6 +932,27 @@ def get_imap_key(args):
     return 'TEXT', args['<query>']
 
 
+def parse_date(text):
+    '''
+    Parse a date given on the command line. IMAP's own dd-Mon-yyyy format is
+    accepted as well as yyyy-mm-dd.
+    '''
+    for fmt in ('%Y-%m-%d', '%d-%b-%Y'):
+        try:
+            return datetime.strptime(text, fmt).date()
+        except ValueError:
+            pass
+
+    raise ValueError('Invalid date: {}'.format(text))
+
+
+def imap_date(day):
+    '''
+    Format a date for an IMAP search (which doesn't depend on the locale).
+    '''
+    return '{}-{}-{}'.format(day.day, MONTHS[day.month - 1], day.year)
+
+
 def show_accounts(accounts):
     '''
     Print out the configured account names and usernames
@@ -194,55 +962,443 @@ def show_accounts(accounts):
         print('  {}: {}'.format(account, details['username']))
 
 
-def get_body(msg, full=False):
+def get_body(raw, full=False):
     '''
-    Extract the body from a message, optionally returning the full message
+    Extract the body from a raw message, optionally returning the full body
     but by default returning a summary of length MSG_SUMMARY_LEN.
+
+    Rather than parsing the whole message, we walk the MIME structure looking
+    only at the headers of each part and stop at the first text/plain part
+    that isn't an attachment (falling back to the first text/html part). Only
+    the selected part is decoded, and only as much of it as is needed for a
+    summary, so large attachments cost us nothing beyond a scan for the next
+    MIME boundary.
     '''
-    if msg.is_multipart():
-        for part in msg.walk():
-            ctype = part.get_content_type()
-            disp = str(part.get('Content-Disposition'))
+    html = None
 
-            # skip any text/plain (txt) attachments
-            if ctype == 'text/plain' and 'attachment' not in disp:
-                body = part.get_payload(decode=True)
-                break
+    for headers, start, end in _mime_parts(raw):
+        if headers.get_content_maintype() != 'text' or \
+                headers.get_content_disposition() == 'attachment':
+            continue
+
+        subtype = headers.get_content_subtype()
+        if subtype == 'plain':
+            break
+        elif subtype == 'html' and html is None:
+            html = (headers, start, end)
     else:
-        # not multipart - i.e. plain text, no attachments (hopefully!)
-        body = msg.get_payload(decode=True)
+        if html is None:
+            return ''
+        headers, start, end = html
 
-    try:
-        body = body.decode()
-    except UnicodeDecodeError:
-        pass
+    if not full:
+        # Markup takes up most of an HTML part so we need more of it
+        scale = 8 if headers.get_content_subtype() == 'html' else 1
+        end = min(end, start + PARTIAL_FETCH_LEN * scale)
+
+    part = TextPart(
+        None,
+        headers.get_content_subtype(),
+        headers.get('Content-Transfer-Encoding'),
+        headers.get_content_charset() or 'utf-8'
+    )
+    body = _decode_part(raw[start:end], part)
+
+    return body if full else body[:MSG_SUMMARY_LEN]
 
-    if full:
-        return body
-    else:
-        return body[:MSG_SUMMARY_LEN]
+
+def parse_headers(raw):
+    '''
+    Parse just the header block of a raw message (or message part). Encoded
+    (rfc2047) header values are decoded for us by the default policy.
+    '''
+    header_end, _ = _split_headers(raw, 0, len(raw))
+    return _HEADER_PARSER.parsebytes(raw[:header_end])
 
 
-def json_message(msg, full=False):
+def json_message(headers, body):
     '''
-    Convert a message to a JSON payload (python dict) of the fields that
-    we care about.
+    Convert the headers and body of a message to a JSON payload (python dict)
+    of the fields that we care about.
     '''
-    cc = msg.get('Cc')
+    cc = headers.get('Cc')
     if cc is not None:
         cc = [c.strip() for c in cc.split(',')]
 
-    bcc = msg.get('Bcc')
+    bcc = headers.get('Bcc')
     if bcc is not None:
         bcc = [b.strip() for b in bcc.split(',')]
 
     return {
-        'id': msg.get('Message-ID'),
-        'to': msg.get('To'),
+        'id': headers.get('Message-ID'),
+        'to': headers.get('To'),
         'cc': cc,
         'bcc': bcc,
-        'from': msg.get('From'),
-        'date': msg.get('Date'),
-        'subject': msg.get('Subject'),
-        'body': get_body(msg, full)
+        'from': headers.get('From'),
+        'date': headers.get('Date'),
+        'subject': headers.get('Subject'),
+        'body': body
     }
+
+
+def html_to_text(html):
+    '''
+    Crude conversion of an HTML body to plain text for summaries.
+    '''
+    class _Text(HTMLParser):
+        def __init__(self):
+            super().__init__()
+            self.chunks = []
+            self.skip = 0
+
+        def handle_starttag(self, tag, attrs):
+            if tag in ('script', 'style'):
+                self.skip += 1
+            elif tag in ('br', 'p', 'div', 'tr', 'li'):
+                self.chunks.append('\n')
+
+        def handle_endtag(self, tag):
+            if tag in ('script', 'style') and self.skip:
+                self.skip -= 1
+
+        def handle_data(self, data):
+            if not self.skip:
+                self.chunks.append(data)
+
+    parser = _Text()
+    parser.feed(html)
+    parser.close()
+    text = ''.join(parser.chunks)
+
+    return re.sub(r'\n\s*\n+', '\n\n', re.sub(r'[ \t]+', ' ', text)).strip()
+
+
+# Scanning of raw messages for get_body. Parts are located by searching for
+# MIME boundaries in the raw bytes and only their headers are ever parsed.
+_HEADER_PARSER = BytesHeaderParser(policy=policy.default)
+_BLANK_LINE = re.compile(rb'\r?\n\r?\n')
+# Guard against pathologically nested multiparts
+MAX_MIME_DEPTH = 10
+
+
+def _split_headers(raw, start, end):
+    '''
+    Find the end of the header block of the entity in raw[start:end] and the
+    start of its body.
+    '''
+    if raw.startswith((b'\r\n', b'\n'), start):
+        # No headers at all
+        return start, raw.index(b'\n', start) + 1
+
+    match = _BLANK_LINE.search(raw, start, end)
+    if match is None:
+        return end, end
+
+    return match.start(), match.end()
+
+
+def _mime_parts(raw, start=0, end=None, depth=0):
+    '''
+    Yield (headers, body_start, body_end) for each leaf part of the MIME
+    entity in raw[start:end], in order.
+    '''
+    end = len(raw) if end is None else end
+    header_end, body_start = _split_headers(raw, start, end)
+    headers = _HEADER_PARSER.parsebytes(raw[start:header_end])
+    boundary = headers.get_boundary()
+
+    if headers.get_content_maintype() != 'multipart' or boundary is None \
+            or depth >= MAX_MIME_DEPTH:
+        yield headers, body_start, end
+        return
+
+    delimiter = re.compile(
+        rb'^--' + re.escape(boundary.encode('ascii', errors='replace')) +
+        rb'(--)?[ \t]*\r?$\n?',
+        re.MULTILINE
+    )
+
+    part_start = None
+    for match in delimiter.finditer(raw, body_start, end):
+        if part_start is not None:
+            # The line break before a delimiter belongs to the delimiter
+            part_end = match.start()
+            if raw.startswith(b'\r\n', part_end - 2):
+                part_end -= 2
+            elif raw.startswith(b'\n', part_end - 1):
+                part_end -= 1
+
+            yield from _mime_parts(raw, part_start, part_end, depth + 1)
+
+        if match.group(1):
+            # Closing delimiter
+            return
+
+        part_start = match.end()
+
+    if part_start is not None:
+        # Truncated message with no closing delimiter
+        yield from _mime_parts(raw, part_start, end, depth + 1)
+
+
+def _cache_row(account, folder, uid, headers, body, flags):
+    '''
+    Build the MailMessage row for a fetched message summary.
+    '''
+    def header(name):
+        value = headers.get(name)
+        return None if value is None else str(value)
+
+    return {
+        'account': account,
+        'folder': folder,
+        'uid': uid,
+        'message_id': header('Message-ID'),
+        'sender': header('From'),
+        'to': header('To'),
+        'cc': header('Cc'),
+        'bcc': header('Bcc'),
+        'date': header('Date'),
+        'day': _message_day(header('Date')),
+        'subject': header('Subject'),
+        'snippet': body,
+        'seen': '\\Seen' in flags,
+    }
+
+
+def _message_day(date_header):
+    '''
+    The date that a message was sent on (in the sender's timezone).
+    '''
+    if not date_header:
+        return None
+
+    try:
+        return email.utils.parsedate_to_datetime(date_header).date()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def _response_code(client, code):
+    '''
+    Pull the value of a response code (e.g. "[UIDVALIDITY 3857529045]") from
+    the last command out of imaplib's untagged responses.
+    '''
+    _, data = client.response(code)
+    if not data or data[-1] is None:
+        return None
+
+    try:
+        return int(data[-1])
+    except ValueError:
+        return None
+
+
+def _readable(client):
+    '''
+    Check if there is anything to read from a client without waiting on the
+    socket: imaplib's reader may have buffered the next response along with
+    the last line it read (and TLS may have decrypted it) where select can't
+    see it. The socket is made non-blocking so that peek never waits.
+    '''
+    sock = client.sock
+    timeout = sock.gettimeout()
+    sock.settimeout(0)
+    try:
+        return bool(client.file.peek(1))
+    except (BlockingIOError, ssl.SSLWantReadError):
+        return False
+    finally:
+        sock.settimeout(timeout)
+
+
+def _message_set(uids):
+    '''
+    Build a compact IMAP message set (e.g. "1:5,8,10:12") from a list of UIDs.
+    '''
+    ranges = []
+
+    for uid in sorted(uids):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+
+    return ','.join(
+        str(a) if a == b else '{}:{}'.format(a, b) for a, b in ranges
+    )
+
+
+def _fetched_item(msg, prefix):
+    '''
+    Look up a FETCH data item by prefix. Servers are free to echo the item
+    names back slightly differently (e.g. "BODY[1]<0>" for a partial fetch).
+    '''
+    for key, value in msg.items():
+        if key.upper().startswith(prefix):
+            return value
+
+    return None
+
+
+def _find_text_part(bodystructure):
+    '''
+    Find the first text/plain part of a message that is not an attachment,
+    falling back to the first text/html part.
+    '''
+    if not isinstance(bodystructure, list):
+        return None
+
+    html = None
+    for section, part in _walk_parts(bodystructure):
+        ctype = [str(p).lower() if p else '' for p in part[:2]]
+        if ctype[0] != 'text' or _is_attachment(part):
+            continue
+
+        params = part[2] if isinstance(part[2], list) else []
+        params = dict(zip(params[::2], params[1::2]))
+        charset = {k.lower(): v for k, v in params.items()}.get('charset')
+        found = TextPart(section, ctype[1], part[5], charset or 'utf-8')
+
+        if ctype[1] == 'plain':
+            return found
+        elif ctype[1] == 'html' and html is None:
+            html = found
+
+    return html
+
+
+def _walk_parts(bodystructure, section=''):
+    '''
+    Yield (section, part) for each leaf of a parsed BODYSTRUCTURE. The body of
+    a single part message is section TEXT.
+    '''
+    if not isinstance(bodystructure[0], list):
+        yield section or 'TEXT', bodystructure
+        return
+
+    for n, child in enumerate(bodystructure, 1):
+        if not isinstance(child, list):
+            # The multipart subtype and extension data follow the parts
+            break
+        child_section = '{}.{}'.format(section, n) if section else str(n)
+        yield from _walk_parts(child, child_section)
+
+
+def _is_attachment(part):
+    '''
+    Check the extension data of a BODYSTRUCTURE part for an attachment
+    disposition.
+    '''
+    for field in part[7:]:
+        if isinstance(field, list) and field and \
+                str(field[0]).lower() == 'attachment':
+            return True
+
+    return False
+
+
+def _decode_part(raw, part):
+    '''
+    Decode the (possibly truncated) raw content of a message part.
+    '''
+    encoding = str(part.encoding or '7bit').lower()
+
+    if encoding == 'base64':
+        compact = b''.join(raw.split())
+        compact = compact[:len(compact) - len(compact) % 4]
+        try:
+            raw = base64.b64decode(compact)
+        except binascii.Error:
+            pass
+    elif encoding == 'quoted-printable':
+        # Drop any escape sequence that was cut off by the partial fetch
+        raw = quopri.decodestring(re.sub(rb'=[0-9A-Fa-f]?$', b'', raw))
+
+    try:
+        text = raw.decode(part.charset, errors='replace')
+    except LookupError:
+        text = raw.decode('utf-8', errors='replace')
+
+    if part.subtype == 'html':
+        text = html_to_text(text)
+
+    return text
+
+
+# Parsing of FETCH responses. imaplib hands us a list of byte strings and
+# (text, literal) tuples which we turn into a token stream and then into a
+# list of {item: value} dicts, one per message.
+_LPAREN, _RPAREN = object(), object()
+
+
+def _parse_fetch(data):
+    '''
+    Parse the data from a FETCH response. Literals become bytes, NIL becomes
+    None, parenthesised lists become lists and everything else is a str.
+    '''
+    tokens = []
+    for item in data:
+        if isinstance(item, tuple):
+            tokens.extend(_tokenize(item[0]))
+            tokens.append(item[1])
+        elif item is not None:
+            tokens.extend(_tokenize(item))
+
+    messages = []
+    pos = 0
+
+    def parse_list():
+        nonlocal pos
+        values = []
+        pos += 1
+        while pos < len(tokens) and tokens[pos] is not _RPAREN:
+            if tokens[pos] is _LPAREN:
+                values.append(parse_list())
+            else:
+                values.append(tokens[pos])
+                pos += 1
+        pos += 1
+        return values
+
+    while pos < len(tokens):
+        # Each message is "<seq> (<item> <value> ...)"
+        if tokens[pos] is _LPAREN:
+            items = parse_list()
+            messages.append({
+                str(k).upper(): v for k, v in zip(items[::2], items[1::2])
+            })
+        else:
+            pos += 1
+
+    return messages
+
+
+_TOKEN = re.compile(rb'''
+    (?P<lparen>\() | (?P<rparen>\)) |
+    "(?P<quoted>(?:[^"\\]|\\.)*)" |
+    (?P<atom>(?:[^\s()\[\]"]+|\[[^\]]*\])+)
+''', re.VERBOSE)
+
+
+def _tokenize(text):
+    '''
+    Split a chunk of FETCH response text into tokens, dropping any trailing
+    literal marker ("{123}") as the literal itself follows separately.
+    '''
+    text = re.sub(rb'\{\d+\}$', b'', text)
+    tokens = []
+
+    for match in _TOKEN.finditer(text):
+        if match.group('lparen'):
+            tokens.append(_LPAREN)
+        elif match.group('rparen'):
+            tokens.append(_RPAREN)
+        elif match.group('quoted') is not None:
+            value = re.sub(rb'\\(.)', rb'\1', match.group('quoted'))
+            tokens.append(value.decode('utf-8', errors='replace'))
+        else:
+            atom = match.group('atom').decode('utf-8', errors='replace')
+            tokens.append(None if atom.upper() == 'NIL' else atom)
+
+    return tokens
@@ -7,19 +7,74 @@ Usage:
   pa note (-h | --help)
 
 Options:
-  -g <pattern>, --grep <pattern>    Grep your notes
+  -g <pattern>, --grep <pattern>    Grep your notes for a regular expression
+  -f <query>, --find <query>        Search the full text index of your notes
+  -t <tag>, --tag <tag>             Only show --find results from notes with
+                                    the given tag
   -l, --list                        List the contents of your notes directory
   -s, --sync                        Sync the local notes to the remote git repo
+
+The --find option uses a full text index of your notes that is kept up to date
+each time you search. Queries match whole words and support "exact phrases",
+prefix* matches and AND/OR/NOT. If the index isn't available
+(note.index_enabled is off or SQLite was built without FTS5) the query is
+grepped for instead.
 '''
 import os
 import re
+import mmap
+import hashlib
 import subprocess
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from fnmatch import fnmatch
+from functools import lru_cache
+from itertools import repeat
+
+import peewee
 
-from ..utils import today, get_config, TEMPLATE, GREEN, NC
+from ..db import DB, PaModel
+from ..utils import today, get_config, print_red, print_yellow, TEMPLATE, \
+    GREEN, NC
 
 
 SUMMARY = 'Create and manage markdown note files'
+# todo's sync rolls over and updates the daily TODO files that we push
+SYNC_AFTER = ['todo']
+NOTE_DIRS = ['daily-notes', 'notes']
+TAGS_PREFIX = '### Tags ::'
+# Below this many files it isn't worth starting a process pool for _grep
+GREP_POOL_THRESHOLD = 64
+
+# Each line of each note is a row in the index so that we can report line
+# numbers for matches.
+FTS_SCHEMA = '''\
+CREATE VIRTUAL TABLE IF NOT EXISTS note_fts USING fts5(
+    line,
+    file_id UNINDEXED,
+    lno UNINDEXED,
+    prefix='2 3'
+)'''
+
+
+class NoteFile(PaModel):
+    '''
+    A note file that has been added to the full text search index along with
+    what we need to know to tell if it has changed since.
+    '''
+    path = peewee.CharField(unique=True)
+    mtime = peewee.IntegerField()
+    size = peewee.IntegerField()
+    digest = peewee.CharField()
+    tags = peewee.TextField(default='')
+
+    @property
+    def tag_set(self):
+        return {t for t in self.tags.split(',') if t}
+
+
+class IndexUnavailable(Exception):
+    '''The SQLite build we are using does not support FTS5'''
 
 
 def run(args):
@@ -32,6 +87,8 @@ def run(args):
         list_notes(config)
     elif args['--grep']:
         grep_notes(config, args['--grep'])
+    elif args['--find']:
+        find_notes(config, args['--find'], tag=args['--tag'])
     elif args['--sync']:
         sync(config)
     else:
@@ -48,7 +105,7 @@ def list_notes(config):
     '''
     Show the contents of the notes directory
     '''
-    os.chdir(config['note']['note_root'])
+    os.chdir(config.note.path('note_root'))
     print('{} Current notes: {}'.format(GREEN, NC))
     subprocess.run(['ls', 'notes'])
 
@@ -56,30 +113,58 @@ def list_notes(config):
 def grep_notes(config, pattern):
     '''
     Grep through the notes and daily_notes for a given pattern.
-    If `ag` is enabled then prefer that over searching in python
+    If `ag` is enabled then prefer that over searching in python.
     '''
-    use_ag = config['general']['ag_enabled']
-    note_root = config['note']['note_root']
+    use_ag = config.general.ag_enabled
+    note_root = config.note.path('note_root')
 
     for subdir in ['/daily-notes', '/notes']:
         if use_ag:
             os.chdir(note_root + subdir)
             subprocess.run(['ag', pattern])
-        else:
-            _grep(note_root + subdir, pattern)
+            continue
+
+        try:
+            _grep(note_root + subdir, pattern, root=note_root)
+        except re.error as e:
+            print_red('Invalid pattern: {}'.format(e))
+            exit(42)
+
+
+def find_notes(config, query, tag=None):
+    '''
+    Search the full text index of the notes, falling back to grepping for
+    the query when the index isn't available.
+    '''
+    note_root = config.note.path('note_root')
+
+    if config.note.index_enabled:
+        try:
+            update_index(note_root)
+            print_search_results(search_index(query, tag=tag))
+            return
+        except IndexUnavailable:
+            pass
+        except peewee.OperationalError as e:
+            print_red('Invalid search query: {}'.format(e))
+            exit(42)
+
+    print_yellow('The search index is not available: grepping instead')
+    grep_notes(config, query)
 
 
 def sync(config):
     '''
     Push the local note content to the remote git repo
     '''
-    os.chdir(config['note']['note_root'])
+    # Syncs run concurrently so we mustn't change directory
+    note_root = config.note.path('note_root')
     print('{}Pushing notes to remote repo...{}'.format(GREEN, NC))
-    subprocess.run('git add -A', shell=True)
+    subprocess.run(['git', 'add', '-A'], cwd=note_root)
     subprocess.run(
-        'git commit -m"Updating notes: {}"'.format(today()),
-        shell=True)
-    subprocess.run('git push', shell=True)
+        ['git', 'commit', '-m', 'Updating notes: {}'.format(today())],
+        cwd=note_root)
+    subprocess.run(['git', 'push'], cwd=note_root, check=True)
 
 
 def create_or_open_note(config, title):
@@ -90,7 +175,7 @@ def create_or_open_note(config, title):
     y, m, d = today.year, today.month, today.day
     date = '{}/{}/{}'.format(y, m, d)
 
-    root = config['note']['note_root']
+    root = config.note.path('note_root')
 
     # Make sure we have a notes directory
     note_dir = os.path.join(root, 'notes')
@@ -102,7 +187,7 @@ def create_or_open_note(config, title):
     else:
         note_file = '{}/notes/{}.md'.format(root, title)
 
-    editor = config['general']['editor']
+    editor = config.general.editor
 
     if not os.path.exists(note_file):
         with open(note_file, 'w') as f:
@@ -111,23 +196,306 @@ def create_or_open_note(config, title):
     subprocess.run([editor, note_file])
 
 
-def _grep(base_directory, pattern):
+def _grep(base_directory, pattern, root=None, max_workers=None):
+    '''
+    `grep` for a regex in all files in a directory.
+
+    Files are searched in parallel across a process pool and results are
+    printed in path order. Hidden files and directories, binary files and
+    anything matched by a .gitignore (in the directory or its parents up to
+    `root`) are skipped.
+    '''
+    # Fail early on a bad pattern rather than in each worker
+    _compile(pattern)
+    paths = sorted(_grep_files(base_directory, root or base_directory))
+
+    if len(paths) < GREP_POOL_THRESHOLD:
+        results = (_grep_file(path, pattern) for path in paths)
+        _print_grep_results(paths, results)
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as ex:
+            results = ex.map(
+                _grep_file, paths, repeat(pattern), chunksize=16)
+            _print_grep_results(paths, results)
+
+
+def _print_grep_results(paths, results):
+    '''
+    Print the matches for each file as they become available.
+    '''
+    for path, hits in zip(paths, results):
+        if hits:
+            print('\n[{}]'.format(path))
+            for lno, line in hits:
+                print('{}: {}'.format(lno, line))
+
+
+@lru_cache(maxsize=8)
+def _compile(pattern):
+    return re.compile(pattern.encode(), re.MULTILINE)
+
+
+def _grep_file(path, pattern):
     '''
-    `grep` for a pattern in all files in a directory
+    Search a single file for a pattern, returning [(lno, line)] for each line
+    that contains a match. The file is mmapped and searched as a single
+    buffer: line numbers are only calculated for lines that match.
     '''
-    pattern = re.compile(pattern)
+    regex = _compile(pattern)
+    hits = []
+
+    try:
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return hits
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                if b'\0' in buf[:8192]:
+                    # Binary file
+                    return hits
+
+                # There is no line after a trailing newline, even though a
+                # pattern that matches the empty string matches there
+                last = len(buf) - 1 if buf[-1:] == b'\n' else len(buf)
+
+                lno, counted_to, pos = 1, 0, 0
+                while True:
+                    match = regex.search(buf, pos)
+                    if match is None or match.start() > last:
+                        break
+
+                    start = buf.rfind(b'\n', 0, match.start()) + 1
+                    end = buf.find(b'\n', match.start())
+                    if end == -1:
+                        end = len(buf)
+
+                    # mmap has no count() but each byte is only copied once
+                    lno += buf[counted_to:start].count(b'\n')
+                    counted_to = start
+                    line = buf[start:end].decode('utf-8', errors='replace')
+                    hits.append((lno, line.strip()))
+
+                    # Only report each line once
+                    pos = end + 1
+                    if pos > last:
+                        break
+    except (OSError, ValueError):
+        # Unreadable, or changed size underneath us
+        pass
+
+    return hits
+
+
+def _grep_files(base_directory, root):
+    '''
+    Walk a directory, skipping hidden and gitignored files and directories.
+    '''
+    ignored = _gitignore_patterns(base_directory, root)
+
+    for base_path, dirs, fnames in os.walk(base_directory):
+        ignored += _read_gitignore(base_path)
+        dirs[:] = [
+            d for d in dirs
+            if not d.startswith('.')
+            and not _is_ignored(os.path.join(base_path, d), True, ignored)
+        ]
 
-    for base_path, _, fnames in os.walk(base_directory):
         for fname in fnames:
-            has_matches = False
             path = os.path.join(base_path, fname)
+            if not fname.startswith('.') and \
+                    not _is_ignored(path, False, ignored):
+                yield path
+
+
+def _gitignore_patterns(directory, root):
+    '''
+    Collect the .gitignore patterns that apply to a directory from its
+    parents, stopping at the root of the git repo or at `root` (the notes
+    root) if we get there first.
+    '''
+    patterns = []
+    directory = os.path.abspath(directory)
+    root = os.path.abspath(root)
+
+    while not os.path.exists(os.path.join(directory, '.git')):
+        parent = os.path.dirname(directory)
+        if directory == root or parent == directory:
+            break
+        directory = parent
+        patterns += _read_gitignore(directory)
+
+    return patterns
+
 
-            with open(path, 'r') as f:
-                for lno, line in enumerate(f):
-                    if pattern.search(line):
-                        if not has_matches:
-                            # Print header
-                            print('\n[{}]'.format(path))
-                            has_matches = True
+def _read_gitignore(directory):
+    '''
+    Read the patterns from a .gitignore file as (directory, pattern) pairs.
+    Only the common subset of gitignore syntax is supported: comments, globs,
+    anchored paths and trailing slashes for directories. Negations are
+    ignored.
+    '''
+    try:
+        with open(os.path.join(directory, '.gitignore'), 'r') as f:
+            lines = [line.strip() for line in f]
+    except (OSError, UnicodeDecodeError):
+        return []
+
+    return [
+        (directory, line) for line in lines
+        if line and not line.startswith(('#', '!'))
+    ]
+
+
+def _is_ignored(path, is_dir, patterns):
+    '''
+    Check a path against a list of (directory, pattern) gitignore patterns.
+    '''
+    for directory, pattern in patterns:
+        if not path.startswith(directory + os.sep):
+            continue
+
+        if pattern.endswith('/'):
+            if not is_dir:
+                continue
+            pattern = pattern.rstrip('/')
+
+        if '/' in pattern:
+            rel = os.path.relpath(path, directory)
+            if fnmatch(rel, pattern.lstrip('/')):
+                return True
+        elif fnmatch(os.path.basename(path), pattern):
+            return True
+
+    return False
+
+
+def update_index(note_root):
+    '''
+    Bring the full text index up to date with the files under the note root.
+    Only files whose mtime or size have changed are read and only those whose
+    content hash has also changed are re-indexed.
+    '''
+    try:
+        DB.execute_sql(FTS_SCHEMA)
+    except peewee.OperationalError as e:
+        raise IndexUnavailable(str(e))
+
+    NoteFile.create_table(safe=True)
+    known = {n.path: n for n in NoteFile.select()}
+    seen = set()
+
+    with DB.atomic():
+        for path in _note_files(note_root):
+            seen.add(path)
+            stat = os.stat(path)
+            note = known.get(path)
+
+            if (note is not None and note.mtime == stat.st_mtime_ns
+                    and note.size == stat.st_size):
+                continue
+
+            with open(path, 'rb') as f:
+                data = f.read()
+
+            digest = hashlib.sha1(data).hexdigest()
+            unchanged = note is not None and note.digest == digest
+
+            if note is None:
+                note = NoteFile(path=path)
+
+            note.mtime, note.size = stat.st_mtime_ns, stat.st_size
+            if unchanged:
+                # Touched but not edited
+                note.save()
+                continue
+
+            lines = _index_lines(data)
+            note.digest = digest
+            note.tags = ','.join(_parse_tags(lines))
+            note.save()
+
+            DB.execute_sql(
+                'DELETE FROM note_fts WHERE file_id = ?', (note.id,))
+            DB.connection().executemany(
+                'INSERT INTO note_fts (line, file_id, lno) VALUES (?, ?, ?)',
+                ((line, note.id, lno) for lno, line in enumerate(lines, 1)
+                 if line.strip())
+            )
+
+        for path in set(known) - seen:
+            note = known[path]
+            DB.execute_sql(
+                'DELETE FROM note_fts WHERE file_id = ?', (note.id,))
+            note.delete_instance()
+
+
+def search_index(query, tag=None):
+    '''
+    Run an FTS5 query against the index, returning [(path, [(lno, line)])]
+    with the best matching files first and matches in line order within each
+    file.
+    '''
+    notes = {n.id: n for n in NoteFile.select()}
+    cursor = DB.execute_sql(
+        'SELECT file_id, lno, line FROM note_fts '
+        'WHERE note_fts MATCH ? ORDER BY rank',
+        (query,)
+    )
+
+    results = {}
+    for file_id, lno, line in cursor:
+        note = notes.get(file_id)
+        if note is None or (tag is not None and tag not in note.tag_set):
+            continue
+
+        # dicts preserve insertion order so files stay in rank order
+        results.setdefault(note.path, []).append((lno, line))
+
+    return [(path, sorted(hits)) for path, hits in results.items()]
+
+
+def print_search_results(results):
+    '''
+    Display search results in the same format as _grep.
+    '''
+    for path, hits in results:
+        print('\n[{}]'.format(path))
+        for lno, line in hits:
+            print('{}: {}'.format(lno, line.strip()))
+
+
+def _note_files(note_root):
+    '''
+    All of the (non-hidden, non-binary) files in the note directories.
+    '''
+    for subdir in NOTE_DIRS:
+        note_dir = os.path.join(note_root, subdir)
+        for base_path, dirs, fnames in os.walk(note_dir):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+
+            for fname in fnames:
+                if not fname.startswith('.'):
+                    yield os.path.join(base_path, fname)
+
+
+def _index_lines(data):
+    '''
+    Split raw file content into lines for the index. Binary files are treated
+    as being empty.
+    '''
+    if b'\0' in data[:8192]:
+        return []
+
+    return data.decode('utf-8', errors='replace').splitlines()
+
+
+def _parse_tags(lines):
+    '''
+    Pull the tags out of the TEMPLATE header of a note.
+    '''
+    for line in lines[:10]:
+        if line.startswith(TAGS_PREFIX):
+            tags = line[len(TAGS_PREFIX):].replace(',', ' ').split()
+            return sorted(set(tags))
 
-                        print('{}: {}'.format(lno+1, line.strip()))
+    return []
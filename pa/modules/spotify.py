@@ -2,7 +2,14 @@
 pa spotify - Control the Linux Spotify desktop app from the commandline
 
 For this to work you need to have the Spotify application open already
-as all this script does is send dbus commands to the running process.
+as all this script does is send dbus commands to the running process. The
+dbus connection is kept open for the life of the process so commands run
+through `pa daemon` (media key bindings for example) are near instant.
+
+`pa spotify watch` prints the current track each time that it changes (for
+status bars) and keeps it in ~/.config/pa/spotify.json. While a watcher is
+running `pa spotify current` reads the track from there rather than asking
+Spotify. Watching needs PyGObject for the GLib main loop.
 
 Adding a new playlist:
   - Playlist names are stored in config and map to Spotify URIs
@@ -18,15 +25,41 @@ Usage:
   pa spotify next
   pa spotify prev
   pa spotify current
+  pa spotify watch
   pa spotify list
   pa spotify (-h | --help)
 '''
+import os
+import json
+
 import dbus
-from subprocess import Popen, PIPE
-from ..utils import get_config, print_red, print_yellow, print_green
+from ..utils import get_config, atomic_write, print_red, print_yellow, \
+    print_green, CONFIG_ROOT
 
 
 SUMMARY = 'control the Linux Spotify desktop app'
+# `pa spotify watch` runs until interrupted so must not be run by `pa daemon`
+LONG_RUNNING = ['watch']
+
+BUS_NAME = 'org.mpris.MediaPlayer2.spotify'
+OBJECT_PATH = '/org/mpris/MediaPlayer2'
+PLAYER_IFACE = 'org.mpris.MediaPlayer2.Player'
+PROPERTIES_IFACE = 'org.freedesktop.DBus.Properties'
+
+# Written by `pa spotify watch` whenever the track or playback status changes
+STATE_PATH = os.path.join(CONFIG_ROOT, 'spotify.json')
+
+# Errors that mean Spotify isn't running or has been restarted since we
+# last spoke to it (so the proxy is bound to a process that has gone away).
+GONE_ERRORS = {
+    'org.freedesktop.DBus.Error.ServiceUnknown',
+    'org.freedesktop.DBus.Error.NameHasNoOwner',
+    'org.freedesktop.DBus.Error.NoReply',
+    'org.freedesktop.DBus.Error.Disconnected',
+}
+
+# Proxy for the Spotify player object, reused between commands
+_PLAYER = None
 
 
 def run(args):
@@ -49,10 +82,10 @@ def run(args):
 
     elif args['<playlist>']:
         key = args['<playlist>']
-        uri = config['spotify'].get(key)
+        uri = config.spotify.get(key)
 
         if uri is None:
-            keys = '\n  '.join(config['spotify'].keys())
+            keys = '\n  '.join(config.spotify.keys())
             print_red(f'"ERROR: {key}" is not a known playlist')
             print_yellow(f'Available playlists are:\n  {keys}')
             exit(42)
@@ -62,43 +95,58 @@ def run(args):
     elif args['current']:
         current_song()
 
+    elif args['watch']:
+        watch()
+
     elif args['list']:
-        keys = '\n  '.join(config['spotify'].keys())
+        keys = '\n  '.join(config.spotify.keys())
         print_yellow(f'Available playlists are:\n  {keys}')
 
 
-def _cmd(action, arg=''):
-    '''Send a command via dbus.'''
-    base_cmd = 'qdbus org.mpris.MediaPlayer2.spotify /org/mpris/MediaPlayer2'
-    # ' org.mpris.MediaPlayer2.Player.OpenUri'
-    # ' spotify:track:1WNPappMd13lY5o9POZ4gU3'
-    cmd = ' '.join([base_cmd, action, arg])
-    Popen(cmd, shell=True, stdout=PIPE)
+def _player():
+    '''The (cached) proxy for the Spotify player object'''
+    global _PLAYER
+
+    if _PLAYER is None:
+        _PLAYER = dbus.SessionBus().get_object(
+            BUS_NAME, OBJECT_PATH, introspect=False)
+
+    return _PLAYER
+
+
+def _call(interface, method, *args):
+    '''
+    Call an MPRIS method on Spotify, connecting again (once) if Spotify has
+    been restarted since we last used the connection.
+    '''
+    global _PLAYER
+
+    for _ in range(2):
+        try:
+            return _player().get_dbus_method(method, interface)(*args)
+        except dbus.exceptions.DBusException as e:
+            _PLAYER = None
+            if e.get_dbus_name() not in GONE_ERRORS:
+                print_red(f'Spotify returned an error for {method}: {e}')
+                exit(42)
+
+    print_red('Unable to connect to Spotify. Is it running?')
+    exit(42)
 
 
 def player_action(action):
     '''Run a media player action on the current playback'''
-    _cmd(f'org.mpris.MediaPlayer2.Player."{action}"')
+    _call(PLAYER_IFACE, action)
 
 
 def play_uri(uri):
     '''Start playing a spotify uri'''
-    _cmd(f'org.mpris.MediaPlayer2.Player.OpenUri {uri}')
+    _call(PLAYER_IFACE, 'OpenUri', uri)
 
 
 def get_metadata():
-    try:
-        session_bus = dbus.SessionBus()
-        bus = session_bus.get_object(
-            "org.mpris.MediaPlayer2.spotify",
-            "/org/mpris/MediaPlayer2")
-    except Exception:
-        print_red('Unable to connect to Spotify. Is it running?')
-        exit(42)
-
-    properties = dbus.Interface(bus, "org.freedesktop.DBus.Properties")
-    metadata = properties.Get("org.mpris.MediaPlayer2.Player", "Metadata")
-    return metadata
+    '''The MPRIS metadata for the current track'''
+    return _call(PROPERTIES_IFACE, 'Get', PLAYER_IFACE, 'Metadata')
 
 
 def show_metadata():
@@ -109,7 +157,117 @@ def show_metadata():
 
 def current_song():
     '''Show the currently playing song'''
-    metadata = get_metadata()
-    artist = metadata['xesam:artist'][0]
-    title = metadata['xesam:title']
-    print_green(f'{artist}: {title}')
+    state = read_state()
+
+    if state is None:
+        track = _track(get_metadata())
+    elif not state['running']:
+        print_red('Unable to connect to Spotify. Is it running?')
+        exit(42)
+    else:
+        track = state['track']
+
+    print_green(track)
+
+
+def watch():
+    '''
+    Print the current track whenever it (or the playback status) changes
+    until we are interrupted, keeping STATE_PATH up to date as we go.
+    '''
+    from gi.repository import GLib
+    from dbus.mainloop.glib import DBusGMainLoop
+
+    # A connection of our own as the shared one has no main loop attached
+    bus = dbus.SessionBus(mainloop=DBusGMainLoop(), private=True)
+    current = {'running': False, 'track': '', 'status': 'Stopped'}
+    shown = []
+
+    def show():
+        if shown == [current]:
+            return
+
+        shown[:] = [dict(current)]
+        _write_state(current)
+
+        if current['status'] == 'Paused':
+            print('{} (paused)'.format(current['track']), flush=True)
+        else:
+            print(current['track'], flush=True)
+
+    def properties_changed(interface, changed, invalidated):
+        if interface != PLAYER_IFACE:
+            return
+
+        if 'Metadata' in changed:
+            current['track'] = _track(changed['Metadata'])
+        if 'PlaybackStatus' in changed:
+            current['status'] = str(changed['PlaybackStatus'])
+
+        show()
+
+    def owner_changed(owner):
+        # Spotify has started or quit: only one query per start up
+        current.update(running=bool(owner), track='', status='Stopped')
+
+        if owner:
+            player = bus.get_object(BUS_NAME, OBJECT_PATH, introspect=False)
+            try:
+                props = player.GetAll(
+                    PLAYER_IFACE, dbus_interface=PROPERTIES_IFACE)
+            except dbus.exceptions.DBusException:
+                props = {}
+
+            properties_changed(PLAYER_IFACE, props, [])
+
+        show()
+
+    bus.add_signal_receiver(
+        properties_changed,
+        signal_name='PropertiesChanged',
+        dbus_interface=PROPERTIES_IFACE,
+        bus_name=BUS_NAME,
+        path=OBJECT_PATH,
+    )
+    bus.watch_name_owner(BUS_NAME, owner_changed)
+
+    try:
+        GLib.MainLoop().run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if os.path.exists(STATE_PATH):
+            os.unlink(STATE_PATH)
+
+
+def read_state():
+    '''
+    The state written by a running `pa spotify watch` or None if there
+    isn't a watcher running.
+    '''
+    try:
+        with open(STATE_PATH, 'r') as f:
+            state = json.load(f)
+        os.kill(state['pid'], 0)
+    except PermissionError:
+        # The watcher is running as someone else but it is still running
+        return state
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+    return state
+
+
+def _write_state(current):
+    with atomic_write(STATE_PATH) as f:
+        json.dump(dict(current, pid=os.getpid()), f)
+
+
+def _track(metadata):
+    '''Format MPRIS metadata as "artist: title"'''
+    if not metadata:
+        return ''
+
+    artists = metadata.get('xesam:artist') or ['']
+    title = metadata.get('xesam:title', '')
+    return f'{artists[0]}: {title}'
@@ -14,9 +14,14 @@ Usage:
   pa todo (-h | --help)
 
 Options:
-  -l, --list    List today's outstanding TODOs
-  -o, --open    Open the current TODO file in your editor
-  -s, --sync    Sync the local TODO file with Todoist
+  -l, --list            List today's outstanding TODOs
+  -o, --open            Open the current TODO file in your editor
+  -s, --sync            Sync the local TODO file with Todoist
+  -t, --todoist         List open Todoist tasks as of the last sync (this does
+                        not need a network connection)
+  --due <date>          With --todoist, only show tasks due on or before a
+                        yyyy-mm-dd date (or 'today')
+  --match <text>        With --todoist, only show tasks containing <text>
 '''
 import os
 import re
@@ -24,18 +29,32 @@ import sys
 import json
 import uuid
 import subprocess
+from collections import namedtuple
 from datetime import datetime, date
 
 import peewee
-from requests import get, post, HTTPError
+from requests import HTTPError
 
-from ..db import PaModel
-from ..utils import today, get_config, print_red, print_yellow, \
-    print_green, TEMPLATE
+from ..db import DB, PaModel, get_state, set_state
+from ..utils import today, get_config, http_request, fetch_many, \
+    atomic_write, print_red, print_yellow, print_green, TEMPLATE
 
 
 SUMMARY = 'Create, manage and sync todo\'s with todoist'
-URL = 'https://beta.todoist.com/API/v8/{}'
+SYNC_URL = 'https://api.todoist.com/sync/v8/sync'
+# The Sync API accepts at most 100 commands per request
+SYNC_BATCH_SIZE = 100
+SYNC_MAX_THREADS = 4
+# State key for the sync token of our last read from the Sync API
+SYNC_TOKEN_KEY = 'todo.sync_token'
+# Open, in progress and important TODOs
+OPEN = re.compile(r'\[[ o+]\]')
+# A TODO line with an optional Todoist ID: "- [x] (1234) Do the thing"
+TODO_LINE = re.compile(r'^- \[(.)\] (?:\((\d+)\) )?(.*?)\s*$')
+
+# A single TODO from a TODO file: its (0 based) line number, the character
+# between the brackets, its Todoist ID (if it has one) and the TODO itself.
+TodoLine = namedtuple('TodoLine', ['n', 'state', 'todoist_id', 'text'])
 
 
 # TODO: add tables for labels and projects
@@ -66,50 +85,55 @@ class Todo(PaModel):
         return self.label_ids_str.split(',')
 
     @staticmethod
-    def format_json_for_insert(data):
+    def from_sync_item(item):
         '''
-        Format the JSON response from todoist for the creation of Todo
-        instances.
-        The resulting dictionary can be used either as:
-        >>> t = Todo(*data)  # Single todo
-        >>> t.save()
-
-        Or:
-        >>> Todo.insert_many([...]).execute() # array of todos
-
-        NOTE: data should be a dictionary not a raw string
+        Convert an item from the Todoist Sync API into a dictionary of Todo
+        fields suitable for:
+        >>> Todo.insert_many([...]).on_conflict_replace().execute()
         '''
-        data['label_ids_str'] = ','.join(str(i) for i in data['label_ids'])
-
-        due = data.get('due')
-        if due:
-            d = due.get('date')
-            dt = due.get('datetime')
-            if dt:
-                due['due_date'] = date(*map(int, d.split('-')))
-            if dt:
-                due['due_time'] = datetime.strptime(
-                    dt + due['timezone'].replace(':', ''),
-                    '%Y-%m-%dT%H:%M:%SZUTC%z'
-                )
-            del(data['due'])
-
-        del(data['order'])
-        del(data['indent'])
-        del(data['label_ids'])
-        del(data['comment_count'])
-
-        return data
+        row = {
+            'id': item['id'],
+            'project_id': item.get('project_id'),
+            'completed': bool(item.get('checked')),
+            'content': item['content'],
+            'label_ids_str': ','.join(str(i) for i in item.get('labels', [])),
+            'due_date': None,
+            'due_time': None,
+            'url': 'https://todoist.com/showTask?id={}'.format(item['id']),
+            'priority': item.get('priority', 1),
+        }
+
+        due = item.get('due')
+        if due and due.get('date'):
+            d = due['date']
+            row['due_date'] = date(*map(int, d[:10].split('-')))
+            if 'T' in d:
+                row['due_time'] = datetime.fromisoformat(
+                    d.replace('Z', '+00:00'))
+
+        return row
 
     @classmethod
-    def fetch_all_open(cls):
+    def fetch_all_open(cls, config):
         '''
         Pull all currently open tasks and load them into the database.
         '''
-        config = get_config()
-        tasks = query(config, get, 'tasks')
-        tasks = [cls.format_json_for_insert(t) for t in tasks]
-        cls.insert_many(tasks).execute()
+        pull_changes(config, full=True)
+
+
+class TodoFile(PaModel):
+    '''
+    A daily note file along with the (0 based) line numbers of any open TODOs
+    in it, so that we only need to read files that have changed.
+    '''
+    path = peewee.CharField(unique=True)
+    mtime = peewee.IntegerField()
+    size = peewee.IntegerField()
+    open_lines = peewee.TextField(default='')
+
+    @property
+    def line_numbers(self):
+        return [int(n) for n in self.open_lines.split(',') if n]
 
 
 def run(args):
@@ -127,8 +151,11 @@ def run(args):
     elif args['--open']:
         quick_open(todo_file, config)
 
+    elif args['--todoist']:
+        list_todoist(args['--due'], args['--match'])
+
     elif args['--sync']:
-        if not config['todoist']['enabled']:
+        if not config.todoist.enabled:
             print_red('Todoist functionality is not enabled')
             exit()
 
@@ -143,36 +170,11 @@ def run(args):
         quick_todo(todo_file, args['<todo>'])
 
 
-def query(config, req_func, endpoint, params={}, data=None, headers=None):
-    '''
-    Query the Todoist REST API using an api token
-    '''
-    if not config.get('todoist', 'api_token'):
-        raise ValueError('No Todoist API token given in config')
-
-    params['token'] = config['todoist']['api_token']
-    resp = req_func(
-        URL.format(endpoint),
-        params=params,
-        data=data,
-        headers=headers
-    )
-
-    if 200 <= resp.status_code < 400:
-        try:
-            return resp.json()
-        except json.JSONDecodeError:
-            # TODO: confirm that this is the correct error
-            return resp.text
-
-    raise HTTPError(resp.reason)
-
-
 def ensure_default_todo_file(config):
     '''
     Conditionally migrate over any notes from yesterday and open a new file
     '''
-    root = config['note']['note_root']
+    root = config.note.path('note_root')
     today = datetime.today()
     y, m, d = today.year, today.month, today.day
     date = '{}/{}/{}'.format(y, m, d)
@@ -184,55 +186,86 @@ def ensure_default_todo_file(config):
         os.makedirs(today_dir)
 
     if not os.path.exists(todo_file):
-        # Get the name of all of the files containing incomplete TODOs
-        try:
-            os.chdir(root + '/daily-notes')
-        except FileNotFoundError:
-            os.mkdir(root + '/daily-notes')
-            os.chdir(root + '/daily-notes')
-
-        if config['general']['ag_enabled']:
-            res = subprocess.run(
-                r'ag -l --nocolor "\[[ o+]\]"',
-                shell=True,
-                stdout=subprocess.PIPE
-            )
-            res = res.stdout.decode().split('\n')
-        else:
-            res = _get_open_todos(config)
+        daily_dir = root + '/daily-notes'
+        to_move = find_todos_to_move(
+            daily_dir, update_todo_index(daily_dir))
+        open_todos = [
+            line for rel_path in sorted(to_move)
+            for _, line in to_move[rel_path]
+        ]
+
+        if open_todos:
+            print_yellow('Moving existing TODOs to today:')
+            for todo in open_todos:
+                print('  ' + todo[6:].rstrip('\n'))
+
+        # Write today's file before marking anything as moved so that a crash
+        # can at worst leave a TODO in two places rather than losing it.
+        with atomic_write(todo_file) as f:
+            f.write(TEMPLATE.format(date, '') + '\n')
+            f.writelines(open_todos)
+
+        mark_todos_moved(daily_dir, to_move)
+
+    return todo_file
 
-        os.chdir(os.path.expanduser('~/'))
 
-        old_todo_files = list(filter(lambda l: len(l) > 0, res))
+def find_todos_to_move(daily_dir, open_files):
+    '''
+    Find the open `- [ ]` TODOs that need moving to today's file.
 
-        open_todos = []
+    `open_files` is {path: [line numbers]} from update_todo_index. Each file is
+    only read as far as its last open TODO. Returns {path: [(n, line)]} for
+    the files that have something to move. Like the index, a note that isn't
+    valid UTF-8 is read with the offending bytes replaced.
+    '''
+    to_move = {}
+
+    for rel_path, line_numbers in open_files.items():
+        wanted = set(line_numbers)
+        last = max(line_numbers)
+        found = []
+
+        path = os.path.join(daily_dir, rel_path)
+        with open(path, 'r', errors='replace') as f:
+            for n, line in enumerate(f):
+                if n in wanted and line.startswith('- [ ]'):
+                    if not line.endswith('\n'):
+                        line += '\n'
+                    found.append((n, line))
+                if n >= last:
+                    break
 
-        for fname in old_todo_files:
-            old_notes = '{}/daily-notes/{}'.format(root, fname)
+        if found:
+            to_move[rel_path] = found
 
-            with open(old_notes, 'r') as f:
-                lines = f.readlines()
+    return to_move
 
-            for n, line in enumerate(lines):
-                # Find open TODOs
-                if line.startswith('- [ ]'):
-                    open_todos.append((n, line))
-                    lines[n] = line[:3] + '-' + line[4:]
 
-            if open_todos:
-                print_yellow('Moving existing TODOs to today:')
-                for line, todo in open_todos:
-                    print(todo[6:])
+def mark_todos_moved(daily_dir, to_move):
+    '''
+    Mark moved TODOs as `- [-]` in their original files.
 
-                with open(old_notes, 'w') as f:
-                    f.writelines(lines)
+    Each file is streamed into a temporary file that replaces the original
+    once it has been completely written so a crash can't truncate notes. Bytes
+    that aren't valid UTF-8 are passed through untouched (surrogateescape)
+    rather than replaced as we are rewriting the user's notes.
+    '''
+    for rel_path, moved in to_move.items():
+        path = os.path.join(daily_dir, rel_path)
+        line_numbers = {n for n, _ in moved}
 
-        with open(todo_file, 'w') as f:
-            f.write(TEMPLATE.format(date, '') + '\n')
-            for line, todo in open_todos:
-                f.write(todo)
+        with open(path, 'r', errors='surrogateescape') as src, \
+                atomic_write(path, errors='surrogateescape') as dst:
+            for n, line in enumerate(src):
+                if n in line_numbers:
+                    line = line[:3] + '-' + line[4:]
+                dst.write(line)
 
-    return todo_file
+        index_todo_file(
+            daily_dir, rel_path,
+            TodoFile.get_or_none(TodoFile.path == rel_path)
+        )
 
 
 def quick_todo(todo_file, note_content):
@@ -248,48 +281,182 @@ def list_todo(config):
     '''
     List the current todos
     '''
-    os.chdir(config['note']['note_root'] + '/daily-notes')
-    subprocess.run(
-        r'ag "\[[ o+]\]" ',
-        shell=True,
-    )
+    daily_dir = config.note.path('note_root') + '/daily-notes'
+
+    for fname, line_numbers in sorted(update_todo_index(daily_dir).items()):
+        with open(os.path.join(daily_dir, fname), 'r', errors='replace') as f:
+            lines = f.readlines()
+
+        for n in line_numbers:
+            print('{}:{}:{}'.format(fname, n + 1, lines[n].rstrip('\n')))
 
 
 def quick_open(todo_file, config):
     '''
     Open today's TODO file in the user specified editor
     '''
-    subprocess.run([config['general']['editor'], todo_file])
+    subprocess.run([config.general.editor, todo_file])
 
 
-def today_and_overdue(config):
-    '''Get tasks that need to be done today'''
-    json_tasks = query(
-        config, get, 'tasks', {'filter': '(overdue|{})'.format(today())})
-    tasks = [(t['id'], t['content']) for t in json_tasks]
-    return tasks
+def today_and_overdue():
+    '''Get tasks that need to be done today from the local copy'''
+    todos = open_todos(due=date.today())
+    return [(t.id, t.content) for t in todos]
 
 
-def close_task(config, task_id):
-    '''Close a task by ID'''
-    query(config, post, 'tasks/{}/close'.format(task_id))
+def open_todos(due=None, match=None):
+    '''
+    Query the local copy of our Todoist tasks for open tasks, optionally
+    filtering by due date (inclusive) and content.
+    '''
+    Todo.create_table(safe=True)
+    query = Todo.select().where(Todo.completed == False)  # noqa: E712
+
+    if due is not None:
+        query = query.where(Todo.due_date <= due)
+    if match is not None:
+        query = query.where(Todo.content.contains(match))
+
+    return query.order_by(Todo.due_date, Todo.priority.desc(), Todo.id)
+
+
+def list_todoist(due=None, match=None):
+    '''
+    Show open Todoist tasks from the local database.
+    '''
+    if due == 'today':
+        due = date.today()
+    elif due is not None:
+        due = date(*map(int, due.split('-')))
+
+    for todo in open_todos(due, match):
+        when = todo.due_date.isoformat() if todo.due_date else 'no date'
+        print('({}) [{}] {}'.format(todo.id, when, todo.content))
 
 
-def new_task(config, content, priority=1):
-    '''Create a new task'''
-    data = json.dumps({
-        'content': content,
-        'due_string': today(),
-        'due_lang': 'en',
-        'priority': 1
+def pull_changes(config, full=False):
+    '''
+    Bring the local Todo table up to date with Todoist.
+
+    Only the changes since our last sync are requested (using the sync token
+    that Todoist gave us last time) so the cost of this depends on how much
+    has changed rather than on the size of the account.
+    '''
+    token = config.todoist.api_token
+    if not token:
+        raise ValueError('No Todoist API token given in config')
+
+    sync_token = '*' if full else get_state(SYNC_TOKEN_KEY, '*')
+    resp = http_request('POST', SYNC_URL, data={
+        'token': token,
+        'sync_token': sync_token,
+        'resource_types': json.dumps(['items']),
     })
-    headers = {
-        "Content-Type": "application/json",
-        "X-Request-Id": str(uuid.uuid4()),
+    if not resp.ok:
+        raise HTTPError(resp.reason)
+
+    data = resp.json()
+    apply_item_changes(data.get('items', []), data.get('full_sync', False))
+    set_state(SYNC_TOKEN_KEY, data['sync_token'])
+
+
+def apply_item_changes(items, full_sync=False):
+    '''
+    Upsert changed items into the Todo table and remove deleted ones. A full
+    sync replaces the table contents entirely.
+    '''
+    Todo.create_table(safe=True)
+    deleted = [i['id'] for i in items if i.get('is_deleted')]
+    rows = [Todo.from_sync_item(i) for i in items if not i.get('is_deleted')]
+
+    with DB.atomic():
+        if full_sync:
+            Todo.delete().execute()
+        elif deleted:
+            Todo.delete().where(Todo.id.in_(deleted)).execute()
+
+        # Keep well under SQLite's limit on the number of bound variables
+        for i in range(0, len(rows), 50):
+            Todo.insert_many(rows[i:i + 50]).on_conflict_replace().execute()
+
+
+def close_task_command(task_id):
+    '''Sync API command to close a task by ID'''
+    return {
+        'type': 'item_close',
+        'uuid': str(uuid.uuid4()),
+        'args': {'id': task_id},
     }
 
-    resp = query(config, post, 'tasks', data=data, headers=headers)
-    return resp['id']
+
+def new_task_command(content, priority=1):
+    '''
+    Sync API command to create a new task due today. The real ID of the task
+    is found by looking up the command's `temp_id` in the response.
+    '''
+    return {
+        'type': 'item_add',
+        'uuid': str(uuid.uuid4()),
+        'temp_id': str(uuid.uuid4()),
+        'args': {
+            'content': content,
+            'due': {'string': today(), 'lang': 'en'},
+            'priority': priority,
+        },
+    }
+
+
+def sync_commands(config, commands):
+    '''
+    Send a list of write commands to the Todoist Sync API, batching them so
+    that each request carries up to SYNC_BATCH_SIZE commands and running up
+    to SYNC_MAX_THREADS requests at once.
+
+    Returns the combined {uuid: status} and {temp_id: id} mappings from the
+    responses. A command succeeded if its status is 'ok'.
+    '''
+    token = config.todoist.api_token
+    if not token:
+        raise ValueError('No Todoist API token given in config')
+
+    requests = [
+        (i, 'POST', SYNC_URL, {'data': {
+            'token': token,
+            'commands': json.dumps(commands[i:i + SYNC_BATCH_SIZE]),
+        }})
+        for i in range(0, len(commands), SYNC_BATCH_SIZE)
+    ]
+    statuses, temp_ids = {}, {}
+
+    # Failed batches are simply missing from the results so the commands in
+    # them are reported as failed by the caller.
+    for _, resp, error in fetch_many(requests, max_threads=SYNC_MAX_THREADS):
+        if error is not None or not resp.ok:
+            continue
+
+        data = resp.json()
+        statuses.update(data.get('sync_status', {}))
+        temp_ids.update(data.get('temp_id_mapping', {}))
+
+    return statuses, temp_ids
+
+
+def parse_todo_lines(lines):
+    '''
+    Parse the lines of a TODO file into TodoLines. Lines that are not TODOs
+    are skipped.
+    '''
+    entries = []
+
+    for n, line in enumerate(lines):
+        match = TODO_LINE.match(line)
+        if match:
+            state, todoist_id, text = match.groups()
+            if todoist_id is not None:
+                todoist_id = int(todoist_id)
+            entries.append(TodoLine(n, state, todoist_id, text))
+
+    return entries
 
 
 def sync(config):
@@ -297,101 +464,119 @@ def sync(config):
     Align the local todos with todoist.
     '''
     todo_file = ensure_default_todo_file(config)
-    tasks = today_and_overdue(config)
-    IDs = {t[0] for t in tasks}
-    new_tasks = []
-    completed_tasks = []
-    closed = []
-    local_open = []
+    pull_changes(config)
+    tasks = today_and_overdue()
 
     with open(todo_file, 'r') as f:
         lines = f.readlines()
 
-    for n, line in enumerate(lines):
-        # Find open tasks
-        if line.startswith('- [ ]'):
-            task = line[5:-1]
-            # Don't re-add tasks with an existing ID
-            if not re.match(r'- \[ \] \(\d*\)', line):
-                new_tasks.append((n, task))
-            else:
-                # check for open local tasks that are now closed
-                parts = line[6:-1].partition(') ')
-                try:
-                    ID, task = int(parts[0][1:]), parts[2]
-                    local_open.append((n, ID, task))
-                except ValueError:
-                    # This wasn't a task ID so skip it
-                    pass
-        # Find completed tasks
-        elif line.startswith('- [x] ('):
-            parts = line[6:-1].partition(') ')
-            try:
-                ID, task = int(parts[0][1:]), parts[2]
-                completed_tasks.append((ID, task))
-            except ValueError:
-                # This wasn't a task ID so skip it
-                pass
-
-    # Close completed tasks in Todoist
-    for ID, task in completed_tasks:
-        if ID in IDs:
-            try:
-                close_task(config, ID)
-                print_yellow('Closed "{}"'.format(task))
-                closed.append(ID)
-            except HTTPError:
-                print_red('Unable to close task: {}'.format(ID),
-                          file=sys.stderr)
-
-    for n, ID, task in local_open:
-        if ID not in IDs:
+    entries = parse_todo_lines(lines)
+    by_id = {e.todoist_id: e for e in entries if e.todoist_id is not None}
+    remote_open = {
+        t.id for t in Todo.select(Todo.id).where(
+            Todo.id.in_(list(by_id)), Todo.completed == False  # noqa: E712
+        )
+    }
+    closed = set()
+
+    # Close completed tasks and add new tasks in Todoist as a single batch
+    commands = []
+    closing = {}
+    adding = {}
+
+    for e in entries:
+        if e.todoist_id is None:
+            if e.state == ' ':
+                cmd = new_task_command(e.text)
+                adding[cmd['uuid']] = (e, cmd['temp_id'])
+                commands.append(cmd)
+        elif e.state == 'x' and e.todoist_id in remote_open:
+            cmd = close_task_command(e.todoist_id)
+            closing[cmd['uuid']] = e
+            commands.append(cmd)
+
+    statuses, temp_ids = sync_commands(config, commands)
+
+    for cmd_uuid, e in closing.items():
+        if statuses.get(cmd_uuid) == 'ok':
+            print_yellow('Closed "{}"'.format(e.text))
+            closed.add(e.todoist_id)
+            Todo.update(completed=True).where(
+                Todo.id == e.todoist_id).execute()
+        else:
+            print_red('Unable to close task: {}'.format(e.todoist_id))
+
+    for e in by_id.values():
+        if e.state == ' ' and e.todoist_id not in remote_open:
             # The task is now closed in Todoist so close locally as well
-            lines[n] = line[:3] + 'x' + line[4:]
-
-    # Add new tasks to Todoist
-    for n, task in new_tasks:
-        try:
-            ID = new_task(config, task)
-            lines[n] = '- [ ] ({}) '.format(ID) + lines[n][6:]
-            print_green('Added "{}" to Todoist'.format(task))
-        except HTTPError:
+            lines[e.n] = lines[e.n][:3] + 'x' + lines[e.n][4:]
+
+    for cmd_uuid, (e, temp_id) in adding.items():
+        ID = temp_ids.get(temp_id)
+        if statuses.get(cmd_uuid) == 'ok' and ID is not None:
+            lines[e.n] = '- [ ] ({}) {}\n'.format(ID, e.text)
+            print_green('Added "{}" to Todoist'.format(e.text))
+        else:
             print(
-                'Unable to add task to Todoist: {}'.format(task),
+                'Unable to add task to Todoist: {}'.format(e.text),
                 file=sys.stderr)
 
     # Add new tasks from Todoist
     for ID, task in tasks:
-        if ID not in closed:
-            for line in lines:
-                if str(ID) in line:
-                    break
-            else:
-                lines.append('- [ ] ({}) {}\n'.format(ID, task))
-                print_green('Adding "{}" from Todoist'.format(task))
+        if ID not in closed and ID not in by_id:
+            lines.append('- [ ] ({}) {}\n'.format(ID, task))
+            print_green('Adding "{}" from Todoist'.format(task))
 
     # Update the quicknote file
-    with open(todo_file, 'w') as f:
+    with atomic_write(todo_file) as f:
         f.writelines(lines)
 
 
-def _get_open_todos(config):
+def update_todo_index(daily_dir):
+    '''
+    Bring the index of open TODOs up to date with the daily notes directory,
+    re-reading only those files that have changed since they were last
+    indexed, and return {path: [line numbers]} for the files that contain
+    open TODOs. Paths are relative to `daily_dir` and line numbers start at 0.
+    '''
+    TodoFile.create_table(safe=True)
+    known = {t.path: t for t in TodoFile.select()}
+    seen = set()
+
+    with DB.atomic():
+        for base_path, _, fnames in os.walk(daily_dir):
+            for fname in fnames:
+                path = os.path.join(base_path, fname)
+                rel_path = os.path.relpath(path, daily_dir)
+                seen.add(rel_path)
+                index_todo_file(daily_dir, rel_path, known.get(rel_path))
+
+        for rel_path in set(known) - seen:
+            known[rel_path].delete_instance()
+
+    return {
+        t.path: t.line_numbers
+        for t in TodoFile.select().where(TodoFile.open_lines != '')
+    }
+
+
+def index_todo_file(daily_dir, rel_path, entry=None):
     '''
-    Find all open todos
+    (Re-)index a single daily note file if it has changed since `entry` was
+    recorded.
     '''
-    pattern = re.compile('\[[ o+]\]')
-    base = config['note']['note_root'] + '/daily-notes'
+    stat = os.stat(os.path.join(daily_dir, rel_path))
 
-    note_files = []
+    if entry is None:
+        entry = TodoFile(path=rel_path)
+    elif entry.mtime == stat.st_mtime_ns and entry.size == stat.st_size:
+        return entry
 
-    for path, _, fnames in os.walk(base):
-        for fname in fnames:
-            path = os.path.join(base, fname)
+    with open(os.path.join(daily_dir, rel_path), 'r', errors='replace') as f:
+        line_numbers = [n for n, line in enumerate(f) if OPEN.search(line)]
 
-            with open(path, 'r') as f:
-                for line in f:
-                    if pattern.search(line):
-                        note_files.append(fname)
-                        break
+    entry.mtime, entry.size = stat.st_mtime_ns, stat.st_size
+    entry.open_lines = ','.join(str(n) for n in line_numbers)
+    entry.save()
 
-    return note_files
+    return entry
@@ -4,10 +4,23 @@ pa toggl - Command line toggl tracking and push to STATs
 Manage toggl timers from the command line. (You will need to add your
 toggl api token to your config file and enable toggl to use this module.)
 
+Breakdowns are calculated from a local copy of your time entries. Only the
+last few days (and any dates that have never been fetched) are downloaded
+again each time. Entries are grouped by project unless --by is given, which
+takes a comma separated list of: project, client, description, day,
+weekday, week, month and year. Days are in your local timezone.
+
+Starting and stopping timers only touches local files so they work offline.
+The changes are queued and sent to toggl in the background (or by `pa toggl
+flush` and `pa --sync`), being retried until toggl accepts them. A timer that
+is started and stopped before the start has been sent becomes a single
+entry, which is dropped if it ran for less than 10 seconds.
+
 Usage:
   pa toggl start <project> [<details>...]
   pa toggl stop
-  pa toggl [options]
+  pa toggl flush
+  pa toggl [options] [--by <keys>]
   pa toggl (-h | --help)
 
 Options:
@@ -15,28 +28,85 @@ Options:
   -b <period>, --breakdown <period>     Display a breakdown of the time spent
                                         on each tracked project for the given
                                         period. Periods are: [d]ay, [w]eek,
-                                        [m]onth or [y]ear.
+                                        [m]onth, [y]ear or <from>..<to>
+                                        (dates as YYYY-MM-DD).
+  --by <keys>                           Group the breakdown by these keys,
+                                        e.g. project,weekday or client,month.
 '''
 #  -u, --update-stats                    Update the SEI-Y STATs system with
 #                                        hours worked so far this week on SEI
 #                                        projects.
+import os
 import sys
+import json
+import math
+import uuid
+import fcntl
+import subprocess
+from contextlib import contextmanager
 from calendar import monthcalendar
-from collections import defaultdict
-from datetime import datetime, date, timedelta
+from itertools import groupby
+from datetime import datetime, date, timedelta, timezone
 
+import peewee
 import requests
 from requests.auth import HTTPBasicAuth
 
-from ..utils import get_config, print_red, print_yellow
+from ..db import DB, PaModel, get_state, set_state
+from ..utils import get_config, http_request, fetch_many, atomic_write, \
+    print_red, print_yellow, print_green, CONFIG_ROOT
 
 
 SUMMARY = 'Manage toggl timers and view breakdowns'
 
 # Toggl API urls
 WORKSPACE_URL = 'https://www.toggl.com/api/v8/workspaces'
+PROJECTS_URL = WORKSPACE_URL + '/{}/projects'
+TIME_ENTRIES_URL = 'https://www.toggl.com/api/v8/time_entries'
 DATA_URL = 'https://toggl.com/reports/api/v2/details'
 
+# Timer changes waiting to be sent to toggl, one JSON object per line. The
+# lock files serialise access to the queue and make sure that only one
+# process is flushing it at a time.
+QUEUE_PATH = os.path.join(CONFIG_ROOT, 'toggl-queue.jsonl')
+QUEUE_LOCK_PATH = os.path.join(CONFIG_ROOT, '.toggl-queue.lock')
+FLUSH_LOCK_PATH = os.path.join(CONFIG_ROOT, '.toggl-flush.lock')
+# Run in a detached process after starting or stopping a timer
+FLUSH_COMMAND = "from pa.cli import run; run(['toggl', 'flush'])"
+# Timers started and stopped within this many seconds of each other are
+# dropped if neither change has been sent yet.
+MIN_ENTRY_SECONDS = 10
+
+# The reports API only accepts ranges of up to a year
+MAX_REPORT_DAYS = 365
+# Entries in the last few days are re-fetched on each run to pick up edits
+REFRESH_DAYS = 2
+# State keys for the workspace that we report on and the (inclusive) range
+# of dates that we have a local copy of the entries for.
+WORKSPACE_KEY = 'toggl.workspace_id'
+COVERED_KEY = 'toggl.covered'
+# The running timer, toggl ids for timers that have been started remotely
+# but not yet stopped, project ids by name and the last flush error.
+TIMER_KEY = 'toggl.timer'
+REMOTE_IDS_KEY = 'toggl.remote_ids'
+PROJECTS_KEY = 'toggl.projects'
+FLUSH_ERROR_KEY = 'toggl.flush_error'
+
+# The SQL expression to group on for each --by key. SQLite applies the UTC
+# offset in `start` and then converts to local time so that entries are
+# bucketed by the local day, either side of any DST change. Weekdays are
+# numbered from Monday and weeks are keyed by the date of their Monday.
+GROUP_SQL = {
+    'project': 'project',
+    'client': 'client',
+    'description': 'description',
+    'day': "date(start, 'localtime')",
+    'weekday': "(CAST(strftime('%w', start, 'localtime') AS INTEGER) + 6) % 7",
+    'week': "date(start, 'localtime', '-6 days', 'weekday 1')",
+    'month': "strftime('%Y-%m', start, 'localtime')",
+    'year': "strftime('%Y', start, 'localtime')",
+}
+
 DAYS = [
     'Monday', 'Tuesday', 'Wednesday',
     'Thursday', 'Friday',
@@ -44,13 +114,47 @@ DAYS = [
 ]
 
 
+class TimeEntry(PaModel):
+    '''
+    A time entry from the toggl detailed report API. `start` is kept as the
+    ISO 8601 string that toggl gave us (in the user's toggl timezone) and
+    durations are in milliseconds.
+    '''
+    id = peewee.IntegerField(unique=True)
+    project = peewee.CharField(null=True)
+    client = peewee.CharField(null=True)
+    description = peewee.TextField(null=True)
+    start = peewee.CharField(index=True)
+    dur = peewee.IntegerField()
+    tags = peewee.TextField(null=True)
+
+    @staticmethod
+    def from_report(entry):
+        '''
+        Convert an entry from the detailed report into a row for insertion.
+        '''
+        return {
+            'id': entry['id'],
+            'project': entry.get('project'),
+            'client': entry.get('client'),
+            'description': entry.get('description'),
+            'start': entry['start'],
+            'dur': entry['dur'],
+            'tags': ','.join(entry.get('tags') or []),
+        }
+
+
+class Rejected(Exception):
+    '''Toggl will never accept a queued change so there's no use retrying'''
+
+
 def run(args):
     '''
     Entry point for the cli application.
     '''
     config = get_config()
 
-    if not config['toggl']['enabled']:
+    if not config.toggl.enabled:
         print_red('Toggl functionality is not enabled. See config file.')
         exit()
 
@@ -60,11 +164,14 @@ def run(args):
         start_timer(config, project, details)
     elif args['stop']:
         stop_active_timer(config)
+    elif args['flush']:
+        flush(config)
     elif args['--status']:
         get_status(config)
     elif args['--breakdown']:
         period = args['--breakdown']
-        get_breakdown(config, period)
+        keys = args['--by'].split(',') if args['--by'] else None
+        get_breakdown(config, period, keys)
     else:
         print(__doc__)
         exit()
@@ -72,80 +179,482 @@ def run(args):
 
 def start_timer(config, project, details):
     '''
-    Start a toggl timer
+    Start a toggl timer, stopping the current one if there is one running.
     '''
-    pass
+    now = _now()
+
+    with _lock(QUEUE_LOCK_PATH):
+        running = get_state(TIMER_KEY)
+        if running is not None:
+            _queue_op(_stop_op(running, now))
+
+        timer = {
+            'id': uuid.uuid4().hex,
+            'project': project,
+            'description': details,
+            'start': now,
+        }
+        _queue_op(dict(timer, op='start'))
+        set_state(TIMER_KEY, timer)
+
+    _flush_in_background()
+
+    if running is not None:
+        print_yellow('Stopped {}'.format(_describe(running)))
+    print_green('Started {}'.format(_describe(timer)))
 
 
 def stop_active_timer(config):
     '''
     Stop the current active toggl timer
     '''
-    pass
+    now = _now()
+
+    with _lock(QUEUE_LOCK_PATH):
+        timer = get_state(TIMER_KEY)
+        if timer is None:
+            print_yellow('No timer running')
+            return
+
+        _queue_op(_stop_op(timer, now))
+        set_state(TIMER_KEY, None)
+
+    _flush_in_background()
+    print_green('Stopped {} after {}'.format(
+        _describe(timer), _hours_and_mins(_elapsed_ms(timer['start'], now))))
 
 
 def get_status(config):
     '''
     Show the status of the current toggl timer
     '''
-    pass
+    timer = get_state(TIMER_KEY)
+
+    if timer is None:
+        print('No timer running')
+    else:
+        started = _parse_time(timer['start']).astimezone()
+        print_green('{} running for {} (since {})'.format(
+            _describe(timer),
+            _hours_and_mins(_elapsed_ms(timer['start'], _now())),
+            started.strftime('%H:%M')))
+
+    pending = len(_read_queue())
+    if pending:
+        print_yellow('{} change{} waiting to be sent to toggl'.format(
+            pending, '' if pending == 1 else 's'))
+
+    error = get_state(FLUSH_ERROR_KEY)
+    if error:
+        print_red('Last attempt to send changes to toggl failed: {}'.format(
+            error))
+
+
+def flush(config):
+    '''
+    Send any queued timer changes to toggl, reporting what is left.
+    '''
+    remaining = flush_queue(config, wait=True)
+    error = get_state(FLUSH_ERROR_KEY)
+
+    if remaining:
+        print_red('Unable to send all changes to toggl: {}'.format(error))
+        print_yellow('{} change{} still waiting to be sent'.format(
+            remaining, '' if remaining == 1 else 's'))
+        sys.exit(1)
+    elif error:
+        # Everything was sent apart from changes that toggl will never accept
+        print_red('Toggl rejected a timer change: {}'.format(error))
+        sys.exit(1)
+
+    print_green('All timer changes have been sent to toggl')
+
+
+def sync(config):
+    '''
+    Send any queued timer changes to toggl.
+    '''
+    if config.toggl.enabled:
+        flush(config)
+
+
+def flush_queue(config, wait=False):
+    '''
+    Send queued timer changes to toggl in the order that they were made and
+    remove the ones that were sent (or rejected) from the queue. Stops at the
+    first change that fails so that they stay in order. Returns the number
+    of changes left in the queue.
+
+    If another process is already flushing the queue then we wait for it to
+    finish when `wait` is set and leave it to do the work otherwise.
+    '''
+    with _lock(FLUSH_LOCK_PATH, blocking=wait) as locked:
+        if not locked:
+            return len(_read_queue())
+
+        with _lock(QUEUE_LOCK_PATH):
+            ops = _read_queue()
+
+        remote_ids = get_state(REMOTE_IDS_KEY, {})
+        done = set()
+        error = None
+
+        for change in coalesce(ops):
+            try:
+                _send(config, change, remote_ids)
+            except Rejected as e:
+                error = str(e)
+            except requests.HTTPError as e:
+                error = str(e)
+                resp = e.response
+                status = resp.status_code if resp is not None else None
+                if status is None or status == 429 or status >= 500:
+                    break
+                # Any other 4xx will fail in exactly the same way next time
+            except (requests.RequestException, ValueError) as e:
+                error = str(e)
+                break
+
+            done.update(change['ops'])
+            set_state(REMOTE_IDS_KEY, remote_ids)
+
+        with _lock(QUEUE_LOCK_PATH):
+            remaining = [op for op in _read_queue() if op['id'] not in done]
+            with atomic_write(QUEUE_PATH) as f:
+                f.writelines(json.dumps(op) + '\n' for op in remaining)
+
+        set_state(FLUSH_ERROR_KEY, error)
+
+    return len(remaining)
+
+
+def coalesce(ops):
+    '''
+    Turn queued ops into the changes to send to toggl. Each change has the
+    ids of the ops it covers, the local id of the timer and its start op
+    and/or stop time. A start followed by its stop becomes a single change.
+    '''
+    changes = []
+    starts = {}
+
+    for op in ops:
+        if op['op'] == 'start':
+            change = {
+                'ops': [op['id']], 'timer': op['id'],
+                'start': op, 'stop': None,
+            }
+            starts[op['id']] = change
+            changes.append(change)
+        elif op['timer'] in starts:
+            change = starts.pop(op['timer'])
+            change['ops'].append(op['id'])
+            change['stop'] = op
+        else:
+            changes.append({
+                'ops': [op['id']], 'timer': op['timer'],
+                'start': None, 'stop': op,
+            })
+
+    return changes
+
+
+def _send(config, change, remote_ids):
+    '''
+    Send a single change to toggl, recording the toggl id of any timer that
+    is left running in `remote_ids`.
+    '''
+    start, stop = change['start'], change['stop']
+
+    if start is None:
+        remote_id = remote_ids.get(change['timer'])
+        if remote_id is None:
+            # The start was rejected so there is nothing to stop
+            return
+
+        _api_request(config, 'PUT', '{}/{}'.format(
+            TIME_ENTRIES_URL, remote_id
+        ), {'time_entry': {
+            'stop': stop['at'],
+            'duration': _elapsed_ms(stop['start'], stop['at']) // 1000,
+        }})
+        del remote_ids[change['timer']]
+        return
+
+    entry = {
+        'description': start['description'],
+        'pid': _project_id(config, start['project']),
+        'start': start['start'],
+        'created_with': 'pa',
+    }
+
+    if stop is None:
+        # Toggl marks running entries with a negative duration
+        entry['duration'] = -int(_parse_time(start['start']).timestamp())
+    else:
+        duration = _elapsed_ms(start['start'], stop['at']) // 1000
+        if duration < MIN_ENTRY_SECONDS:
+            return
+        entry.update(stop=stop['at'], duration=duration)
+
+    data = _api_request(
+        config, 'POST', TIME_ENTRIES_URL, {'time_entry': entry})
+
+    if stop is None:
+        remote_ids[change['timer']] = data['data']['id']
+
+
+def _project_id(config, name):
+    '''
+    Look up a project id by (case insensitive) name, only asking toggl when
+    we haven't seen the project before.
+    '''
+    projects = get_state(PROJECTS_KEY, {})
+
+    if name.lower() not in projects:
+        url = PROJECTS_URL.format(workspace_id(config))
+        projects = {
+            p['name'].lower(): p['id']
+            for p in _make_request(config, url) or []
+        }
+        set_state(PROJECTS_KEY, projects)
+
+    if name.lower() not in projects:
+        raise Rejected('Unknown toggl project: {}'.format(name))
+
+    return projects[name.lower()]
+
+
+def _api_request(config, method, url, body):
+    '''
+    Send a JSON request to the toggl API
+    '''
+    resp = http_request(
+        method, url, json=body,
+        auth=HTTPBasicAuth(config.toggl.api_token, 'api_token'))
+
+    if not resp.ok:
+        raise requests.HTTPError(
+            '{} {}'.format(resp.status_code, resp.reason), response=resp)
+
+    return resp.json()
+
+
+def _queue_op(op):
+    '''
+    Append an op to the queue, making sure that it has reached the disk.
+    Callers must hold the queue lock.
+    '''
+    with open(QUEUE_PATH, 'a') as f:
+        f.write(json.dumps(op) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _read_queue():
+    '''
+    The ops in the queue, skipping any line left half written by a crash.
+    '''
+    try:
+        with open(QUEUE_PATH, 'r') as f:
+            lines = f.readlines()
+    except FileNotFoundError:
+        return []
+
+    ops = []
+    for line in lines:
+        try:
+            ops.append(json.loads(line))
+        except ValueError:
+            continue
+
+    return ops
+
+
+@contextmanager
+def _lock(path, blocking=True):
+    '''
+    Hold an exclusive lock on a lock file, yielding whether we got it.
+    '''
+    with open(path, 'a') as f:
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(f, flags)
+            locked = True
+        except BlockingIOError:
+            locked = False
+
+        try:
+            yield locked
+        finally:
+            if locked:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _flush_in_background():
+    '''
+    Start a detached pa process to flush the queue so that we don't have to
+    wait on the network.
+    '''
+    try:
+        subprocess.Popen(
+            [sys.executable, '-c', FLUSH_COMMAND],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+    except OSError:
+        # The changes stay queued for the next flush
+        pass
+
+
+def _stop_op(timer, at):
+    return {
+        'op': 'stop', 'id': uuid.uuid4().hex, 'timer': timer['id'],
+        'start': timer['start'], 'at': at,
+    }
+
+
+def _describe(timer):
+    if timer['description']:
+        return '{}: {}'.format(timer['project'], timer['description'])
+    return timer['project']
 
 
-def get_breakdown(config, period):
+def _now():
+    return datetime.now(timezone.utc).replace(microsecond=0).isoformat()
+
+
+def _parse_time(timestamp):
+    return datetime.fromisoformat(timestamp)
+
+
+def _elapsed_ms(start, end):
+    delta = _parse_time(end) - _parse_time(start)
+    return int(delta.total_seconds() * 1000)
+
+
+def get_breakdown(config, period, keys=None):
     '''
     Display a breakdown of the time spent on each project being tracked
-    within the user's toggl account.
+    within the user's toggl account (or grouped by `keys` if given).
     '''
+    today = date.today()
+
     if period in ['d', 'day']:
         period = 'Day'
-        start = date.today()
-        end = start + timedelta(days=1)
+        start = end = today
     elif period in ['w', 'week']:
         period = 'Week'
         start = _monday()
         end = start + timedelta(days=6)
     elif period in ['m', 'month']:
         period = 'Month'
-        start = date.today().replace(day=1)
-        end = start.replace(month=start.month+1)
-    # TODO: work out how to get a full year's worth of data as
-    #       the API pages
-    # elif period in ['y', 'year']:
-    #     period = 'Year'
-    #     _year = date.today().year
-    #     start = date(_year, 1, 1)
-    #     end = date.today()
+        start = today.replace(day=1)
+        end = (start + timedelta(days=31)).replace(day=1) - timedelta(days=1)
+    elif period in ['y', 'year']:
+        period = 'Year'
+        start = date(today.year, 1, 1)
+        end = today
+    elif '..' in period:
+        try:
+            start, end = (date.fromisoformat(d) for d in period.split('..'))
+        except ValueError:
+            print_red('Invalid period')
+            sys.exit(42)
+        period = '{} to {}'.format(start, end)
     else:
         print_red('Invalid period')
         sys.exit(42)
 
-    if period == 'week':
-        monday = _monday()
-        days = {monday + timedelta(days=ix): DAYS[ix] for ix in range(7)}
+    if keys is None:
+        keys = ['project', 'weekday'] if period == 'Week' else ['project']
 
-    data = get_toggl_data(config, start, end)
+    invalid = [k for k in keys if k not in GROUP_SQL]
+    if invalid or not keys:
+        print_red('Invalid grouping: {}. Choose from {}'.format(
+            ', '.join(invalid), ', '.join(GROUP_SQL)))
+        sys.exit(42)
+
+    try:
+        refresh_entries(config, start, end)
+    except (requests.RequestException, ValueError) as e:
+        print_yellow('Unable to refresh time entries from toggl: {}'.format(e))
 
+    groups = group_totals(start, end, keys)
     grand_total = 0
 
-    for k, v in data.items():
-        print_yellow(k)
+    # One heading per value of the first key with the remaining keys (if
+    # there are any) listed underneath it.
+    for heading, rows in groupby(groups, key=lambda g: g[0][0]):
+        print_yellow(heading)
         total = 0
 
-        for d, hrs in sorted(v.items(), key=lambda t: t[0]):
-            mins = int((hrs - int(hrs)) * 60)
-            if period == 'week':
-                print(f'{days[d]}: {int(hrs)} hrs {mins} mins')
-            total += hrs
+        for labels, ms in rows:
+            if len(labels) > 1:
+                print('{}: {}'.format(
+                    ' / '.join(labels[1:]), _hours_and_mins(ms)))
+            total += ms
 
         grand_total += total
-        total_mins = int((total - int(total)) * 60)
 
         print('--')
-        print(f'Total: {int(total)} hrs {total_mins} mins')
+        print('Total: {}'.format(_hours_and_mins(total)))
         print()
 
-    grand_total_mins = int((grand_total - int(grand_total)) * 60)
-    print(f'\n{period} Total: {int(grand_total)} hrs {grand_total_mins} mins')
+    print('\n{} Total: {}'.format(period, _hours_and_mins(grand_total)))
+
+
+def group_totals(start, end, keys):
+    '''
+    Sum the durations of the local time entries that start on the (local)
+    days from start to end inclusive, grouped by the given keys. Returns a
+    sorted list of ((label, ...), ms) with one label per key.
+    '''
+    exprs = [GROUP_SQL[k] for k in keys]
+    columns = ', '.join(exprs)
+
+    # Toggl's idea of the day can differ from ours by up to a day either way
+    # so the indexed range is widened and then filtered on the local day.
+    query = DB.execute_sql(
+        'SELECT {columns}, SUM(dur) FROM {table} '
+        'WHERE start >= ? AND start < ? '
+        "AND date(start, 'localtime') BETWEEN ? AND ? "
+        'GROUP BY {columns} ORDER BY {order}'.format(
+            columns=columns,
+            table=TimeEntry._meta.table_name,
+            order=', '.join('{0} IS NULL, {0}'.format(e) for e in exprs)),
+        ((start - timedelta(1)).isoformat(),
+         (end + timedelta(2)).isoformat(),
+         start.isoformat(),
+         end.isoformat())
+    )
+
+    return [
+        (tuple(_label(k, v) for k, v in zip(keys, row[:-1])), row[-1])
+        for row in query
+    ]
+
+
+def _label(key, value):
+    '''
+    The label to display for a group key
+    '''
+    if value is None:
+        return '(no {})'.format(key)
+    elif key == 'weekday':
+        return DAYS[value]
+    elif key == 'week':
+        year, week, _ = date.fromisoformat(value).isocalendar()
+        return '{}-W{:02}'.format(year, week)
+
+    return str(value)
+
+
+def _hours_and_mins(ms):
+    '''Format a duration in milliseconds'''
+    mins = ms // 60000
+    return '{} hrs {} mins'.format(mins // 60, mins % 60)
 
 
 def _monday():
@@ -177,58 +686,157 @@ def _monday():
             return date(year, month, monday)
 
 
-def _make_request(config, url, params={}):
+def _request_kwargs(config, params={}):
     '''
-    Make an API request
+    The arguments for an API request
     '''
-    api_token = config['toggl']['api_token']
-    headers = {'content-type': 'application/json'}
+    api_token = config.toggl.api_token
     full_params = {'user_agent': 'aardvark'}
     full_params.update(params)
 
-    resp = requests.get(
-        url,
-        params=full_params,
-        headers=headers,
-        auth=HTTPBasicAuth(api_token, 'api_token'),
-    )
+    return {
+        'params': full_params,
+        'headers': {'content-type': 'application/json'},
+        'auth': HTTPBasicAuth(api_token, 'api_token'),
+    }
+
+
+def _make_request(config, url, params={}):
+    '''
+    Make an API request
+    '''
+    resp = http_request('GET', url, **_request_kwargs(config, params))
 
     if not resp.ok:
-        raise requests.HTTPError()
+        raise requests.HTTPError(
+            '{} {}'.format(resp.status_code, resp.reason), response=resp)
 
     return resp.json()
 
 
-def get_toggl_data(config, start, stop):
-    resp = _make_request(config, WORKSPACE_URL)
-    workspace_id = resp[0]['id']
+def workspace_id(config):
+    '''
+    The id of the user's (first) workspace, which only needs looking up once.
+    '''
+    workspace = get_state(WORKSPACE_KEY)
 
-    # Get the week's raw data from toggl
-    params = {
-        'since': start,
-        'until': stop,
-        'workspace_id': workspace_id,
-    }
+    if workspace is None:
+        workspace = _make_request(config, WORKSPACE_URL)[0]['id']
+        set_state(WORKSPACE_KEY, workspace)
+
+    return workspace
 
-    toggl_data = _make_request(config, DATA_URL, params=params)
 
-    # The response is a JSON array of time entries which we flatten into:
-    # {project: {date: total hours (decimal), ...}, ...}
-    data = defaultdict(lambda: defaultdict(float))
+def refresh_entries(config, start, end):
+    '''
+    Make sure that the local TimeEntry table is up to date for the dates from
+    start to end (inclusive). Dates that we have never fetched are always
+    downloaded but only the last REFRESH_DAYS of what we already have are
+    fetched again.
+    '''
+    TimeEntry.create_table(safe=True)
+    covered = get_state(COVERED_KEY)
+    workspace = None
 
-    # Collect all of the time spent each day (in case of multiple entries)
-    for entry in toggl_data['data']:
-        # NOTE: This is discarding the timezone info which will break
-        #       for users far enough away from UTC.
-        entry_date = datetime.strptime(
-            entry['start'].split('T')[0],
-            '%Y-%m-%d'
-        ).date()
+    for since, until in _ranges_to_fetch(covered, start, end):
+        if workspace is None:
+            workspace = workspace_id(config)
+        fetch_entries(config, workspace, since, until)
 
-        # Toggl timer durations are in milliseconds for some reason...
-        duration = entry['dur'] / 1000 / 60 / 60
+    if covered is not None:
+        start = min(start, date.fromisoformat(covered[0]))
+        end = max(end, date.fromisoformat(covered[1]))
 
-        data[entry['project']][entry_date] = round(
-            data[entry['project']][entry_date] + duration, 2)
+    set_state(COVERED_KEY, [start.isoformat(), end.isoformat()])
 
-    return data
+
+def fetch_entries(config, workspace, since, until):
+    '''
+    Replace the local entries between two dates with those from the detailed
+    report API. The first page tells us how many pages there are and the rest
+    are fetched concurrently. Every page is downloaded before anything is
+    written so that the database is only locked for one short transaction
+    (and nothing is changed locally unless every page was fetched).
+    '''
+    fetched = []
+
+    for chunk_since, chunk_until in _chunks(since, until):
+        params = {
+            'workspace_id': workspace,
+            'since': chunk_since.isoformat(),
+            'until': chunk_until.isoformat(),
+            'page': 1,
+        }
+        first = _make_request(config, DATA_URL, params=params)
+        entries = list(first['data'])
+
+        per_page = first.get('per_page') or len(first['data']) or 1
+        pages = math.ceil(first.get('total_count', 0) / per_page)
+        requests_ = [
+            (page, 'GET', DATA_URL,
+             _request_kwargs(config, dict(params, page=page)))
+            for page in range(2, pages + 1)
+        ]
+
+        for page, resp, error in fetch_many(requests_):
+            if error is not None:
+                raise error
+            if not resp.ok:
+                raise requests.HTTPError(
+                    '{} {}'.format(resp.status_code, resp.reason),
+                    response=resp)
+            entries.extend(resp.json()['data'])
+
+        fetched.append((chunk_since, chunk_until, entries))
+
+    with DB.atomic():
+        for chunk_since, chunk_until, entries in fetched:
+            TimeEntry.delete().where(
+                (TimeEntry.start >= chunk_since.isoformat()) &
+                (TimeEntry.start < (chunk_until + timedelta(1)).isoformat())
+            ).execute()
+            _store_entries(entries)
+
+
+def _store_entries(entries):
+    '''
+    Upsert a page of report entries.
+    '''
+    rows = [TimeEntry.from_report(e) for e in entries]
+
+    # Keep well under SQLite's limit on the number of bound variables
+    for i in range(0, len(rows), 100):
+        TimeEntry.insert_many(rows[i:i + 100]).on_conflict_replace().execute()
+
+
+def _ranges_to_fetch(covered, start, end):
+    '''
+    The (since, until) date ranges that need fetching to bring the local
+    entries for start..end up to date, given the range that we have already
+    fetched. The ranges always leave what we have as one contiguous range.
+    '''
+    if covered is None:
+        return [(start, end)]
+
+    have_since, have_until = (date.fromisoformat(d) for d in covered)
+    stale_from = min(have_until, date.today()) - timedelta(REFRESH_DAYS)
+    ranges = []
+
+    if start < have_since:
+        ranges.append((start, have_since - timedelta(1)))
+
+    if end >= stale_from:
+        since = stale_from if start > have_until else max(start, stale_from)
+        ranges.append((max(since, have_since), end))
+
+    return ranges
+
+
+def _chunks(since, until):
+    '''
+    Split a date range into ranges that the reports API will accept.
+    '''
+    while since <= until:
+        chunk_until = min(until, since + timedelta(MAX_REPORT_DAYS - 1))
+        yield since, chunk_until
+        since = chunk_until + timedelta(1)
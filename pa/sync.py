@@ -0,0 +1,133 @@
+'''
+Running the sync functions of each module for `pa --sync`.
+
+Module syncs are almost entirely network (and git) bound so they are run
+concurrently, each on its own thread. A module can declare that its sync has
+to wait for others to finish first by listing them in `SYNC_AFTER` (note
+pushes the TODO files that todo's sync writes for example) and can override
+the default timeout with `SYNC_TIMEOUT` (in seconds).
+
+A failing or hung module doesn't stop the others: it is reported in the
+summary that is printed once everything has finished. Anything that depends
+on a module that timed out is skipped as the module may still be running.
+Timed out threads are abandoned rather than stopped, so `pa --sync` is never
+run by `pa daemon`: its threads end when the process does.
+'''
+import time
+import queue
+import threading
+from collections import namedtuple
+
+from .utils import print_red, print_yellow, print_green
+
+
+SYNC_TIMEOUT = 120
+
+# The outcome of a single module's sync
+SyncResult = namedtuple('SyncResult', ['name', 'status', 'seconds', 'error'])
+
+
+def run_syncs(modules, config, timeout=SYNC_TIMEOUT):
+    '''
+    Run the sync function of each of the given {name: module} concurrently,
+    respecting their SYNC_AFTER constraints. Returns a SyncResult for each
+    module in the order that they finished.
+    '''
+    after = {
+        name: set(getattr(mod, 'SYNC_AFTER', [])) & set(modules)
+        for name, mod in modules.items()
+    }
+    pending = dict(modules)
+    running = {}
+    results = []
+    finished = queue.Queue()
+
+    def start(name, mod):
+        limit = getattr(mod, 'SYNC_TIMEOUT', timeout)
+        thread = threading.Thread(
+            target=_run_one, args=(name, mod, config, finished), daemon=True)
+        running[name] = (time.monotonic(), limit)
+        thread.start()
+
+    def skip(name, reason):
+        del pending[name]
+        results.append(SyncResult(name, 'skipped', 0.0, reason))
+
+    while pending or running:
+        done = {r.name: r.status for r in results}
+
+        for name in sorted(pending):
+            blocked = [d for d in after[name] if done.get(d) == 'timed out']
+            if blocked:
+                skip(name, '{} timed out'.format(', '.join(sorted(blocked))))
+            elif all(d in done for d in after[name]):
+                start(name, pending.pop(name))
+
+        if not running:
+            # Whatever is left is waiting on itself
+            for name in sorted(pending):
+                skip(name, 'circular SYNC_AFTER')
+            break
+
+        now = time.monotonic()
+        wait = min(
+            started + limit - now for started, limit in running.values())
+
+        try:
+            result = finished.get(timeout=max(wait, 0))
+        except queue.Empty:
+            now = time.monotonic()
+            for name, (started, limit) in list(running.items()):
+                if now - started >= limit:
+                    del running[name]
+                    results.append(SyncResult(
+                        name, 'timed out', now - started,
+                        'no result after {}s'.format(limit)))
+            continue
+
+        if result.name in running:
+            # Late results from a module that already timed out are dropped
+            del running[result.name]
+            results.append(result)
+
+    return results
+
+
+def print_summary(results):
+    '''
+    Print how long each module's sync took and whether or not it worked.
+    '''
+    colours = {
+        'ok': print_green,
+        'failed': print_red,
+        'timed out': print_yellow,
+        'skipped': print_yellow,
+    }
+    width = max((len(r.name) for r in results), default=0)
+
+    print()
+    print_green('Sync summary:')
+    for r in sorted(results, key=lambda r: r.name):
+        line = '  {:<{}}  {:<9}  {:6.2f}s'.format(
+            r.name, width, r.status, r.seconds)
+        if r.error:
+            line += '  ({})'.format(r.error)
+        colours[r.status](line)
+
+
+def _run_one(name, mod, config, finished):
+    '''
+    Run a single sync, reporting the outcome on the `finished` queue.
+    '''
+    started = time.monotonic()
+    status, error = 'ok', None
+
+    try:
+        mod.sync(config)
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            status, error = 'failed', 'exited with {}'.format(e.code)
+    except Exception as e:
+        status, error = 'failed', '{}: {}'.format(type(e).__name__, e)
+
+    finished.put(SyncResult(name, status, time.monotonic() - started, error))
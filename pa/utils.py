@@ -2,15 +2,21 @@
 Utility functions and constants for pa
 '''
 import os
+import copy
+import pickle
+import shutil
+import tempfile
+import threading
 import concurrent.futures
+from contextlib import contextmanager
 from datetime import datetime
 
-import toml
-
 
 CONFIG_ROOT = os.path.expanduser('~/.config/pa')
 MOD_DIR = os.path.expanduser('~/.config/pa/user_modules')
 DEFAULT_CONFIG_FILE = os.path.expanduser('~/.config/pa/pa.toml')
+# Pickled copy of the parsed config file, keyed on its path, mtime and size
+CONFIG_CACHE_FILE = os.path.expanduser('~/.config/pa/.pa.toml.cache')
 
 RED = '\033[0;31m'
 GREEN = '\033[0;32m'
@@ -24,6 +30,23 @@ TEMPLATE = '''\
 ### Tags :: {}
 '''
 
+# Defaults for requests made with http_request: (connect, read) timeouts in
+# seconds, retries with exponential backoff for connection errors and
+# transient server errors, and the most requests we make to one host at once.
+HTTP_TIMEOUT = (3.05, 30)
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.5
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
+HTTP_MAX_PER_HOST = 4
+
+# Shared requests.Session (see http_session)
+_HTTP_SESSION = None
+_HTTP_LOCK = threading.Lock()
+# Per host semaphores limiting concurrent requests
+_HOST_SLOTS = {}
+# Parsed configs for this process as {path: ((mtime, size), config)}
+_CONFIGS = {}
+
 DEFAULT_CONFIG = {
     'general': {
         'ag_enabled': False,
@@ -31,6 +54,7 @@ DEFAULT_CONFIG = {
     },
     'note': {
         'note_root': '~/notes',
+        'index_enabled': True,
     },
     'todoist': {
         'enabled': False,
@@ -43,23 +67,52 @@ DEFAULT_CONFIG = {
     'mail': {
         'enabled': False,
         'oath2': False,
+        # Seconds before the local message cache is refreshed from the server
+        'cache_ttl': 60,
+        # How many of the newest messages to cache when first syncing a folder
+        'initial_sync': 500,
         'accounts': {},
     },
     'cal': {
         'enabled': False,
-    }
+        'calendars': {},
+    },
+    'spotify': {},
 }
 
 
+class Section(dict):
+    '''
+    A section of the pa config. This is a plain dictionary that also allows
+    attribute access to its keys so that modules can do:
+    >>> config.todoist.api_token
+
+    Sections are shared between callers of `get_config` so treat them as read
+    only.
+    '''
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key) from None
+
+    def path(self, key):
+        '''Look up a file system path, expanding `~`.'''
+        return os.path.expanduser(self[key])
+
+
 def get_config(path=DEFAULT_CONFIG_FILE):
     '''
-    Read user config from the config dotfile and return as a dictionary. The
+    Read user config from the config dotfile and return it as a Section. The
     config file is found at `~/.config/pa/pa.toml` and is a standard toml file.
+    Values from the file are deep merged over a fresh copy of DEFAULT_CONFIG.
+
+    The result is memoized for the lifetime of the process and the parsed file
+    is cached on disk, both keyed on the mtime and size of the config file, so
+    repeated calls are cheap and edits to the file are still picked up.
 
     NOTE: This will create the config directory if it does not already exist.
     '''
-    config = DEFAULT_CONFIG
-
     if not os.path.isdir(CONFIG_ROOT):
         # Do a full init of the config dir in this case. This means that we
         # don't attempt a partial init if the user has created the directory
@@ -67,12 +120,85 @@ def get_config(path=DEFAULT_CONFIG_FILE):
         init_config_dir(CONFIG_ROOT)
 
     config_path = os.path.expanduser(path)
-    from_file = toml.load(config_path)
-    config.update(from_file)
+    stat = os.stat(config_path)
+    key = (stat.st_mtime_ns, stat.st_size)
+
+    memo = _CONFIGS.get(config_path)
+    if memo is not None and memo[0] == key:
+        return memo[1]
+
+    from_file = _load_config_file(config_path, key)
+    config = _as_section(merge_config(DEFAULT_CONFIG, from_file))
+    _CONFIGS[config_path] = (key, config)
 
     return config
 
 
+def merge_config(defaults, overrides):
+    '''
+    Recursively merge `overrides` into a copy of `defaults`, leaving both of
+    the inputs unmodified.
+    '''
+    merged = copy.deepcopy(defaults)
+
+    for k, v in overrides.items():
+        if isinstance(v, dict) and isinstance(merged.get(k), dict):
+            merged[k] = merge_config(merged[k], v)
+        else:
+            merged[k] = copy.deepcopy(v)
+
+    return merged
+
+
+def _as_section(d):
+    '''Convert nested dictionaries into Sections.'''
+    return Section(
+        (k, _as_section(v) if isinstance(v, dict) else v)
+        for k, v in d.items()
+    )
+
+
+def _plain(value):
+    '''
+    Convert the dict subclasses that toml uses for inline tables into plain
+    dictionaries so that the parsed config can be pickled.
+    '''
+    if isinstance(value, dict):
+        return {k: _plain(v) for k, v in value.items()}
+    elif isinstance(value, list):
+        return [_plain(v) for v in value]
+
+    return value
+
+
+def _load_config_file(config_path, key, cache_path=CONFIG_CACHE_FILE):
+    '''
+    Parse the toml config file, using the pickled copy from a previous run if
+    the file has not changed since.
+    '''
+    try:
+        with open(cache_path, 'rb') as f:
+            cached = pickle.load(f)
+        if cached['path'] == config_path and cached['key'] == key:
+            return cached['config']
+    except Exception:
+        # Missing, corrupt or from an older version of pa: just re-parse
+        pass
+
+    # Imported here so that runs with a warm cache never need it
+    import toml
+    from_file = _plain(toml.load(config_path))
+
+    try:
+        with atomic_write(cache_path, 'wb') as f:
+            pickle.dump(
+                {'path': config_path, 'key': key, 'config': from_file}, f)
+    except OSError:
+        pass
+
+    return from_file
+
+
 def init_config_dir(config_dir=CONFIG_ROOT):
     '''
     Create all of the default config directories and files.
@@ -92,8 +218,41 @@ def write_default_config_file(path=DEFAULT_CONFIG_FILE):
     '''
     Write out the default config to `path` in toml format.
     '''
+    import toml
+
     config_path = os.path.expanduser(path)
-    toml.dump(DEFAULT_CONFIG, config_path)
+    with open(config_path, 'w') as f:
+        toml.dump(DEFAULT_CONFIG, f)
+
+
+@contextmanager
+def atomic_write(path, mode='w', errors=None):
+    '''
+    Open a temporary file alongside `path` for writing and rename it over
+    `path` once the block exits cleanly. A crash part way through writing
+    leaves the original file untouched rather than truncated. `errors` is
+    passed on to open for text modes.
+    '''
+    path = os.path.expanduser(path)
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.pa-tmp-')
+
+    try:
+        with os.fdopen(fd, mode, errors=errors) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+
+        if os.path.exists(path):
+            shutil.copymode(path, tmp_path)
+        else:
+            os.chmod(tmp_path, 0o644)
+
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
 
 
 def today():
@@ -120,6 +279,81 @@ def print_green(s, end='\n'):
     print('{}{}{}'.format(GREEN, s, NC), end=end)
 
 
+def http_session():
+    '''
+    A process wide requests.Session so that repeated API calls (and repeated
+    commands when running under `pa daemon`) re-use open connections.
+
+    Idempotent requests are retried with backoff on connection errors and
+    transient server errors (honouring Retry-After) and enough connections
+    are kept open to each host for HTTP_MAX_PER_HOST concurrent requests.
+    Responses are compressed if the server supports it (requests asks for
+    gzip and deflate by default).
+    '''
+    global _HTTP_SESSION
+
+    with _HTTP_LOCK:
+        if _HTTP_SESSION is None:
+            # Imported here as most commands never touch the network
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+
+            retry = Retry(
+                total=HTTP_RETRIES,
+                backoff_factor=HTTP_BACKOFF,
+                status_forcelist=HTTP_RETRY_STATUSES,
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(
+                pool_connections=10,
+                pool_maxsize=HTTP_MAX_PER_HOST,
+                max_retries=retry,
+            )
+
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _HTTP_SESSION = session
+
+    return _HTTP_SESSION
+
+
+def http_request(method, url, **kwargs):
+    '''
+    Make a request using the shared session, with a default timeout and no
+    more than HTTP_MAX_PER_HOST requests in flight to any one host. Takes
+    the same arguments as requests.Session.request.
+    '''
+    from urllib.parse import urlsplit
+
+    host = urlsplit(url).netloc
+    with _HTTP_LOCK:
+        slots = _HOST_SLOTS.setdefault(
+            host, threading.BoundedSemaphore(HTTP_MAX_PER_HOST))
+
+    kwargs.setdefault('timeout', HTTP_TIMEOUT)
+    session = http_session()
+
+    with slots:
+        return session.request(method, url, **kwargs)
+
+
+def fetch_many(requests, max_threads=10):
+    '''
+    Make several requests concurrently, yielding (tag, response, exception)
+    as each one completes. `requests` is a list of (tag, method, url, kwargs)
+    and the per host limit of http_request still applies.
+    '''
+    def fetch(method, url, kwargs):
+        return http_request(method, url, **kwargs)
+
+    tag_args = [
+        (tag, (method, url, kwargs)) for tag, method, url, kwargs in requests
+    ]
+    yield from iter_many_tagged(fetch, tag_args, max_threads)
+
+
 def run_many(func, args_list, max_threads=10, fail_quiet=False):
     '''
     Run a function multiple times with different inputs,
@@ -153,30 +387,40 @@ def run_many_tagged(func, tag_args, max_threads=10, fail_quiet=False):
     Run a function multiple times with different inputs,
     each on its own thread. Intended for use with blocking IO
     '''
-    def tagged(tag, func):
-        '''Helper to maintain tags'''
-        def _inner(*args):
-            return tag, func(*args)
-        return _inner
-
     results = {}
+
+    for tag, res, error in iter_many_tagged(func, tag_args, max_threads):
+        if error is not None:
+            if fail_quiet:
+                continue
+            raise error
+
+        if res:
+            results[tag] = res
+
+    return results
+
+
+def iter_many_tagged(func, tag_args, max_threads=10):
+    '''
+    Run a function multiple times with different inputs, each on its own
+    thread, yielding (tag, result, exception) as each call finishes so that
+    callers can process results as they arrive. Exceptions are returned
+    rather than raised so that one failure doesn't lose the other results.
+    '''
+    if not tag_args:
+        return
+
     max_workers = min([max_threads, len(tag_args)])
 
     with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as ex:
-        futures = (
-            ex.submit(tagged(tag, func), *args)
+        futures = {
+            ex.submit(func, *args): tag
             for (tag, args) in tag_args
-        )
+        }
 
         for f in concurrent.futures.as_completed(futures):
             try:
-                tag, res = f.result()
-                if res:
-                    results[tag] = res
+                yield futures[f], f.result(), None
             except Exception as e:
-                if fail_quiet:
-                    pass
-                else:
-                    raise e
-
-    return results
+                yield futures[f], None, e
@@ -17,6 +17,7 @@ setup(
         'icalendar',
         'keyring',
         'peewee',
+        'python-dateutil',
         'pytz',
         'requests',
         'toml',
@@ -0,0 +1,14 @@
+import pytest
+
+from pa.db import DB
+
+
+@pytest.fixture
+def db():
+    '''
+    Point the pa database at a fresh in-memory SQLite database for the test.
+    '''
+    DB.init(':memory:')
+    DB.connect(reuse_if_open=True)
+    yield DB
+    DB.close()
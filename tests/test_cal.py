@@ -0,0 +1,151 @@
+'''
+Expansion of recurring events from the calendar cache.
+'''
+from datetime import datetime
+
+import pytest
+from dateutil import tz
+
+from pa.modules import cal
+
+LONDON = tz.gettz('Europe/London')
+
+
+def feed(*events):
+    body = '\n'.join(
+        'BEGIN:VEVENT\n{}\nEND:VEVENT'.format(e.strip()) for e in events)
+    text = 'BEGIN:VCALENDAR\nVERSION:2.0\nPRODID:-//pa//tests//EN\n{}\n' \
+        'END:VCALENDAR\n'.format(body)
+    return text.replace('\n', '\r\n').encode()
+
+
+class Response:
+    status_code = 200
+    ok = True
+    headers = {}
+
+    def __init__(self, content):
+        self.content = content
+
+
+@pytest.fixture
+def cache(db, monkeypatch):
+    '''
+    A function that queries the cache for the calendar "test", along with
+    `load` to fill the cache from a feed the way refresh_feed does.
+    '''
+    cal._RULESETS.clear()
+    cal.init_cache()
+
+    def load(content):
+        monkeypatch.setattr(
+            cal, 'http_request', lambda *args, **kwargs: Response(content))
+        cal.refresh_feed('test', 'https://example.com/test.ics')
+
+    def query(start, end):
+        events = cal.cached_events(['test'], start, end).get('test', [])
+        return [(e.start.astimezone(LONDON), e.summary) for e in events]
+
+    query.load = load
+    return query
+
+
+def local(*args):
+    return datetime(*args, tzinfo=LONDON)
+
+
+def test_count(cache):
+    cache.load(feed('''
+UID:count@test
+SUMMARY:Standup
+DTSTART;TZID=Europe/London:20240101T100000
+DTEND;TZID=Europe/London:20240101T101500
+RRULE:FREQ=WEEKLY;COUNT=3
+'''))
+
+    assert cache(local(2023, 12, 1), local(2024, 3, 1)) == [
+        (local(2024, 1, 1, 10), 'Standup'),
+        (local(2024, 1, 8, 10), 'Standup'),
+        (local(2024, 1, 15, 10), 'Standup'),
+    ]
+    # The series is bounded so it has a real end in the index
+    [row] = cal.CalEvent.select()
+    assert row.end_ts == int(local(2024, 1, 15, 10, 15).timestamp())
+
+
+def test_exdate(cache):
+    cache.load(feed('''
+UID:exdate@test
+SUMMARY:Gym
+DTSTART;TZID=Europe/London:20240205T070000
+DTEND;TZID=Europe/London:20240205T080000
+RRULE:FREQ=DAILY;COUNT=5
+EXDATE;TZID=Europe/London:20240207T070000,20240208T070000
+'''))
+
+    assert [d.day for d, _ in cache(local(2024, 2, 1), local(2024, 3, 1))] \
+        == [5, 6, 9]
+
+
+def test_overridden_and_cancelled_instances(cache):
+    cache.load(feed('''
+UID:series@test
+SUMMARY:1:1
+DTSTART;TZID=Europe/London:20240603T140000
+DTEND;TZID=Europe/London:20240603T143000
+RRULE:FREQ=WEEKLY
+''', '''
+UID:series@test
+RECURRENCE-ID;TZID=Europe/London:20240610T140000
+SUMMARY:1:1 (moved)
+DTSTART;TZID=Europe/London:20240611T160000
+DTEND;TZID=Europe/London:20240611T163000
+''', '''
+UID:series@test
+RECURRENCE-ID;TZID=Europe/London:20240617T140000
+STATUS:CANCELLED
+SUMMARY:1:1
+DTSTART;TZID=Europe/London:20240617T140000
+DTEND;TZID=Europe/London:20240617T143000
+'''))
+
+    assert cache(local(2024, 6, 1), local(2024, 6, 30)) == [
+        (local(2024, 6, 3, 14), '1:1'),
+        (local(2024, 6, 11, 16), '1:1 (moved)'),
+        (local(2024, 6, 24, 14), '1:1'),
+    ]
+
+
+def test_dst_crossing_keeps_local_time(cache):
+    cache.load(feed('''
+UID:dst@test
+SUMMARY:Coffee
+DTSTART;TZID=Europe/London:20240329T090000
+DTEND;TZID=Europe/London:20240329T091000
+RRULE:FREQ=DAILY;UNTIL=20240402T090000
+'''))
+
+    found = cache(local(2024, 3, 28), local(2024, 4, 10))
+
+    # 09:00 local every day, both sides of the clocks going forward on the
+    # 31st, and the local UNTIL includes the last day.
+    assert [(d.day, d.hour) for d, _ in found] == [
+        (29, 9), (30, 9), (31, 9), (1, 9), (2, 9)
+    ]
+    assert [d.utcoffset().total_seconds() // 3600 for d, _ in found] == [
+        0, 0, 1, 1, 1
+    ]
+
+
+def test_only_occurrences_in_range_are_expanded(cache):
+    cache.load(feed('''
+UID:forever@test
+SUMMARY:Bins
+DTSTART;TZID=Europe/London:20200101T080000
+DTEND;TZID=Europe/London:20200101T081500
+RRULE:FREQ=WEEKLY;BYDAY=WE
+'''))
+
+    # An occurrence that started before the range but overlaps it counts
+    found = cache(local(2024, 1, 3, 8, 10), local(2024, 1, 20))
+    assert [d.day for d, _ in found] == [3, 10, 17]
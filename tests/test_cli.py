@@ -0,0 +1,106 @@
+'''
+Dispatching commands to the daemon or running them in-process, and showing
+the help for a sub-command.
+'''
+from types import SimpleNamespace
+
+import pytest
+
+from pa import cli, manifest
+
+
+MANIFEST = {
+    'mail': {'long_running': ['watch']},
+    'note': {'long_running': []},
+}
+
+
+@pytest.fixture
+def dispatch(monkeypatch):
+    '''
+    Record whether `cli.main` forwards each command to a (fake) daemon or
+    runs it in-process.
+    '''
+    def forward(argv):
+        dispatch.calls.append(('daemon', argv))
+        return 0
+
+    def run(argv):
+        dispatch.calls.append(('local', argv))
+
+    monkeypatch.setattr(cli, 'get_manifest', lambda mod_dir: MANIFEST)
+    monkeypatch.setattr(cli.daemon, 'forward', forward)
+    monkeypatch.setattr(cli, 'run', run)
+    dispatch.calls = []
+    return dispatch
+
+
+@pytest.mark.parametrize('argv, where', [
+    (['note', '-g', 'milk'], 'daemon'),
+    (['mail', 'watch'], 'local'),
+    (['mail', '--account=work', 'watch'], 'local'),
+    (['--sync'], 'local'),
+    (['-s'], 'local'),
+    (['--version'], 'local'),
+    (['daemon', 'status'], 'local'),
+])
+def test_main_dispatch(dispatch, argv, where):
+    try:
+        cli.main(argv)
+    except SystemExit:
+        pass
+
+    assert dispatch.calls == [(where, argv)]
+
+
+@pytest.fixture
+def command(monkeypatch, tmp_path, capsys):
+    '''
+    Run commands through `cli.run` against the built-in modules, recording
+    which modules are imported and the arguments each one is run with.
+    '''
+    def get_manifest(mod_dir):
+        return manifest.get_manifest(mod_dir, str(tmp_path / 'manifest.json'))
+
+    def load(entry):
+        command.loaded.append(entry['name'])
+        return SimpleNamespace(__doc__=entry['doc'], run=command.runs.append)
+
+    def run(argv):
+        try:
+            cli.run(argv)
+        except SystemExit:
+            pass
+        return capsys.readouterr().out
+
+    monkeypatch.setattr(cli, 'get_manifest', get_manifest)
+    monkeypatch.setattr(cli, '_load_or_report', load)
+    command.loaded = []
+    command.runs = []
+    command.run = run
+    return command
+
+
+@pytest.mark.parametrize('argv', [
+    ['note', '--help'],
+    ['note', '-h'],
+    ['todo', '--todoist', '-h'],
+])
+def test_help_without_importing_the_module(command, argv):
+    out = command.run(argv)
+
+    assert out.startswith('pa {} - '.format(argv[0]))
+    assert command.loaded == []
+
+
+@pytest.mark.parametrize('argv, key, value', [
+    (['note', '--grep', '-h'], '--grep', '-h'),
+    (['todo', '--todoist', '--match', '--help'], '--match', '--help'),
+    (['todo', '--todoist', '--match=-h'], '--match', '-h'),
+])
+def test_help_flags_as_values_run_the_command(command, argv, key, value):
+    command.run(argv)
+
+    assert command.loaded == [argv[0]]
+    [args] = command.runs
+    assert args[key] == value
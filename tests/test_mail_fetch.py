@@ -0,0 +1,103 @@
+'''
+Parsing of IMAP FETCH responses. The data below is what imaplib hands back
+from client.uid('FETCH', ...): bytes for plain response lines and
+(text, literal) tuples where the server sent a {n} literal.
+'''
+from pa.modules.mail import _find_text_part, _parse_fetch, _tokenize
+
+
+def test_tokenize_atoms_quoted_and_nil():
+    tokens = _tokenize(b'UID 12 FLAGS (\\Seen \\Answered) X NIL "a b"')
+
+    assert [t for t in tokens if isinstance(t, str) or t is None] == [
+        'UID', '12', 'FLAGS', '\\Seen', '\\Answered', 'X', None, 'a b'
+    ]
+
+
+def test_tokenize_keeps_section_specs_as_one_atom():
+    tokens = _tokenize(b'BODY[HEADER.FIELDS (FROM SUBJECT)] {57}')
+
+    # The literal marker is dropped as the literal follows separately
+    assert tokens == ['BODY[HEADER.FIELDS (FROM SUBJECT)]']
+
+
+def test_tokenize_escaped_quotes():
+    tokens = _tokenize(b'"say \\"hi\\" \\\\ bye"')
+
+    assert tokens == ['say "hi" \\ bye']
+
+
+def test_literal_inside_bodystructure():
+    data = [
+        (b'1 (UID 7 BODYSTRUCTURE (("text" "plain" ("charset" "utf-8") NIL '
+         b'NIL "7bit" 12 1 NIL NIL NIL NIL)("application" "pdf" '
+         b'("name" {9}', b'a (b).pdf'),
+        b') NIL NIL "base64" 1000 NIL ("attachment" ("filename" "a.pdf")) '
+        b'NIL NIL) "mixed" ("boundary" "b1") NIL NIL NIL) FLAGS (\\Seen))',
+    ]
+
+    [msg] = _parse_fetch(data)
+
+    assert msg['UID'] == '7'
+    assert msg['FLAGS'] == ['\\Seen']
+    text, pdf = msg['BODYSTRUCTURE'][:2]
+    assert text[:2] == ['text', 'plain']
+    # Literals stay as bytes and don't upset the nesting around them
+    assert pdf[2] == ['name', b'a (b).pdf']
+    assert pdf[5:7] == ['base64', '1000']
+    assert pdf[8] == ['attachment', ['filename', 'a.pdf']]
+    assert msg['BODYSTRUCTURE'][2:4] == ['mixed', ['boundary', 'b1']]
+
+    part = _find_text_part(msg['BODYSTRUCTURE'])
+    assert (part.section, part.subtype, part.charset) == (
+        '1', 'plain', 'utf-8')
+
+
+def test_multi_line_literal():
+    header = (b'From: Someone <someone@example.com>\r\n'
+              b'Subject: Lunch (today)\r\n\r\n')
+    data = [
+        (b'1 (UID 3 FLAGS () BODY[HEADER.FIELDS (FROM SUBJECT)] {%d}'
+         % len(header), header),
+        b')',
+        (b'2 (UID 4 FLAGS (\\Seen) BODY[HEADER.FIELDS (FROM SUBJECT)] {2}',
+         b'\r\n'),
+        b')',
+    ]
+
+    first, second = _parse_fetch(data)
+
+    assert first['UID'] == '3'
+    assert first['FLAGS'] == []
+    assert first['BODY[HEADER.FIELDS (FROM SUBJECT)]'] == header
+    assert second['UID'] == '4'
+    assert second['BODY[HEADER.FIELDS (FROM SUBJECT)]'] == b'\r\n'
+
+
+def test_fetch_without_flags():
+    data = [
+        b'5 (UID 20 BODYSTRUCTURE ("text" "html" ("charset" "iso-8859-1") '
+        b'NIL NIL "quoted-printable" 2048 40 NIL NIL NIL NIL))',
+    ]
+
+    [msg] = _parse_fetch(data)
+
+    assert 'FLAGS' not in msg
+    assert msg['BODYSTRUCTURE'][3:5] == [None, None]
+
+    part = _find_text_part(msg['BODYSTRUCTURE'])
+    assert (part.section, part.subtype) == ('TEXT', 'html')
+    assert (part.encoding, part.charset) == ('quoted-printable', 'iso-8859-1')
+
+
+def test_skips_unsolicited_and_empty_lines():
+    data = [
+        None,
+        b'1 (UID 1 FLAGS (\\Seen))',
+        b'2 (FLAGS (\\Deleted) UID 2)',
+    ]
+
+    assert _parse_fetch(data) == [
+        {'UID': '1', 'FLAGS': ['\\Seen']},
+        {'FLAGS': ['\\Deleted'], 'UID': '2'},
+    ]
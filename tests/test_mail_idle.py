@@ -0,0 +1,65 @@
+'''
+Waiting for changes with IMAP IDLE, against a fake server on a socket pair.
+'''
+import socket
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from pa.modules import mail
+
+
+@pytest.fixture
+def server():
+    '''
+    A MailBox talking to a fake server that sends `server.greeting` in a
+    single write as soon as IDLE starts and completes the command on DONE.
+    '''
+    ours, theirs = socket.socketpair()
+    ours.settimeout(5)
+    client = SimpleNamespace(
+        sock=ours,
+        file=ours.makefile('rb'),
+        send=ours.sendall,
+        tagged_commands={},
+        _new_tag=lambda: b'A1',
+    )
+    client.readline = client.file.readline
+    box = mail.MailBox.__new__(mail.MailBox)
+    box.client = client
+
+    def serve():
+        f = theirs.makefile('rb')
+        assert f.readline() == b'A1 IDLE\r\n'
+        theirs.sendall(server.greeting)
+        assert f.readline() == b'DONE\r\n'
+        theirs.sendall(b'A1 OK IDLE terminated\r\n')
+
+    thread = threading.Thread(target=serve, daemon=True)
+    server.box = box
+    server.start = thread.start
+    yield server
+    thread.join(5)
+    ours.close()
+    theirs.close()
+
+
+def test_idle_sees_a_change_sent_with_the_go_ahead(server):
+    # The change is already in imaplib's buffer where select can't see it
+    server.greeting = b'+ idling\r\n* 3 EXISTS\r\n'
+    server.start()
+
+    started = time.monotonic()
+    responses = server.box.idle(timeout=3)
+
+    assert responses == [b'* 3 EXISTS\r\n']
+    assert time.monotonic() - started < 1
+
+
+def test_idle_times_out_without_changes(server):
+    server.greeting = b'+ idling\r\n'
+    server.start()
+
+    assert server.box.idle(timeout=0.2) == []
@@ -0,0 +1,164 @@
+'''
+Scanning raw messages for MIME parts and decoding the selected text part.
+'''
+from pa.modules.mail import TextPart, _decode_part, _mime_parts, get_body
+
+
+def crlf(text):
+    return text.replace('\n', '\r\n').encode()
+
+
+NESTED = crlf('''\
+From: a@example.com
+Subject: nested
+MIME-Version: 1.0
+Content-Type: multipart/mixed; boundary="outer"
+
+This is a multi-part message in MIME format.
+--outer
+Content-Type: multipart/alternative; boundary="inner"
+
+--inner
+Content-Type: text/plain; charset="utf-8"
+
+plain body
+--inner
+Content-Type: text/html; charset="utf-8"
+
+<p>html body</p>
+--inner--
+--outer
+Content-Type: application/pdf
+Content-Disposition: attachment; filename="a.pdf"
+Content-Transfer-Encoding: base64
+
+JVBERi0xLjQK
+--outer--
+epilogue
+''')
+
+
+def parts(raw):
+    return [
+        (headers.get_content_type(), raw[start:end])
+        for headers, start, end in _mime_parts(raw)
+    ]
+
+
+def test_nested_multipart():
+    assert parts(NESTED) == [
+        ('text/plain', b'plain body'),
+        ('text/html', b'<p>html body</p>'),
+        ('application/pdf', b'JVBERi0xLjQK'),
+    ]
+    assert get_body(NESTED) == 'plain body'
+
+
+def test_boundary_inside_body_lines():
+    raw = crlf('''\
+Content-Type: multipart/mixed; boundary="b1"
+
+--b1
+Content-Type: text/plain
+
+a line mentioning --b1 in passing
+--b1-not-a-delimiter
+ --b1
+--b1
+Content-Type: text/plain
+
+second
+--b1--
+''')
+
+    assert parts(raw) == [
+        ('text/plain', crlf('''\
+a line mentioning --b1 in passing
+--b1-not-a-delimiter
+ --b1''')),
+        ('text/plain', b'second'),
+    ]
+
+
+def test_missing_closing_boundary():
+    raw = crlf('''\
+Content-Type: multipart/mixed; boundary="b1"
+
+--b1
+Content-Type: text/html
+
+<b>first</b>
+--b1
+Content-Type: text/plain
+
+cut off part way thr''')
+
+    assert parts(raw) == [
+        ('text/html', b'<b>first</b>'),
+        ('text/plain', b'cut off part way thr'),
+    ]
+    assert get_body(raw) == 'cut off part way thr'
+
+
+def test_single_part_without_headers():
+    raw = b'\r\njust a body'
+
+    assert parts(raw) == [('text/plain', b'just a body')]
+
+
+def test_html_used_when_there_is_no_plain_part():
+    raw = crlf('''\
+Content-Type: multipart/alternative; boundary="b1"
+
+--b1
+Content-Type: text/html; charset=utf-8
+
+<html><body><p>Hello</p><p>there</p></body></html>
+--b1--
+''')
+
+    assert get_body(raw) == 'Hello\nthere'
+
+
+def test_quoted_printable_with_charset():
+    raw = crlf('''\
+Content-Type: text/plain; charset="iso-8859-1"
+Content-Transfer-Encoding: quoted-printable
+
+Caf=E9 au lait, s'il vous pla=EEt. A long line that is soft=
+ wrapped.
+''')
+
+    assert get_body(raw, full=True) == (
+        "Café au lait, s'il vous plaît. "
+        "A long line that is soft wrapped.\r\n")
+
+
+def test_base64_with_charset():
+    raw = crlf('''\
+Content-Type: multipart/mixed; boundary=zz
+
+--zz
+Content-Type: text/plain; charset=utf-8
+Content-Transfer-Encoding: base64
+
+wqFIb2xhLCBzZcOxb3Ih
+--zz--
+''')
+
+    assert get_body(raw) == '¡Hola, señor!'
+
+
+def test_decode_truncated_parts():
+    # Partial fetches can cut base64 mid-quantum and qp mid-escape
+    b64 = TextPart(None, 'plain', 'base64', 'utf-8')
+    qp = TextPart(None, 'plain', 'quoted-printable', 'utf-8')
+
+    assert _decode_part(b'wqFIb2xhLCBzZcOxb3Ih'[:-3], b64) == '¡Hola, señ'
+    assert _decode_part(b'na=C3=AFve=C', qp) == 'naïve'
+
+
+def test_unknown_charset_falls_back_to_utf8():
+    part = TextPart(None, 'plain', '8bit', 'x-made-up')
+
+    assert _decode_part('naïve'.encode(), part) == 'naïve'
@@ -0,0 +1,72 @@
+'''
+Note search: the usage text and the grep fallback.
+'''
+import pytest
+from docopt import docopt
+
+from pa.modules import note
+
+
+@pytest.mark.parametrize('argv, expected', [
+    (['--find', 'milk'], {'--find': 'milk', '--tag': None}),
+    (['-f', 'milk', '-t', 'shopping'],
+     {'--find': 'milk', '--tag': 'shopping'}),
+    (['--find', 'oat milk', '--tag', 'shopping'],
+     {'--find': 'oat milk', '--tag': 'shopping'}),
+    (['--grep', 'mi.k'], {'--grep': 'mi.k', '--find': None}),
+    (['shopping list'], {'<title>': 'shopping list', '--find': None}),
+])
+def test_usage(argv, expected):
+    args = docopt(note.__doc__, argv=['note'] + argv)
+    assert {k: args[k] for k in expected} == expected
+
+
+@pytest.mark.parametrize('content, pattern, expected', [
+    (b'one\ntwo\n\nfour\n', '^', [1, 2, 3, 4]),
+    (b'one\ntwo\n\nfour\n', 'x*', [1, 2, 3, 4]),
+    (b'one\ntwo\n\nfour', '$', [1, 2, 3, 4]),
+    (b'one\ntwo\n\nfour\n', '^$', [3]),
+    (b'milk\nbread\nmilk and bread\n', 'milk', [1, 3]),
+])
+def test_grep_file_line_numbers(tmp_path, content, pattern, expected):
+    path = tmp_path / 'note.md'
+    path.write_bytes(content)
+
+    hits = note._grep_file(str(path), pattern)
+
+    assert [lno for lno, _ in hits] == expected
+
+
+def write(path, text):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text)
+
+
+def test_grep_files_gitignore_stops_at_the_notes_root(tmp_path):
+    # Nothing above the notes root applies unless it is in the same repo
+    write(tmp_path / '.gitignore', '*.md\n')
+    root = tmp_path / 'home' / 'notes'
+    write(root / '.gitignore', 'drafts/\n')
+    write(root / 'notes' / 'a.md', 'a')
+    write(root / 'notes' / 'drafts' / 'b.md', 'b')
+    write(root / 'notes' / 'sub' / '.gitignore', 'c.md\n')
+    write(root / 'notes' / 'sub' / 'c.md', 'c')
+
+    assert sorted(note._grep_files(str(root / 'notes'), str(root))) == [
+        str(root / 'notes' / 'a.md'),
+    ]
+
+
+def test_grep_files_gitignore_stops_at_the_repo_root(tmp_path):
+    write(tmp_path / '.gitignore', '*.md\n')
+    repo = tmp_path / 'repo'
+    (repo / '.git').mkdir(parents=True)
+    write(repo / '.gitignore', 'private.md\n')
+    write(repo / 'notes' / 'a.md', 'a')
+    write(repo / 'notes' / 'private.md', 'b')
+
+    assert sorted(note._grep_files(str(repo / 'notes'), str(repo))) == [
+        str(repo / 'notes' / 'a.md'),
+    ]
+    assert note._gitignore_patterns(str(repo / 'notes'), str(tmp_path)) \
+        == [(str(repo), 'private.md')]
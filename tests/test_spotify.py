@@ -0,0 +1,152 @@
+'''
+`pa spotify watch` and the state file it leaves for other commands, run
+against a fake session bus.
+'''
+import importlib
+import json
+import os
+import subprocess
+import sys
+import types
+
+import pytest
+
+
+BUS_NAME = 'org.mpris.MediaPlayer2.spotify'
+PLAYER_IFACE = 'org.mpris.MediaPlayer2.Player'
+
+
+class DBusException(Exception):
+    def get_dbus_name(self):
+        return 'org.freedesktop.DBus.Error.ServiceUnknown'
+
+
+class Player:
+    def __init__(self, props):
+        self.props = props
+
+    def GetAll(self, interface, dbus_interface):
+        return self.props
+
+
+class SessionBus:
+    '''
+    Just enough of a dbus connection for `watch`. Running the main loop
+    calls `script` with the signal handlers that were registered.
+    '''
+    def __init__(self, mainloop=None, private=False):
+        self.handlers = {}
+        SessionBus.bus = self
+
+    def add_signal_receiver(self, handler, signal_name, **kwargs):
+        self.handlers[signal_name] = handler
+
+    def watch_name_owner(self, name, handler):
+        assert name == BUS_NAME
+        self.handlers['NameOwnerChanged'] = handler
+
+    def get_object(self, bus_name, path, introspect=True):
+        return Player(SessionBus.props)
+
+
+class MainLoop:
+    def run(self):
+        SessionBus.script(SessionBus.bus.handlers)
+        raise KeyboardInterrupt
+
+
+@pytest.fixture
+def spotify(monkeypatch, tmp_path):
+    '''
+    Import the spotify module with fake dbus and GLib modules in place and
+    its state file in a temporary directory.
+    '''
+    dbus = types.ModuleType('dbus')
+    dbus.SessionBus = SessionBus
+    dbus.exceptions = types.SimpleNamespace(DBusException=DBusException)
+    glib = types.SimpleNamespace(DBusGMainLoop=lambda: None)
+    gi = types.SimpleNamespace(GLib=types.SimpleNamespace(MainLoop=MainLoop))
+
+    monkeypatch.setitem(sys.modules, 'dbus', dbus)
+    monkeypatch.setitem(sys.modules, 'dbus.mainloop', types.ModuleType('m'))
+    monkeypatch.setitem(sys.modules, 'dbus.mainloop.glib', glib)
+    monkeypatch.setitem(sys.modules, 'gi', types.ModuleType('gi'))
+    monkeypatch.setitem(sys.modules, 'gi.repository', gi)
+    monkeypatch.delitem(sys.modules, 'pa.modules.spotify', raising=False)
+
+    module = importlib.import_module('pa.modules.spotify')
+    monkeypatch.setattr(module, 'STATE_PATH', str(tmp_path / 'spotify.json'))
+    yield module
+    sys.modules.pop('pa.modules.spotify', None)
+
+
+def metadata(artist, title):
+    return {'xesam:artist': [artist], 'xesam:title': title}
+
+
+def test_watch_writes_each_change_to_the_state_file(spotify, capsys):
+    SessionBus.props = {
+        'Metadata': metadata('Low', 'Words'), 'PlaybackStatus': 'Playing',
+    }
+    states = []
+
+    def script(handlers):
+        changed = handlers['PropertiesChanged']
+        handlers['NameOwnerChanged'](':1.42')
+        states.append(spotify.read_state())
+
+        changed(PLAYER_IFACE, {'PlaybackStatus': 'Paused'}, [])
+        states.append(spotify.read_state())
+
+        # Other interfaces and repeats of what we have shown are ignored
+        changed('org.mpris.MediaPlayer2', {'Identity': 'Spotify'}, [])
+        changed(PLAYER_IFACE, {'PlaybackStatus': 'Paused'}, [])
+
+        changed(PLAYER_IFACE, {
+            'Metadata': metadata('Low', 'Lullaby'),
+            'PlaybackStatus': 'Playing',
+        }, [])
+        states.append(spotify.read_state())
+
+        handlers['NameOwnerChanged']('')
+        states.append(spotify.read_state())
+
+    SessionBus.script = script
+    spotify.watch()
+
+    pid = os.getpid()
+    assert states == [
+        {'running': True, 'track': 'Low: Words', 'status': 'Playing',
+         'pid': pid},
+        {'running': True, 'track': 'Low: Words', 'status': 'Paused',
+         'pid': pid},
+        {'running': True, 'track': 'Low: Lullaby', 'status': 'Playing',
+         'pid': pid},
+        {'running': False, 'track': '', 'status': 'Stopped', 'pid': pid},
+    ]
+    assert capsys.readouterr().out.splitlines() == [
+        'Low: Words', 'Low: Words (paused)', 'Low: Lullaby', '',
+    ]
+    # Nothing is left behind for `current` once the watcher exits
+    assert not os.path.exists(spotify.STATE_PATH)
+
+
+def test_read_state_ignores_a_stale_watcher(spotify):
+    assert spotify.read_state() is None
+
+    # A pid that has exited (and been reaped) can't belong to a watcher
+    proc = subprocess.Popen([sys.executable, '-c', ''])
+    proc.wait()
+    state = {'running': True, 'track': 'Low: Words', 'status': 'Playing'}
+
+    with open(spotify.STATE_PATH, 'w') as f:
+        json.dump(dict(state, pid=proc.pid), f)
+    assert spotify.read_state() is None
+
+    with open(spotify.STATE_PATH, 'w') as f:
+        json.dump(dict(state, pid=os.getpid()), f)
+    assert spotify.read_state() == dict(state, pid=os.getpid())
+
+    with open(spotify.STATE_PATH, 'w') as f:
+        f.write('{"running": tr')
+    assert spotify.read_state() is None
@@ -0,0 +1,103 @@
+'''
+Rolling open TODOs over from earlier daily notes into today's file.
+'''
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+from pa.modules import todo
+from pa.utils import TEMPLATE
+
+
+class Today(datetime):
+    @classmethod
+    def today(cls):
+        return cls(2024, 3, 5, 9, 30)
+
+
+@pytest.fixture
+def notes(db, monkeypatch, tmp_path):
+    '''
+    An empty notes directory with rollover happening on 2024-03-05.
+    '''
+    monkeypatch.setattr(todo, 'datetime', Today)
+    notes.config = SimpleNamespace(
+        note=SimpleNamespace(path=lambda key: str(tmp_path)))
+    notes.daily = tmp_path / 'daily-notes'
+    notes.daily.mkdir()
+    return notes
+
+
+def write_note(notes, rel_path, content):
+    path = notes.daily / rel_path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(content)
+    return path
+
+
+def test_rollover_moves_open_todos(notes):
+    first = write_note(notes, '2024/3/3.md', (
+        TEMPLATE.format('2024/3/3', 'work') +
+        '- [ ] (123) Call the bank\n'
+        '- [x] Done already\n'
+        'Some notes about - [ ] that aren\'t a TODO\n'
+        '- [ ] Buy milk'
+    ).encode())
+    second = write_note(notes, '2024/3/4.md', (
+        TEMPLATE.format('2024/3/4', '') +
+        '- [o] In progress\n'
+        '- [ ] Write report\n'
+    ).encode())
+
+    todo_file = todo.ensure_default_todo_file(notes.config)
+
+    assert todo_file == str(notes.daily / '2024/3/5.md')
+    with open(todo_file) as f:
+        assert f.read() == TEMPLATE.format('2024/3/5', '') + (
+            '\n'
+            '- [ ] (123) Call the bank\n'
+            '- [ ] Buy milk\n'
+            '- [ ] Write report\n'
+        )
+
+    # Only the moved lines change and the rest of each note is untouched
+    assert first.read_text() == (
+        TEMPLATE.format('2024/3/3', 'work') +
+        '- [-] (123) Call the bank\n'
+        '- [x] Done already\n'
+        'Some notes about - [ ] that aren\'t a TODO\n'
+        '- [-] Buy milk'
+    )
+    assert second.read_text() == (
+        TEMPLATE.format('2024/3/4', '') +
+        '- [o] In progress\n'
+        '- [-] Write report\n'
+    )
+
+    # The index sees the rewritten notes: nothing is left to move
+    open_files = todo.update_todo_index(str(notes.daily))
+    del open_files['2024/3/5.md']
+    assert todo.find_todos_to_move(str(notes.daily), open_files) == {}
+
+
+def test_rollover_keeps_bytes_that_are_not_utf8(notes):
+    note = write_note(notes, '2024/3/4.md', (
+        b'### Date :: 2024/3/4\n'
+        b'Caf\xe9 receipts (latin-1)\n'
+        b'- [ ] Pay caf\xe9\n'
+        b'- [ ] Post letter\n'
+    ))
+
+    todo_file = todo.ensure_default_todo_file(notes.config)
+
+    with open(todo_file) as f:
+        assert f.read().splitlines()[-2:] == [
+            '- [ ] Pay caf�', '- [ ] Post letter',
+        ]
+    assert note.read_bytes() == (
+        b'### Date :: 2024/3/4\n'
+        b'Caf\xe9 receipts (latin-1)\n'
+        b'- [-] Pay caf\xe9\n'
+        b'- [-] Post letter\n'
+    )
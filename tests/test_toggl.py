@@ -0,0 +1,306 @@
+'''
+Local toggl time entries and the timer queue.
+'''
+import time
+from datetime import date, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+from pa.db import DB
+from pa.modules import toggl
+
+
+CONFIG = SimpleNamespace(
+    toggl=SimpleNamespace(api_token='token', enabled=True))
+
+
+class Response:
+    def __init__(self, data, status_code=200):
+        self.data = data
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.reason = 'Reason'
+
+    def json(self):
+        return self.data
+
+
+def report_entry(n, day):
+    return {
+        'id': n,
+        'project': 'P{}'.format(n % 2),
+        'client': 'C',
+        'description': 'entry {}'.format(n),
+        'start': '{}T10:00:00+00:00'.format(day.isoformat()),
+        'dur': 60000 * n,
+        'tags': ['a', 'b'],
+    }
+
+
+@pytest.fixture
+def report(db, monkeypatch):
+    '''
+    Serve a paginated detailed report of `report.entries` and record each
+    request made for it.
+    '''
+    def http_request(method, url, **kwargs):
+        params = kwargs['params']
+        # Nothing may hold the database's write lock across a request
+        assert not DB.in_transaction()
+        report.requests.append(params)
+
+        if url == toggl.WORKSPACE_URL:
+            return Response([{'id': 42}])
+
+        rows = [
+            e for e in report.entries
+            if params['since'] <= e['start'][:10] <= params['until']
+        ]
+        page = params['page']
+        return Response({
+            'total_count': len(rows),
+            'per_page': 2,
+            'data': rows[(page - 1) * 2:page * 2],
+        })
+
+    def fetch_many(requests, max_threads=10):
+        for tag, method, url, kwargs in requests:
+            yield tag, http_request(method, url, **kwargs), None
+
+    monkeypatch.setattr(toggl, 'http_request', http_request)
+    monkeypatch.setattr(toggl, 'fetch_many', fetch_many)
+    toggl.TimeEntry.create_table()
+    report.entries = []
+    report.requests = []
+    return report
+
+
+def test_fetch_entries_replaces_the_range(report):
+    day = date(2024, 3, 4)
+    report.entries = [report_entry(n, day) for n in range(1, 6)]
+    toggl.TimeEntry.insert(
+        id=99, start='2024-03-04T09:00:00+00:00', dur=1).execute()
+
+    toggl.fetch_entries(CONFIG, 42, day, day)
+
+    # Three pages of two, with the deleted entry gone
+    assert [r['page'] for r in report.requests] == [1, 2, 3]
+    assert sorted(e.id for e in toggl.TimeEntry.select()) == [1, 2, 3, 4, 5]
+    assert toggl.TimeEntry.get_by_id(3).tags == 'a,b'
+
+
+def test_failed_page_changes_nothing(report, monkeypatch):
+    day = date(2024, 3, 4)
+    report.entries = [report_entry(n, day) for n in range(1, 6)]
+    toggl.TimeEntry.insert(
+        id=99, start='2024-03-04T09:00:00+00:00', dur=1).execute()
+
+    def fetch_many(requests, max_threads=10):
+        for tag, method, url, kwargs in requests:
+            yield tag, Response({}, 503), None
+
+    monkeypatch.setattr(toggl, 'fetch_many', fetch_many)
+
+    with pytest.raises(toggl.requests.HTTPError):
+        toggl.fetch_entries(CONFIG, 42, day, day)
+
+    assert [e.id for e in toggl.TimeEntry.select()] == [99]
+
+
+def test_refresh_only_fetches_missing_and_recent_dates(report):
+    today = date.today()
+    start = today - timedelta(30)
+
+    toggl.refresh_entries(CONFIG, start, today)
+    report.requests.clear()
+    toggl.refresh_entries(CONFIG, start - timedelta(10), today)
+
+    assert [(r['since'], r['until']) for r in report.requests] == [
+        ((start - timedelta(10)).isoformat(),
+         (start - timedelta(1)).isoformat()),
+        ((today - timedelta(toggl.REFRESH_DAYS)).isoformat(),
+         today.isoformat()),
+    ]
+
+
+@pytest.fixture
+def london(monkeypatch):
+    '''
+    Run the test in the Europe/London timezone.
+    '''
+    monkeypatch.setenv('TZ', 'Europe/London')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def add_entries(*entries):
+    toggl.TimeEntry.insert_many([
+        {'id': n, 'project': project, 'client': client, 'start': start,
+         'dur': dur}
+        for n, (project, client, start, dur) in enumerate(entries, 1)
+    ]).execute()
+
+
+def test_group_totals_buckets_by_local_day(db, london):
+    toggl.TimeEntry.create_table()
+    add_entries(
+        # 00:30 BST on the 1st of July
+        ('A', 'X', '2022-06-30T23:30:00+00:00', 1000),
+        # Still the 30th in London (toggl's timezone was ahead)
+        ('A', 'X', '2022-07-01T00:30:00+02:00', 2000),
+        ('B', None, '2022-07-01T12:00:00+01:00', 4000),
+        (None, 'X', '2022-07-02T09:00:00+01:00', 8000),
+    )
+
+    assert toggl.group_totals(
+        date(2022, 7, 1), date(2022, 7, 2), ['day', 'project']
+    ) == [
+        (('2022-07-01', 'A'), 1000),
+        (('2022-07-01', 'B'), 4000),
+        (('2022-07-02', '(no project)'), 8000),
+    ]
+    assert toggl.group_totals(
+        date(2022, 6, 1), date(2022, 7, 31), ['client', 'month']
+    ) == [
+        (('X', '2022-06'), 2000),
+        (('X', '2022-07'), 9000),
+        (('(no client)', '2022-07'), 4000),
+    ]
+
+
+def test_group_totals_weekday_and_week_order(db, london):
+    toggl.TimeEntry.create_table()
+    add_entries(
+        ('A', None, '2024-01-07T10:00:00+00:00', 1),  # Sunday, 2024-W01
+        ('A', None, '2024-01-08T10:00:00+00:00', 2),  # Monday, 2024-W02
+        ('A', None, '2023-12-31T10:00:00+00:00', 4),  # Sunday, 2023-W52
+    )
+
+    assert toggl.group_totals(
+        date(2023, 12, 1), date(2024, 1, 31), ['weekday']
+    ) == [(('Monday',), 2), (('Sunday',), 5)]
+    assert toggl.group_totals(
+        date(2023, 12, 1), date(2024, 1, 31), ['year', 'week']
+    ) == [
+        (('2023', '2023-W52'), 4),
+        (('2024', '2024-W01'), 1),
+        (('2024', '2024-W02'), 2),
+    ]
+
+
+def start_op(n, at, project='P'):
+    return {
+        'op': 'start', 'id': 'start{}'.format(n), 'project': project,
+        'description': 'timer {}'.format(n), 'start': at,
+    }
+
+
+def stop_op(n, start, at):
+    return {
+        'op': 'stop', 'id': 'stop{}'.format(n), 'timer': 'start{}'.format(n),
+        'start': start, 'at': at,
+    }
+
+
+def test_coalesce_pairs_starts_with_their_stops():
+    first = start_op(1, '2024-03-04T10:00:00+00:00')
+    second = start_op(2, '2024-03-04T11:00:00+00:00')
+    ops = [
+        stop_op(0, '2024-03-04T09:00:00+00:00', '2024-03-04T10:00:00+00:00'),
+        first,
+        stop_op(1, first['start'], second['start']),
+        second,
+    ]
+
+    changes = toggl.coalesce(ops)
+
+    assert [(c['ops'], c['timer']) for c in changes] == [
+        (['stop0'], 'start0'),
+        (['start1', 'stop1'], 'start1'),
+        (['start2'], 'start2'),
+    ]
+    assert changes[0]['start'] is None
+    assert changes[1]['start'] is first and changes[1]['stop'] is ops[2]
+    assert changes[2]['stop'] is None
+
+
+@pytest.fixture
+def api(db, monkeypatch, tmp_path):
+    '''
+    Keep the timer queue in a temporary directory and record the requests
+    sent to toggl. Requests fail once `api.fail_after` have been made.
+    '''
+    def http_request(method, url, json=None, **kwargs):
+        if len(api.requests) >= api.fail_after:
+            raise toggl.requests.ConnectionError('Network is down')
+        api.requests.append((method, url, json))
+        return Response({'data': {'id': 1000 + len(api.requests)}})
+
+    for name in ('QUEUE_PATH', 'QUEUE_LOCK_PATH', 'FLUSH_LOCK_PATH'):
+        monkeypatch.setattr(toggl, name, str(tmp_path / name))
+    monkeypatch.setattr(toggl, 'http_request', http_request)
+    toggl.set_state(toggl.PROJECTS_KEY, {'p': 7})
+    api.requests = []
+    api.fail_after = float('inf')
+    return api
+
+
+def queue(*ops):
+    with toggl._lock(toggl.QUEUE_LOCK_PATH):
+        for op in ops:
+            toggl._queue_op(op)
+
+
+def test_flush_drops_short_entries_and_maps_remote_ids(api):
+    short = start_op(1, '2024-03-04T10:00:00+00:00')
+    running = start_op(2, '2024-03-04T10:00:05+00:00')
+    queue(
+        short,
+        stop_op(1, short['start'], running['start']),
+        running,
+    )
+
+    assert toggl.flush_queue(CONFIG) == 0
+    # The five second entry never reaches toggl
+    assert api.requests == [('POST', toggl.TIME_ENTRIES_URL, {'time_entry': {
+        'description': 'timer 2', 'pid': 7, 'start': running['start'],
+        'created_with': 'pa', 'duration': -1709546405,
+    }})]
+    assert toggl.get_state(toggl.REMOTE_IDS_KEY) == {'start2': 1001}
+
+    # A later stop on its own updates the entry toggl already has
+    queue(stop_op(2, running['start'], '2024-03-04T11:00:05+00:00'))
+    assert toggl.flush_queue(CONFIG) == 0
+    assert api.requests[1] == (
+        'PUT', toggl.TIME_ENTRIES_URL + '/1001', {'time_entry': {
+            'stop': '2024-03-04T11:00:05+00:00', 'duration': 3600,
+        }})
+    assert toggl.get_state(toggl.REMOTE_IDS_KEY) == {}
+    assert toggl._read_queue() == []
+
+
+def test_flush_replays_a_partially_flushed_queue(api):
+    ops = []
+    for n in range(3):
+        start = '2024-03-04T1{}:00:00+00:00'.format(n)
+        stop = '2024-03-04T1{}:30:00+00:00'.format(n)
+        ops += [start_op(n, start), stop_op(n, start, stop)]
+    queue(*ops)
+
+    api.fail_after = 1
+    assert toggl.flush_queue(CONFIG) == 4
+    assert 'Network is down' in toggl.get_state(toggl.FLUSH_ERROR_KEY)
+    # Only the change that reached toggl leaves the queue
+    assert toggl._read_queue() == ops[2:]
+
+    api.fail_after = float('inf')
+    assert toggl.flush_queue(CONFIG) == 0
+    assert toggl.get_state(toggl.FLUSH_ERROR_KEY) is None
+    assert [body['time_entry']['description']
+            for method, url, body in api.requests] == [
+        'timer 0', 'timer 1', 'timer 2',
+    ]
+    assert toggl._read_queue() == []